@@ -1,15 +1,135 @@
-from flask import Flask, render_template, request, jsonify, g
-import pandas as pd
+from flask import Flask, Response, render_template, request, jsonify, g
+import numpy as np
 import json
-from datetime import datetime, timedelta
-from dateutil import parser
+from datetime import datetime, timedelta, timezone
 import os
 from flask_sqlalchemy import SQLAlchemy
+import sqlalchemy
+from sqlalchemy import func
 import time
+import queue
+import threading
+import atexit
+import hashlib
+import hmac
+import functools
+import itertools
+import bisect
+import math
+import re
+import click
+import contextlib
+import gzip
+import zlib
+import io
+import csv
+import mmap
+from concurrent.futures import ThreadPoolExecutor
+from collections import OrderedDict, Counter, deque
+import random
+import uuid
+try:
+    import fcntl
+except ImportError:  # not available on Windows
+    fcntl = None
+import sys
+
+EPOCH = datetime(1970, 1, 1)
 
 app = Flask(__name__)
 
-app.config["SQLALCHEMY_DATABASE_URI"] = "sqlite:///database.db"
+app.config["SQLALCHEMY_DATABASE_URI"] = os.environ.get("DATABASE_URL", "sqlite:///database.db")
+
+# Background log writer settings
+app.config["LOG_QUEUE_SIZE"] = int(os.environ.get("LOG_QUEUE_SIZE", 10000))
+app.config["LOG_BATCH_SIZE"] = int(os.environ.get("LOG_BATCH_SIZE", 200))
+app.config["LOG_FLUSH_INTERVAL"] = float(os.environ.get("LOG_FLUSH_INTERVAL", 1.0))  # seconds
+app.config["LOG_QUEUE_POLICY"] = os.environ.get("LOG_QUEUE_POLICY", "drop")  # 'drop' or 'block'
+app.config["LOG_BLOCK_TIMEOUT"] = float(os.environ.get("LOG_BLOCK_TIMEOUT", 0.05))  # seconds
+
+# HTTP caching of the read APIs
+app.config["API_CACHE_MAX_AGE"] = int(os.environ.get("API_CACHE_MAX_AGE", 0))  # seconds before revalidating
+app.config["RESPONSE_CACHE_SIZE"] = int(os.environ.get("RESPONSE_CACHE_SIZE", 512))
+app.config["CALENDAR_CACHE_SIZE"] = int(os.environ.get("CALENDAR_CACHE_SIZE", 1024))
+
+# Course data hot reload: poll the CSVs every N seconds (0 disables the watcher)
+app.config["COURSE_DATA_WATCH_INTERVAL"] = float(os.environ.get("COURSE_DATA_WATCH_INTERVAL", 5.0))
+app.config["COURSE_DATA_RELOAD_TRIGGER"] = os.environ.get(
+    "COURSE_DATA_RELOAD_TRIGGER", os.path.join(app.instance_path, "reload.trigger"))
+
+# Conflict-free schedule search: wall-clock budget per search and cap on alternatives returned
+app.config["SCHEDULE_SEARCH_TIME_BUDGET"] = float(os.environ.get("SCHEDULE_SEARCH_TIME_BUDGET", 0.5))  # seconds
+app.config["SCHEDULE_SEARCH_MAX_RESULTS"] = int(os.environ.get("SCHEDULE_SEARCH_MAX_RESULTS", 20))
+app.config["COURSE_SEARCH_MAX_RESULTS"] = int(os.environ.get("COURSE_SEARCH_MAX_RESULTS", 50))
+
+# Batch calendar API: request size limit and thread pool used once a batch has enough distinct selections
+app.config["BATCH_CALENDAR_MAX_SELECTIONS"] = int(os.environ.get("BATCH_CALENDAR_MAX_SELECTIONS", 5000))
+app.config["BATCH_CALENDAR_WORKERS"] = int(os.environ.get("BATCH_CALENDAR_WORKERS", 4))
+app.config["BATCH_CALENDAR_PARALLEL_MIN"] = int(os.environ.get("BATCH_CALENDAR_PARALLEL_MIN", 32))
+
+# Request profiling: sample a fraction of requests, or keep those slower than PROFILE_SLOW_MS (0 disables both)
+app.config["PROFILE_SAMPLE_RATE"] = float(os.environ.get("PROFILE_SAMPLE_RATE", 0.0))
+app.config["PROFILE_SLOW_MS"] = float(os.environ.get("PROFILE_SLOW_MS", 0.0))
+app.config["PROFILE_INTERVAL_MS"] = float(os.environ.get("PROFILE_INTERVAL_MS", 2.0))  # stack sampling period
+app.config["PROFILE_DIR"] = os.environ.get("PROFILE_DIR", os.path.join(app.instance_path, "profiles"))
+app.config["PROFILE_KEEP"] = int(os.environ.get("PROFILE_KEEP", 50))  # captures kept on disk
+
+# Room occupancy analysis: opening hours used for utilization and the heatmap columns ("start-end" hours)
+app.config["ROOM_HOURS"] = os.environ.get("ROOM_HOURS", "8-22")
+
+# Compiled course data, mapped at startup instead of parsing the CSVs (empty disables it)
+app.config["COURSE_SNAPSHOT"] = os.environ.get(
+    "COURSE_SNAPSHOT", os.path.join(app.instance_path, "course_data.snapshot"))
+
+# Other terms: each subdirectory of COURSE_TERMS_DIR holds its own courses_info.csv and course_sessions.csv,
+# selected with ?term=<name>; the top-level CSVs are DEFAULT_TERM. Terms are loaded on first use and
+# evicted least recently used first beyond DATASET_MAX_RESIDENT or DATASET_MEMORY_BUDGET_MB (0: no budget)
+app.config["COURSE_TERMS_DIR"] = os.environ.get("COURSE_TERMS_DIR", "terms")
+app.config["DEFAULT_TERM"] = os.environ.get("DEFAULT_TERM", "current")
+app.config["DATASET_MAX_RESIDENT"] = int(os.environ.get("DATASET_MAX_RESIDENT", 4))
+app.config["DATASET_MEMORY_BUDGET_MB"] = float(os.environ.get("DATASET_MEMORY_BUDGET_MB", 512))
+
+# Course selection analytics: selections with more courses than this are left out of the co-selection counts
+app.config["SELECTION_PAIRS_MAX_COURSES"] = int(os.environ.get("SELECTION_PAIRS_MAX_COURSES", 50))
+
+# Log retention: raw rows older than LOG_RETENTION_DAYS are archived to gzipped JSON Lines and deleted,
+# minute rollups older than ROLLUP_MINUTE_RETENTION_DAYS are dropped (the hourly ones are kept)
+app.config["LOG_RETENTION_DAYS"] = float(os.environ.get("LOG_RETENTION_DAYS", 30))  # 0 keeps raw rows forever
+app.config["ROLLUP_MINUTE_RETENTION_DAYS"] = float(os.environ.get("ROLLUP_MINUTE_RETENTION_DAYS", 7))
+app.config["LOG_ARCHIVE_DIR"] = os.environ.get("LOG_ARCHIVE_DIR", os.path.join(app.instance_path, "archive"))
+app.config["LOG_ARCHIVE_CHUNK_ROWS"] = int(os.environ.get("LOG_ARCHIVE_CHUNK_ROWS", 50000))  # rows per archive file
+app.config["LOG_DELETE_BATCH"] = int(os.environ.get("LOG_DELETE_BATCH", 500))  # rows per delete transaction
+app.config["LOG_DELETE_PAUSE"] = float(os.environ.get("LOG_DELETE_PAUSE", 0.05))  # seconds between delete batches
+app.config["LOG_RETENTION_INTERVAL"] = float(os.environ.get("LOG_RETENTION_INTERVAL", 86400))  # seconds, 0 disables
+
+# Log ingest policy: per-route sampling ("route=rate,..." keyed by URL rule), a per-worker budget of detailed
+# request_log rows per second (0 disables throttling), and health/bot traffic that is only counted
+app.config["LOG_SAMPLE_RATES"] = os.environ.get("LOG_SAMPLE_RATES", "/static/<path:filename>=0.1")
+app.config["LOG_DETAIL_BUDGET"] = float(os.environ.get("LOG_DETAIL_BUDGET", 100))  # rows per second
+app.config["LOG_HEALTH_PATHS"] = os.environ.get("LOG_HEALTH_PATHS", "/health,/healthz,/ping")
+app.config["LOG_HEALTH_AGENTS"] = os.environ.get(
+    "LOG_HEALTH_AGENTS", r"AlwaysOn|HealthCheck|ReadyForRequest|kube-probe|ELB-HealthChecker|GoogleHC")
+# Crawler product tokens: a word ending in bot/crawler/spider/slurp directly followed by its version, a
+# ';', '+', ')' or '-' ("Googlebot/2.1", "Yahoo! Slurp;"), so device names such as "Cubot X19" do not match
+app.config["LOG_BOT_AGENTS"] = os.environ.get(
+    "LOG_BOT_AGENTS",
+    r"\b[\w.-]*(?:bot|crawler|spider|slurp)(?=[/;+)-])|\bfacebookexternalhit\b|\bBingpreview\b")
+app.config["USER_AGENT_CACHE_SIZE"] = int(os.environ.get("USER_AGENT_CACHE_SIZE", 10000))
+
+# Rows read per query while streaming /stats/export
+app.config["EXPORT_CHUNK_ROWS"] = int(os.environ.get("EXPORT_CHUNK_ROWS", 5000))
+
+# Admin endpoints require this token in X-Admin-Token; without it they only answer local requests
+app.config["ADMIN_TOKEN"] = os.environ.get("ADMIN_TOKEN")
+
+# Latency metrics spool shared by all workers
+app.config["METRICS_SPOOL_DIR"] = os.environ.get("METRICS_SPOOL_DIR", os.path.join(app.instance_path, "metrics"))
+app.config["METRICS_SPOOL_INTERVAL"] = float(os.environ.get("METRICS_SPOOL_INTERVAL", 5.0))  # seconds
+
+# Live dashboard stream (/stats/stream)
+app.config["LIVE_STATS_INTERVAL"] = float(os.environ.get("LIVE_STATS_INTERVAL", 2.0))  # seconds between updates
+app.config["LIVE_STATS_STREAM_SECONDS"] = float(os.environ.get("LIVE_STATS_STREAM_SECONDS", 300))
+app.config["LIVE_STATS_MAX_STREAMS"] = int(os.environ.get("LIVE_STATS_MAX_STREAMS", 8))  # per worker
 
 db = SQLAlchemy(app)
 
@@ -17,254 +137,3761 @@ class RequestLog(db.Model):
     __tablename__ = "request_log"
 
     id = db.Column(db.Integer, primary_key=True, autoincrement=True)
-    timestamp = db.Column(db.DateTime, default=datetime.utcnow)
+    timestamp = db.Column(db.DateTime, default=datetime.utcnow, index=True)
     method = db.Column(db.String(10))
     path = db.Column(db.String(255))
     status_code = db.Column(db.Integer)
     response_time = db.Column(db.Float)
     remote_addr = db.Column(db.String(45))
-    user_agent = db.Column(db.Text)
+    user_agent = db.Column(db.Text)  # only on rows logged before user_agent_id
+    user_agent_id = db.Column(db.Integer)
+    weight = db.Column(db.Float, nullable=False, default=1.0)  # requests this row stands for after sampling
 
 class UserActivity(db.Model):
     __tablename__ = "user_activity"
 
     id = db.Column(db.Integer, primary_key=True, autoincrement=True)
-    timestamp = db.Column(db.DateTime, default=datetime.utcnow)
+    timestamp = db.Column(db.DateTime, default=datetime.utcnow, index=True)
     activity_type = db.Column(db.String(50))  # 'site_visit', 'calendar_export', 'course_selection', etc.
     details = db.Column(db.Text)  # JSON string with additional details
     remote_addr = db.Column(db.String(45))
-    user_agent = db.Column(db.Text)
+    user_agent = db.Column(db.Text)  # only on rows logged before user_agent_id
+    user_agent_id = db.Column(db.Integer)
+
+class UserAgent(db.Model):
+    """Each distinct User-Agent header once, referenced by the log tables"""
+    __tablename__ = "user_agent"
+
+    id = db.Column(db.Integer, primary_key=True, autoincrement=True)
+    user_agent = db.Column(db.String(512), nullable=False, unique=True)
+    timestamp = db.Column(db.DateTime, nullable=False, index=True)  # first seen
+
+class RequestCount:
+    """A request counted in the rollups without a request_log row (sampled out, health check or bot).
+
+    Submitted to the log writer like a model, but never inserted itself.
+    """
+
+class TrafficCounter(db.Model):
+    """Hourly counts of health-check and bot requests, which get no request_log rows"""
+    __tablename__ = "traffic_counter"
+    __table_args__ = (
+        db.UniqueConstraint('bucket', 'category', 'label'),
+    )
+
+    id = db.Column(db.Integer, primary_key=True, autoincrement=True)
+    bucket = db.Column(db.DateTime, nullable=False)
+    category = db.Column(db.String(20), nullable=False)  # 'health' or 'bot'
+    label = db.Column(db.String(100), nullable=False)  # bot name or health-check path
+    count = db.Column(db.Integer, nullable=False, default=0)
+
+class RequestRollup(db.Model):
+    """Request counts and latency sums per time bucket, path, method and status"""
+    __tablename__ = "request_rollup"
+    __table_args__ = (
+        db.UniqueConstraint('granularity', 'bucket', 'path', 'method', 'status_code'),
+    )
+
+    id = db.Column(db.Integer, primary_key=True, autoincrement=True)
+    granularity = db.Column(db.String(10), nullable=False)  # 'minute' or 'hour'
+    bucket = db.Column(db.DateTime, nullable=False)  # start of the bucket (UTC)
+    path = db.Column(db.String(255), nullable=False)
+    method = db.Column(db.String(10), nullable=False)
+    status_code = db.Column(db.Integer, nullable=False)
+    count = db.Column(db.Integer, nullable=False, default=0)
+    response_time_sum = db.Column(db.Float, nullable=False, default=0.0)
+
+class ActivityRollup(db.Model):
+    """User activity counts per time bucket and activity type"""
+    __tablename__ = "activity_rollup"
+    __table_args__ = (
+        db.UniqueConstraint('granularity', 'bucket', 'activity_type'),
+    )
+
+    id = db.Column(db.Integer, primary_key=True, autoincrement=True)
+    granularity = db.Column(db.String(10), nullable=False)
+    bucket = db.Column(db.DateTime, nullable=False)
+    activity_type = db.Column(db.String(50), nullable=False)
+    count = db.Column(db.Integer, nullable=False, default=0)
+
+class CourseSelection(db.Model):
+    """One row per course of a logged course selection or calendar export"""
+    __tablename__ = "course_selection"
+    __table_args__ = (
+        db.Index('ix_course_selection_course', 'course_id', 'timestamp'),
+    )
+
+    id = db.Column(db.Integer, primary_key=True, autoincrement=True)
+    selection_key = db.Column(db.String(32), nullable=False, index=True)  # shared by the rows of one activity
+    timestamp = db.Column(db.DateTime, nullable=False, index=True)
+    activity_type = db.Column(db.String(50), nullable=False)  # 'course_selection' or 'calendar_export'
+    course_id = db.Column(db.String(50), nullable=False)
+    selection_size = db.Column(db.Integer, nullable=False)
+    in_conflict = db.Column(db.Boolean, nullable=False, default=False)  # overlaps another selected course
+
+class CourseSelectionCount(db.Model):
+    """Running selection and conflict counts per activity type and course"""
+    __tablename__ = "course_selection_count"
+    __table_args__ = (
+        db.UniqueConstraint('activity_type', 'course_id'),
+        db.Index('ix_course_selection_count_rank', 'activity_type', 'count'),
+    )
+
+    id = db.Column(db.Integer, primary_key=True, autoincrement=True)
+    activity_type = db.Column(db.String(50), nullable=False)
+    course_id = db.Column(db.String(50), nullable=False)
+    count = db.Column(db.Integer, nullable=False, default=0)
+    conflict_count = db.Column(db.Integer, nullable=False, default=0)
+
+class CoSelectionCount(db.Model):
+    """How often two courses were selected together (course1 < course2)"""
+    __tablename__ = "co_selection_count"
+    __table_args__ = (
+        db.UniqueConstraint('activity_type', 'course1', 'course2'),
+        db.Index('ix_co_selection_count_course2', 'activity_type', 'course2'),
+    )
+
+    id = db.Column(db.Integer, primary_key=True, autoincrement=True)
+    activity_type = db.Column(db.String(50), nullable=False)
+    course1 = db.Column(db.String(50), nullable=False)
+    course2 = db.Column(db.String(50), nullable=False)
+    count = db.Column(db.Integer, nullable=False, default=0)
+
+class SchemaMigration(db.Model):
+    """One-off data migrations that have already been applied"""
+    __tablename__ = "schema_migration"
+
+    name = db.Column(db.String(100), primary_key=True)
+    applied_at = db.Column(db.DateTime, default=datetime.utcnow)
+
+ROLLUP_GRANULARITIES = ('minute', 'hour')
+
+def rollup_buckets(timestamp):
+    """Return (granularity, bucket start) pairs for a log timestamp"""
+    minute = timestamp.replace(second=0, microsecond=0)
+    return (('minute', minute), ('hour', minute.replace(minute=0)))
+
+def upsert(model):
+    """INSERT ... ON CONFLICT statement for the configured database"""
+    if db.engine.dialect.name == 'postgresql':
+        from sqlalchemy.dialects.postgresql import insert
+    else:
+        from sqlalchemy.dialects.sqlite import insert
+    return insert(model.__table__)
+
+def update_rollups(rows_by_model):
+    """Fold a batch of raw log rows into the rollup tables"""
+    requests = {}
+    for row in itertools.chain(rows_by_model.get(RequestLog, ()), rows_by_model.get(RequestCount, ())):
+        for granularity, bucket in rollup_buckets(row['timestamp']):
+            key = (granularity, bucket, row['path'] or '', row['method'] or '', row['status_code'] or 0)
+            count, total = requests.get(key, (0, 0.0))
+            requests[key] = (count + 1, total + (row['response_time'] or 0.0))
+
+    activities = {}
+    for row in rows_by_model.get(UserActivity, ()):
+        for granularity, bucket in rollup_buckets(row['timestamp']):
+            key = (granularity, bucket, row['activity_type'] or '')
+            activities[key] = activities.get(key, 0) + 1
+
+    if requests:
+        stmt = upsert(RequestRollup)
+        stmt = stmt.on_conflict_do_update(
+            index_elements=['granularity', 'bucket', 'path', 'method', 'status_code'],
+            set_={
+                'count': RequestRollup.count + stmt.excluded['count'],
+                'response_time_sum': RequestRollup.response_time_sum + stmt.excluded.response_time_sum
+            }
+        )
+        db.session.execute(stmt, [
+            {'granularity': granularity, 'bucket': bucket, 'path': path, 'method': method,
+             'status_code': status_code, 'count': count, 'response_time_sum': total}
+            for (granularity, bucket, path, method, status_code), (count, total) in requests.items()
+        ])
+
+    if activities:
+        stmt = upsert(ActivityRollup)
+        stmt = stmt.on_conflict_do_update(
+            index_elements=['granularity', 'bucket', 'activity_type'],
+            set_={'count': ActivityRollup.count + stmt.excluded['count']}
+        )
+        db.session.execute(stmt, [
+            {'granularity': granularity, 'bucket': bucket, 'activity_type': activity_type, 'count': count}
+            for (granularity, bucket, activity_type), count in activities.items()
+        ])
+
+def update_traffic_counters(rows_by_model):
+    """Fold health-check and bot requests into the hourly traffic counters"""
+    counts = Counter()
+    for row in rows_by_model.get(RequestCount, ()):
+        if row['category'] in ('health', 'bot'):
+            bucket = row['timestamp'].replace(minute=0, second=0, microsecond=0)
+            counts[(bucket, row['category'], row['label'][:100])] += 1
+    if counts:
+        stmt = upsert(TrafficCounter)
+        stmt = stmt.on_conflict_do_update(
+            index_elements=['bucket', 'category', 'label'],
+            set_={'count': TrafficCounter.count + stmt.excluded['count']}
+        )
+        db.session.execute(stmt, [
+            {'bucket': bucket, 'category': category, 'label': label, 'count': count}
+            for (bucket, category, label), count in counts.items()
+        ])
+
+def backfill_rollups(chunk_size=5000):
+    """Build rollups from raw log rows written before the rollup tables existed"""
+    columns = {
+        RequestLog: (RequestLog.timestamp, RequestLog.path, RequestLog.method,
+                     RequestLog.status_code, RequestLog.response_time),
+        UserActivity: (UserActivity.timestamp, UserActivity.activity_type),
+    }
+    for model, cols in columns.items():
+        query = db.session.query(*cols).filter(model.timestamp.isnot(None)).yield_per(chunk_size)
+        chunk = []
+        for row in query:
+            chunk.append(row._asdict())
+            if len(chunk) >= chunk_size:
+                update_rollups({model: chunk})
+                chunk = []
+        update_rollups({model: chunk})
+
+SELECTION_ACTIVITIES = ('course_selection', 'calendar_export')
+
+def update_selection_counts(rows_by_model):
+    """Fold a batch of CourseSelection rows into the per-course and co-selection counts"""
+    selections = {}
+    for row in rows_by_model.get(CourseSelection, ()):
+        selections.setdefault((row['activity_type'], row['selection_key']), []).append(row)
+
+    courses = {}
+    pairs = {}
+    max_courses = app.config["SELECTION_PAIRS_MAX_COURSES"]
+    for (activity_type, _), rows in selections.items():
+        for row in rows:
+            key = (activity_type, row['course_id'])
+            count, conflicts = courses.get(key, (0, 0))
+            courses[key] = (count + 1, conflicts + bool(row['in_conflict']))
+        if len(rows) > max_courses:
+            continue
+        course_ids = sorted(row['course_id'] for row in rows)
+        for i, course1 in enumerate(course_ids):
+            for course2 in course_ids[i + 1:]:
+                key = (activity_type, course1, course2)
+                pairs[key] = pairs.get(key, 0) + 1
+
+    if courses:
+        stmt = upsert(CourseSelectionCount)
+        stmt = stmt.on_conflict_do_update(
+            index_elements=['activity_type', 'course_id'],
+            set_={
+                'count': CourseSelectionCount.count + stmt.excluded['count'],
+                'conflict_count': CourseSelectionCount.conflict_count + stmt.excluded.conflict_count
+            }
+        )
+        db.session.execute(stmt, [
+            {'activity_type': activity_type, 'course_id': course_id, 'count': count, 'conflict_count': conflicts}
+            for (activity_type, course_id), (count, conflicts) in courses.items()
+        ])
+
+    if pairs:
+        stmt = upsert(CoSelectionCount)
+        stmt = stmt.on_conflict_do_update(
+            index_elements=['activity_type', 'course1', 'course2'],
+            set_={'count': CoSelectionCount.count + stmt.excluded['count']}
+        )
+        db.session.execute(stmt, [
+            {'activity_type': activity_type, 'course1': course1, 'course2': course2, 'count': count}
+            for (activity_type, course1, course2), count in pairs.items()
+        ])
+
+def selection_rows(activity_type, course_ids, matrix, timestamp, selection_key):
+    """CourseSelection rows for one activity, flagging courses that overlap another selected one"""
+    course_ids = list(dict.fromkeys(course_ids))
+    mask = matrix.mask_of(course_ids)
+    rows = []
+    for course_id in course_ids:
+        code = matrix.position.get(course_id)
+        rows.append({
+            'selection_key': selection_key,
+            'timestamp': timestamp,
+            'activity_type': activity_type,
+            'course_id': course_id,
+            'selection_size': len(course_ids),
+            'in_conflict': code is not None and bool(matrix.rows[code] & mask)
+        })
+    return rows
+
+def backfill_course_selections(chunk_size=5000):
+    """Normalize the selections and exports logged as JSON before CourseSelection existed.
+
+    Conflict flags use the course data loaded now. Deltas from
+    /api/calendar/delta only carry the toggled courses and are skipped.
+    """
+    matrix = scheduler.get_conflict_matrix()
+    query = db.session.query(
+        UserActivity.id, UserActivity.timestamp, UserActivity.activity_type, UserActivity.details
+    ).filter(
+        UserActivity.activity_type.in_(SELECTION_ACTIVITIES),
+        UserActivity.details.isnot(None),
+        UserActivity.timestamp.isnot(None)
+    ).yield_per(chunk_size)
+    chunk = []
+    for activity_id, timestamp, activity_type, details in query:
+        try:
+            details = json.loads(details)
+        except ValueError:
+            continue
+        course_ids = details.get('selected_courses') or details.get('exported_courses')
+        if not isinstance(course_ids, list) or not course_ids:
+            continue
+        chunk.extend(selection_rows(activity_type, [str(c) for c in course_ids], matrix,
+                                    timestamp, f"activity-{activity_id}"))
+        if len(chunk) >= chunk_size:
+            db.session.execute(db.insert(CourseSelection), chunk)
+            update_selection_counts({CourseSelection: chunk})
+            chunk = []
+    if chunk:
+        db.session.execute(db.insert(CourseSelection), chunk)
+        update_selection_counts({CourseSelection: chunk})
+
+def create_log_indexes():
+    """Add the timestamp indexes to log tables created before they were declared"""
+    connection = db.session.connection()
+    for model in (RequestLog, UserActivity):
+        for index in model.__table__.indexes:
+            index.create(connection, checkfirst=True)
+
+def add_ingest_columns():
+    """Add the user_agent_id and weight columns, moving logged User-Agent texts into user_agent"""
+    connection = db.session.connection()
+    inspector = sqlalchemy.inspect(connection)
+    for model, column, ddl in ((RequestLog, 'user_agent_id', 'INTEGER'),
+                               (RequestLog, 'weight', 'FLOAT NOT NULL DEFAULT 1.0'),
+                               (UserActivity, 'user_agent_id', 'INTEGER')):
+        if column not in {c['name'] for c in inspector.get_columns(model.__tablename__)}:
+            connection.execute(sqlalchemy.text(f"ALTER TABLE {model.__tablename__} ADD COLUMN {column} {ddl}"))
+
+    for model in (RequestLog, UserActivity):
+        logged = (model.user_agent.isnot(None)) & (model.user_agent != '')
+        texts = db.session.query(func.substr(model.user_agent, 1, 512), func.min(model.timestamp)).filter(
+            logged).group_by(func.substr(model.user_agent, 1, 512)).all()
+        if not texts:
+            continue
+        stmt = upsert(UserAgent).on_conflict_do_nothing(index_elements=['user_agent'])
+        db.session.execute(stmt, [{'user_agent': text, 'timestamp': first or datetime.utcnow()}
+                                  for text, first in texts])
+        db.session.execute(db.update(model).where(logged).values(
+            user_agent_id=db.select(UserAgent.id).where(
+                UserAgent.user_agent == func.substr(model.user_agent, 1, 512)).scalar_subquery(),
+            user_agent=None
+        ))
+
+def run_migration(name, func):
+    """Apply a data migration once across all workers.
+
+    The marker row is inserted first, in the same transaction as the
+    migration, so concurrent workers wait on it and then skip.
+    """
+    try:
+        if db.session.get(SchemaMigration, name) is not None:
+            return False
+        db.session.add(SchemaMigration(name=name))
+        db.session.flush()
+        func()
+        db.session.commit()
+        return True
+    except Exception as e:
+        db.session.rollback()
+        if db.session.get(SchemaMigration, name) is None:
+            print(f"Migration {name} failed: {e}")
+        return False
+
+class LogWriter:
+    """Queue log rows in memory and insert them in batches from a background thread.
+
+    Requests only pay for a queue put. The writer thread commits a multi-row
+    insert once LOG_BATCH_SIZE rows are pending or LOG_FLUSH_INTERVAL seconds
+    have passed. When the queue is full, the 'drop' policy discards the row
+    (counted in stats) and the 'block' policy waits up to LOG_BLOCK_TIMEOUT
+    before dropping it.
+    """
+
+    def __init__(self, app, max_queue=10000, batch_size=200, flush_interval=1.0,
+                 policy='drop', block_timeout=0.05):
+        if policy not in ('drop', 'block'):
+            raise ValueError(f"Unknown log queue policy: {policy}")
+        self.app = app
+        self.max_queue = max_queue
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.policy = policy
+        self.block_timeout = block_timeout
+        self.submitted = 0
+        self.dropped = 0
+        self.written = 0
+        self.failed = 0
+        self.batches = 0
+        self.batch_hooks = []
+        self.prepare_hooks = []
+        self.commit_hooks = []
+        self.commit_guards = []
+        self._lock = threading.Lock()
+        self._pid = None
+        self._queue = None
+        self._thread = None
+
+    def _ensure_started(self):
+        # Started lazily, and again after a fork, so each gunicorn worker owns its thread
+        if self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            self._queue = queue.Queue(maxsize=self.max_queue)
+            self._thread = threading.Thread(target=self._run, name='log-writer', daemon=True)
+            self._thread.start()
+            self._pid = os.getpid()
+
+    def add_batch_hook(self, hook):
+        """Call hook(rows_by_model) inside every batch's transaction"""
+        self.batch_hooks.append(hook)
+
+    def add_prepare_hook(self, hook):
+        """Call hook(rows_by_model) before a batch is inserted; it may rewrite the rows"""
+        self.prepare_hooks.append(hook)
+
+    def add_commit_hook(self, hook, guard=None):
+        """Call hook(rows_by_model) once a batch is committed, never for batches rolled back.
+
+        guard() is a context manager held from just before the commit until
+        the hook has run, so readers taking it see the hook's effects and the
+        commit together.
+        """
+        self.commit_hooks.append(hook)
+        if guard is not None:
+            self.commit_guards.append(guard)
+
+    def submit(self, model, row):
+        """Queue one row for insertion into model's table"""
+        self._ensure_started()
+        # Request threads submit concurrently; += on an attribute is not atomic
+        with self._lock:
+            self.submitted += 1
+        try:
+            if self.policy == 'block':
+                self._queue.put((model, row), timeout=self.block_timeout)
+            else:
+                self._queue.put_nowait((model, row))
+        except queue.Full:
+            with self._lock:
+                self.dropped += 1
+
+    def flush(self, timeout=5.0):
+        """Block until every row queued so far has been written"""
+        if self._pid != os.getpid():
+            return True
+        done = threading.Event()
+        self._queue.put(done)
+        return done.wait(timeout)
+
+    def stop(self, timeout=5.0):
+        """Write out pending rows and stop the writer thread"""
+        if self._pid != os.getpid():
+            return
+        self._queue.put(None)
+        self._thread.join(timeout)
+        self._pid = None
+
+    def stats(self):
+        return {
+            'policy': self.policy,
+            'queued': self._queue.qsize() if self._pid == os.getpid() else 0,
+            'max_queue': self.max_queue,
+            'submitted': self.submitted,
+            'written': self.written,
+            'dropped': self.dropped,
+            'failed': self.failed,
+            'batches': self.batches
+        }
+
+    def _run(self):
+        batch = []
+        deadline = None
+        while True:
+            timeout = None if deadline is None else max(deadline - time.monotonic(), 0)
+            try:
+                item = self._queue.get(timeout=timeout)
+            except queue.Empty:
+                item = False  # flush interval elapsed
+
+            if item is False or item is None or isinstance(item, threading.Event):
+                self._write(batch)
+                batch, deadline = [], None
+                if item is None:
+                    return
+                if isinstance(item, threading.Event):
+                    item.set()
+                continue
+
+            batch.append(item)
+            if deadline is None:
+                deadline = time.monotonic() + self.flush_interval
+            if len(batch) >= self.batch_size:
+                self._write(batch)
+                batch, deadline = [], None
+
+    def _write(self, batch):
+        if not batch:
+            return
+        rows_by_model = {}
+        for model, row in batch:
+            rows_by_model.setdefault(model, []).append(row)
+        with self.app.app_context(), contextlib.ExitStack() as guards:
+            try:
+                for hook in self.prepare_hooks:
+                    hook(rows_by_model)
+                for model, rows in rows_by_model.items():
+                    # Rows of plain classes such as RequestCount only feed the batch hooks
+                    if hasattr(model, '__table__'):
+                        db.session.execute(db.insert(model), rows)
+                for hook in self.batch_hooks:
+                    hook(rows_by_model)
+                for guard in self.commit_guards:
+                    guards.enter_context(guard())
+                db.session.commit()
+                self.written += len(batch)
+                self.batches += 1
+            except Exception as e:
+                # Don't let logging errors kill the writer thread
+                print(f"Log writer error: {e}")
+                db.session.rollback()
+                self.failed += len(batch)
+                return
+            for hook in self.commit_hooks:
+                try:
+                    hook(rows_by_model)
+                except Exception as e:
+                    print(f"Log writer commit hook error: {e}")
+
+log_writer = LogWriter(
+    app,
+    max_queue=app.config["LOG_QUEUE_SIZE"],
+    batch_size=app.config["LOG_BATCH_SIZE"],
+    flush_interval=app.config["LOG_FLUSH_INTERVAL"],
+    policy=app.config["LOG_QUEUE_POLICY"],
+    block_timeout=app.config["LOG_BLOCK_TIMEOUT"]
+)
+log_writer.add_batch_hook(update_rollups)
+log_writer.add_batch_hook(update_selection_counts)
+log_writer.add_batch_hook(update_traffic_counters)
+atexit.register(log_writer.stop)
+
+def archive_json(value):
+    if isinstance(value, datetime):
+        return value.isoformat()
+    raise TypeError(f"Cannot archive {type(value).__name__}")
+
+def read_archive(directory, table, since=None, until=None):
+    """Yield archived rows of a table, oldest chunk first, optionally only those in [since, until)"""
+    # Timestamps are stored as ISO strings, which sort like the datetimes
+    since = since.isoformat() if since else None
+    until = until.isoformat() if until else None
+    for path in archive_files(directory, table):
+        for row in iter_archive_chunk(path):
+            timestamp = row.get('timestamp')
+            if since and (timestamp is None or timestamp < since):
+                continue
+            if until and (timestamp is None or timestamp >= until):
+                continue
+            yield row
+
+def archive_files(directory, table):
+    """Archive chunk paths of a table; names sort in the order they were written"""
+    if not directory or not os.path.isdir(directory):
+        return []
+    prefix = table + '.'
+    return [os.path.join(directory, name) for name in sorted(os.listdir(directory))
+            if name.startswith(prefix) and name.endswith('.jsonl.gz')]
+
+class LogRetention:
+    """Keep the raw log tables small: archive and delete old rows, drop old minute rollups.
+
+    Expired raw rows are written to gzipped JSON Lines chunks in archive_dir
+    (table.<utc time>.jsonl.gz, at most chunk_rows rows each) before they are
+    deleted. Every delete removes at most batch_size rows in its own short
+    transaction, with a pause in between, so the log writer never waits long
+    for the SQLite write lock. A run that stops between writing a chunk and
+    deleting its rows finishes those deletes first next time, so no row is
+    archived twice. Hourly rollups are the downsampled history and are kept.
+    """
+
+    raw_models = (RequestLog, UserActivity, CourseSelection)
+    rollup_models = (RequestRollup, ActivityRollup)
+
+    def __init__(self, app, archive_dir, raw_days=30, minute_rollup_days=7, chunk_rows=50000,
+                 batch_size=500, pause=0.05, interval=86400, lock_path=None):
+        self.app = app
+        self.archive_dir = archive_dir
+        self.raw_days = raw_days
+        self.minute_rollup_days = minute_rollup_days
+        self.chunk_rows = chunk_rows
+        self.batch_size = batch_size
+        self.pause = pause
+        self.interval = interval
+        self.lock_path = lock_path
+        self.runs = 0
+        self.last_run = None
+        self.last_result = None
+        self.last_error = None
+        self._pid = None
+        self._lock = threading.Lock()
+
+    def start(self):
+        """Run retention from a background thread in this process every interval seconds"""
+        if self.interval <= 0 or self._pid == os.getpid():
+            return
+        self._pid = os.getpid()
+        threading.Thread(target=self._loop, name='log-retention', daemon=True).start()
+
+    def _loop(self):
+        while True:
+            try:
+                self.run()
+            except Exception as e:
+                # Keep the thread alive; the next run retries
+                print(f"Log retention error: {e}")
+            time.sleep(self.interval)
+
+    def run(self, now=None):
+        """Apply the retention policy once; returns counts, or None if another process holds the lock"""
+        with self._lock, self._process_lock() as locked:
+            if not locked:
+                return None
+            now = now or datetime.utcnow()
+            started = time.monotonic()
+            result = {'archived': {}, 'deleted': {}, 'files': []}
+            with self.app.app_context():
+                try:
+                    if self.raw_days > 0:
+                        cutoff = now - timedelta(days=self.raw_days)
+                        for model in self.raw_models:
+                            archived, deleted, files = self.expire_rows(model, cutoff)
+                            result['archived'][model.__tablename__] = archived
+                            result['deleted'][model.__tablename__] = deleted
+                            result['files'] += files
+                    if self.minute_rollup_days > 0:
+                        cutoff = now - timedelta(days=self.minute_rollup_days)
+                        for model in self.rollup_models:
+                            result['deleted'][model.__tablename__] = self.delete_where(
+                                (model.granularity == 'minute') & (model.bucket < cutoff), model)
+                    self.last_error = None
+                except Exception as e:
+                    db.session.rollback()
+                    self.last_error = str(e)
+                    raise
+                finally:
+                    self.runs += 1
+                    self.last_run = now
+            result['duration'] = round(time.monotonic() - started, 3)
+            self.last_result = result
+            return result
+
+    @contextlib.contextmanager
+    def _process_lock(self):
+        # One run at a time across the gunicorn workers sharing the database
+        if self.lock_path is None or fcntl is None:
+            yield True
+            return
+        os.makedirs(os.path.dirname(self.lock_path) or '.', exist_ok=True)
+        with open(self.lock_path, 'a') as f:
+            try:
+                fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except OSError:
+                yield False
+                return
+            yield True  # closing the file releases the lock
+
+    def expire_rows(self, model, cutoff):
+        """Archive (if archive_dir is set) and delete the rows of model older than cutoff"""
+        table = model.__tablename__
+        deleted = 0
+        if self.archive_dir:
+            files = archive_files(self.archive_dir, table)
+            if files:
+                # The newest chunk may have been written by a run that stopped before deleting it.
+                # Its ids may since have been reused by new rows (no AUTOINCREMENT), so only old ones go.
+                deleted += self.delete_ids(model, [row['id'] for row in iter_archive_chunk(files[-1])],
+                                           model.timestamp < cutoff)
+        else:
+            return 0, self.delete_where(model.timestamp < cutoff, model), []
+
+        archived, written = 0, []
+        columns = model.__table__.columns
+        while True:
+            rows = [row._asdict() for row in db.session.query(*columns).filter(
+                model.timestamp < cutoff).order_by(model.id).limit(self.chunk_rows)]
+            db.session.commit()  # end the read transaction before writing
+            if not rows:
+                break
+            written.append(self.write_chunk(table, rows))
+            archived += len(rows)
+            deleted += self.delete_ids(model, [row['id'] for row in rows])
+        return archived, deleted, written
+
+    def write_chunk(self, table, rows):
+        os.makedirs(self.archive_dir, exist_ok=True)
+        name = f"{table}.{datetime.utcnow():%Y%m%dT%H%M%S%f}.jsonl.gz"
+        path = os.path.join(self.archive_dir, name)
+        tmp_path = path + '.tmp'
+        with gzip.open(tmp_path, 'wt', encoding='utf-8') as f:
+            for row in rows:
+                f.write(json.dumps(row, default=archive_json) + '\n')
+        os.replace(tmp_path, path)  # a chunk only exists once it is complete
+        return name
+
+    def delete_ids(self, model, ids, condition=None):
+        deleted = 0
+        for start in range(0, len(ids), self.batch_size):
+            where = model.id.in_(ids[start:start + self.batch_size])
+            if condition is not None:
+                where = where & condition
+            result = db.session.execute(db.delete(model).where(where))
+            db.session.commit()
+            deleted += result.rowcount
+            self._yield_lock()
+        return deleted
+
+    def delete_where(self, condition, model):
+        deleted = 0
+        while True:
+            ids = [row[0] for row in db.session.query(model.id).filter(condition).limit(self.batch_size)]
+            if not ids:
+                db.session.commit()
+                return deleted
+            db.session.execute(db.delete(model).where(model.id.in_(ids)))
+            db.session.commit()
+            deleted += len(ids)
+            self._yield_lock()
+
+    def _yield_lock(self):
+        # Give the log writer a chance to take the write lock between batches
+        if self.pause > 0:
+            time.sleep(self.pause)
+
+    def stats(self):
+        return {
+            'raw_days': self.raw_days,
+            'minute_rollup_days': self.minute_rollup_days,
+            'archive_dir': self.archive_dir or None,
+            'runs': self.runs,
+            'last_run': self.last_run.isoformat() if self.last_run else None,
+            'last_result': self.last_result,
+            'last_error': self.last_error
+        }
+
+def iter_archive_chunk(path):
+    with gzip.open(path, 'rt', encoding='utf-8') as f:
+        for line in f:
+            yield json.loads(line)
+
+log_retention = LogRetention(
+    app,
+    app.config["LOG_ARCHIVE_DIR"],
+    raw_days=app.config["LOG_RETENTION_DAYS"],
+    minute_rollup_days=app.config["ROLLUP_MINUTE_RETENTION_DAYS"],
+    chunk_rows=app.config["LOG_ARCHIVE_CHUNK_ROWS"],
+    batch_size=app.config["LOG_DELETE_BATCH"],
+    pause=app.config["LOG_DELETE_PAUSE"],
+    interval=app.config["LOG_RETENTION_INTERVAL"],
+    lock_path=os.path.join(app.config["LOG_ARCHIVE_DIR"] or app.instance_path, ".retention.lock")
+)
+
+class LatencyHistogram:
+    """Mergeable log-linear histogram of latencies in milliseconds.
+
+    Values are kept in microseconds. Each power of two is split into
+    SUB_BUCKETS linear buckets, so a reported percentile is within 1/SUB_BUCKETS
+    (12.5%) of the true value.
+    """
+
+    SUB_BUCKETS = 8
+    SUB_BITS = 3
+
+    def __init__(self):
+        self.buckets = {}
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+    @classmethod
+    def bucket_of(cls, micros):
+        if micros < 2 * cls.SUB_BUCKETS:
+            return micros
+        shift = micros.bit_length() - 1 - cls.SUB_BITS
+        return shift * cls.SUB_BUCKETS + (micros >> shift)
+
+    @classmethod
+    def upper_bound(cls, bucket):
+        """Exclusive upper bound of a bucket, in microseconds"""
+        shift = max(bucket // cls.SUB_BUCKETS - 1, 0)
+        mantissa = bucket - shift * cls.SUB_BUCKETS
+        return (mantissa + 1) << shift
+
+    def record(self, value_ms):
+        bucket = self.bucket_of(max(int(value_ms * 1000), 0))
+        self.buckets[bucket] = self.buckets.get(bucket, 0) + 1
+        self.count += 1
+        self.sum += value_ms
+        if value_ms > self.max:
+            self.max = value_ms
+
+    def merge(self, other):
+        for bucket, count in other.buckets.items():
+            self.buckets[bucket] = self.buckets.get(bucket, 0) + count
+        self.count += other.count
+        self.sum += other.sum
+        self.max = max(self.max, other.max)
+
+    def percentile(self, q):
+        """Latency in milliseconds below which a fraction q of requests fall"""
+        if not self.count:
+            return 0.0
+        rank = q * self.count
+        seen = 0
+        for bucket in sorted(self.buckets):
+            seen += self.buckets[bucket]
+            if seen >= rank:
+                return min(self.upper_bound(bucket) / 1000.0, self.max)
+        return self.max
+
+    def since(self, earlier):
+        """Histogram of the values recorded after earlier, a past copy of this histogram"""
+        histogram = LatencyHistogram()
+        for bucket, count in self.buckets.items():
+            count -= earlier.buckets.get(bucket, 0)
+            if count > 0:
+                histogram.buckets[bucket] = count
+        histogram.count = self.count - earlier.count
+        histogram.sum = self.sum - earlier.sum
+        # The maximum of the difference is unknown; its highest bucket bounds it
+        histogram.max = self.upper_bound(max(histogram.buckets)) / 1000.0 if histogram.buckets else 0.0
+        return histogram
+
+    def to_dict(self):
+        return {'buckets': self.buckets, 'count': self.count, 'sum': self.sum, 'max': self.max}
+
+    @classmethod
+    def from_dict(cls, data):
+        histogram = cls()
+        histogram.buckets = {int(bucket): count for bucket, count in data['buckets'].items()}
+        histogram.count = data['count']
+        histogram.sum = data['sum']
+        histogram.max = data['max']
+        return histogram
+
+
+def write_spool_file(path, data):
+    """Atomically replace a worker's spool file with data as JSON"""
+    try:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_file = path + '.tmp'
+        with open(tmp_file, 'w') as f:
+            json.dump(data, f)
+        os.replace(tmp_file, path)
+    except Exception as e:
+        print(f"Metrics spool error: {e}")
+
+RETIRED_SPOOL = 'retired.json'
+
+def load_spool_file(path, default=None):
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return default
+
+def read_spool_files(directory):
+    """The contents of every worker's spool file in directory, exited workers' as one retired snapshot.
+
+    The retired file names the worker files it has absorbed; those are
+    skipped until compact_spool has removed them. If a listed file vanishes
+    mid-read, it was just absorbed, so the directory is read again.
+    """
+    for _ in range(3):
+        try:
+            names = [name for name in os.listdir(directory) if name.endswith('.json') and name != RETIRED_SPOOL]
+        except FileNotFoundError:
+            return []
+        # Read after listing: a file absorbed since then is in `absorbed`
+        retired = load_spool_file(os.path.join(directory, RETIRED_SPOOL), {'absorbed': [], 'data': None})
+        absorbed = set(retired['absorbed'])
+        snapshots = [retired['data']] if retired['data'] is not None else []
+        vanished = False
+        for name in names:
+            if name in absorbed:
+                continue
+            try:
+                with open(os.path.join(directory, name)) as f:
+                    snapshots.append(json.load(f))
+            except FileNotFoundError:
+                vanished = True
+                break
+            except (OSError, ValueError):
+                continue  # being replaced by another worker
+        if not vanished:
+            break
+    return snapshots
+
+def process_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass  # exists, owned by someone else
+    return True
+
+def compact_spool(directory, merge):
+    """Fold the spool files of exited workers into the retired file, so the directory stays small.
+
+    Worker files are named <pid>-<start ms>.json; merge(snapshots) combines
+    snapshots into one. The retired file is replaced first and lists what it
+    absorbed, then those files are removed, so readers never count one twice.
+    """
+    if fcntl is None:
+        return  # no flock, and os.kill(pid, 0) would not be a liveness check
+    try:
+        names = [name for name in os.listdir(directory) if name.endswith('.json') and name != RETIRED_SPOOL]
+    except FileNotFoundError:
+        return
+    dead = [name for name in names if name.split('-', 1)[0].isdigit() and not process_alive(int(name.split('-', 1)[0]))]
+    if not dead:
+        return
+    with open(os.path.join(directory, 'compact.lock'), 'a') as lock:
+        try:
+            fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            return  # another worker is compacting
+        retired_path = os.path.join(directory, RETIRED_SPOOL)
+        retired = load_spool_file(retired_path, {'absorbed': [], 'data': None})
+        # Files absorbed by a compaction that stopped before removing them are only removed
+        leftover = [name for name in dead if name in retired['absorbed']]
+        snapshots = [retired['data']] if retired['data'] is not None else []
+        absorbed = list(leftover)
+        for name in dead:
+            if name in leftover:
+                continue
+            snapshot = load_spool_file(os.path.join(directory, name))
+            if snapshot is not None:
+                snapshots.append(snapshot)
+                absorbed.append(name)
+        write_spool_file(retired_path, {'absorbed': absorbed, 'data': merge(snapshots)})
+        for name in absorbed:
+            try:
+                os.remove(os.path.join(directory, name))
+            except OSError:
+                pass
+
+
+class LatencyMetrics:
+    """Per-route latency histograms for this process, spooled to disk for the other workers.
+
+    Every worker periodically writes its cumulative histograms to its own JSON
+    file in the spool directory. The metrics endpoint merges all files, so the
+    numbers cover every worker (including ones that have since exited) without
+    touching the database; the files of exited workers are folded into one.
+    """
+
+    QUANTILES = (0.5, 0.9, 0.99)
+
+    def __init__(self, spool_dir, spool_interval=5.0):
+        self.spool_dir = spool_dir
+        self.spool_interval = spool_interval
+        self.histograms = {}
+        self._lock = threading.Lock()
+        self._pid = None
+        self._spool_name = None
+        self._next_spool = 0.0
+
+    def _ensure_process(self):
+        # Start from empty histograms in each forked worker
+        if self._pid != os.getpid():
+            self.histograms = {}
+            self._pid = os.getpid()
+            self._spool_name = f"{self._pid}-{int(time.time() * 1000)}.json"
+
+    def record(self, route, status_code, value_ms):
+        key = (route, f"{status_code // 100}xx")
+        with self._lock:
+            self._ensure_process()
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = self.histograms[key] = LatencyHistogram()
+            histogram.record(value_ms)
+        if time.monotonic() >= self._next_spool:
+            self.spool()
+
+    def spool(self):
+        """Write this process's histograms to its spool file"""
+        self._next_spool = time.monotonic() + self.spool_interval
+        with self._lock:
+            if self._pid != os.getpid():
+                return
+            snapshot = self.to_snapshot(self.histograms)
+            spool_file = os.path.join(self.spool_dir, self._spool_name)
+        write_spool_file(spool_file, snapshot)
+
+    @staticmethod
+    def to_snapshot(histograms):
+        return [{'route': route, 'status': status, 'histogram': histogram.to_dict()}
+                for (route, status), histogram in histograms.items()]
+
+    @staticmethod
+    def merge_snapshots(snapshots):
+        merged = {}
+        for snapshot in snapshots:
+            for entry in snapshot:
+                key = (entry['route'], entry['status'])
+                histogram = merged.setdefault(key, LatencyHistogram())
+                histogram.merge(LatencyHistogram.from_dict(entry['histogram']))
+        return merged
+
+    def merged(self):
+        """Histograms merged across every worker's spool file"""
+        self.spool()
+        compact_spool(self.spool_dir, lambda snapshots: self.to_snapshot(self.merge_snapshots(snapshots)))
+        return self.merge_snapshots(read_spool_files(self.spool_dir))
+
+    def render(self):
+        """Render merged histograms in the Prometheus text format"""
+        lines = [
+            '# HELP http_request_duration_ms Request latency in milliseconds by route and status class',
+            '# TYPE http_request_duration_ms summary'
+        ]
+        for (route, status), histogram in sorted(self.merged().items()):
+            labels = f'route="{route}",status="{status}"'
+            for q in self.QUANTILES:
+                lines.append(f'http_request_duration_ms{{{labels},quantile="{q}"}} {histogram.percentile(q):.3f}')
+            lines.append(f'http_request_duration_ms_max{{{labels}}} {histogram.max:.3f}')
+            lines.append(f'http_request_duration_ms_sum{{{labels}}} {histogram.sum:.3f}')
+            lines.append(f'http_request_duration_ms_count{{{labels}}} {histogram.count}')
+        return '\n'.join(lines) + '\n'
+
+latency_metrics = LatencyMetrics(app.config["METRICS_SPOOL_DIR"], app.config["METRICS_SPOOL_INTERVAL"])
+atexit.register(latency_metrics.spool)
+
+class LiveStats:
+    """Dashboard counters pushed by /stats/stream, kept current without querying the logs.
+
+    Each worker folds the rows its log writer commits into cumulative
+    counters (a commit hook, so requests pay nothing extra and rolled back
+    batches are never counted) and spools them after every batch, like
+    LatencyMetrics. A worker serving streams reads the summary from the
+    rollup tables once, then merges the spool files at most once per interval
+    and adds what every worker counted since. All of its viewers share that
+    state, so the cost per update depends on the number of workers, not on
+    the size of the logs. Each open stream still holds one worker thread,
+    which is why a worker serves at most LIVE_STATS_MAX_STREAMS of them.
+
+    Writers hold a shared lock on spool_dir + '.lock' from commit until the
+    batch is spooled, and the first summary is read under the exclusive
+    lock, so every batch is either in both that summary and the baseline
+    spool counters or in neither.
+    """
+
+    COUNTERS = ('paths', 'status_codes', 'methods', 'activities', 'filtered')
+    RECENT = 10
+
+    def __init__(self, spool_dir, interval=2.0, latency_window=60.0):
+        self.spool_dir = spool_dir
+        self.interval = interval
+        self.latency_window = latency_window
+        self.streams = 0
+        self._lock = threading.Lock()
+        self._seed_lock = threading.Lock()
+        self._pid = None
+        self._spool_name = None
+        self._local = None
+        self._base = None
+        self._baseline = None
+        self._history = deque()  # (monotonic time, merged latency histogram)
+        self._state = None
+        self._next_refresh = 0.0
+
+    @classmethod
+    def empty_counts(cls):
+        counts = {name: Counter() for name in cls.COUNTERS}
+        counts.update({'requests': 0, 'response_time_sum': 0.0, 'latency': LatencyHistogram(), 'recent': []})
+        return counts
+
+    @contextlib.contextmanager
+    def spool_lock(self, mode=None):
+        """Shared lock by default, the guard log writers hold while a committed batch is spooled"""
+        if fcntl is None:
+            yield
+            return
+        os.makedirs(os.path.dirname(self.spool_dir) or '.', exist_ok=True)
+        with open(self.spool_dir + '.lock', 'a') as f:
+            fcntl.flock(f, fcntl.LOCK_SH if mode is None else mode)
+            yield  # closing the file releases the lock
+
+    def observe(self, rows_by_model):
+        """Commit hook: count the requests and activities of a log writer batch, then spool"""
+        with self._lock:
+            if self._pid != os.getpid():
+                self._pid = os.getpid()
+                self._spool_name = f"{self._pid}-{int(time.time() * 1000)}.json"
+                self._local = self.empty_counts()
+            local = self._local
+            for row in itertools.chain(rows_by_model.get(RequestLog, ()), rows_by_model.get(RequestCount, ())):
+                response_time = row['response_time'] or 0.0
+                local['requests'] += 1
+                local['response_time_sum'] += response_time
+                local['latency'].record(response_time)
+                local['paths'][row['path'] or ''] += 1
+                local['status_codes'][str(row['status_code'] or 0)] += 1
+                local['methods'][row['method'] or ''] += 1
+                if row.get('category') in ('health', 'bot'):
+                    local['filtered'][row['category']] += 1
+            for row in rows_by_model.get(UserActivity, ()):
+                local['activities'][row['activity_type'] or ''] += 1
+                local['recent'].append({
+                    'timestamp': row['timestamp'].isoformat() if row['timestamp'] else None,
+                    'type': row['activity_type'],
+                    'details': row['details'],
+                    'remote_addr': row['remote_addr']
+                })
+            del local['recent'][:-self.RECENT]
+            snapshot = self.to_snapshot(local)
+            spool_file = os.path.join(self.spool_dir, self._spool_name)
+        write_spool_file(spool_file, snapshot)
+
+    @classmethod
+    def to_snapshot(cls, counts):
+        recent = sorted(counts['recent'], key=lambda activity: activity['timestamp'] or '')[-cls.RECENT:]
+        return dict(counts, latency=counts['latency'].to_dict(), recent=recent)
+
+    @classmethod
+    def merge_snapshots(cls, snapshots):
+        merged = cls.empty_counts()
+        for snapshot in snapshots:
+            merged['requests'] += snapshot['requests']
+            merged['response_time_sum'] += snapshot['response_time_sum']
+            merged['latency'].merge(LatencyHistogram.from_dict(snapshot['latency']))
+            merged['recent'] += snapshot['recent']
+            for name in cls.COUNTERS:
+                merged[name].update(snapshot[name])
+        return merged
+
+    def merged(self):
+        """Cumulative counters of every worker's spool file"""
+        compact_spool(self.spool_dir, lambda snapshots: self.to_snapshot(self.merge_snapshots(snapshots)))
+        return self.merge_snapshots(read_spool_files(self.spool_dir))
+
+    def current(self):
+        """The dashboard state (shaped like /stats/summary plus a latency window), refreshed at most once per interval"""
+        if self._base is None:
+            # Not under self._lock: this thread's log writer may be waiting for it in observe()
+            with self._seed_lock:
+                if self._base is None:
+                    with self.spool_lock(fcntl and fcntl.LOCK_EX):
+                        # Counters spooled before the summary is read are already in the rollups
+                        self._baseline = self.merged()
+                        self._base = summary_counts()
+        with self._lock:
+            now = time.monotonic()
+            if self._state is not None and now < self._next_refresh:
+                return self._state
+            merged = self.merged()
+            self._history.append((now, merged['latency']))
+            while len(self._history) > 1 and self._history[1][0] <= now - self.latency_window:
+                self._history.popleft()
+            self._state = self.build_state(merged, self._history[0][1])
+            self._next_refresh = now + self.interval
+            return self._state
+
+    def build_state(self, merged, window_start):
+        base, baseline = self._base, self._baseline
+        counts = {'requests': base['requests'] + merged['requests'] - baseline['requests'],
+                  'response_time_sum': base['response_time_sum'] + merged['response_time_sum'] - baseline['response_time_sum']}
+        for name in self.COUNTERS:
+            counts[name] = Counter(base[name])
+            counts[name].update(merged[name])
+            counts[name].subtract(baseline[name])
+        seen = {(a['timestamp'], a['type'], a['remote_addr'], a['details']) for a in baseline['recent']}
+        recent = base['recent'] + [dict(activity, details=json.loads(activity['details']) if activity['details'] else None)
+                                   for activity in merged['recent']
+                                   if (activity['timestamp'], activity['type'], activity['remote_addr'],
+                                       activity['details']) not in seen]
+        counts['recent'] = sorted(recent, key=lambda activity: activity['timestamp'] or '', reverse=True)[:self.RECENT]
+
+        state = summary_payload(counts)
+        window = merged['latency'].since(window_start)
+        state['latency'] = {
+            'window_seconds': self.latency_window,
+            'count': window.count,
+            'avg': round(window.sum / window.count, 3) if window.count else 0.0,
+            **{f"p{int(q * 100)}": round(window.percentile(q), 3) for q in LatencyMetrics.QUANTILES}
+        }
+        return state
+
+    def open_stream(self, limit):
+        """Count a new viewer of this worker, unless limit viewers are already connected"""
+        with self._lock:
+            if self.streams >= limit:
+                return False
+            self.streams += 1
+            return True
+
+    def close_stream(self):
+        with self._lock:
+            self.streams -= 1
+
+    @staticmethod
+    def delta(previous, state):
+        """The parts of state that changed since previous; new recent activities are listed on their own"""
+        changes = {key: value for key, value in state.items()
+                   if key != 'user_activities' and previous.get(key) != value}
+        activities, previous_activities = state['user_activities'], previous['user_activities']
+        changed = {key: value for key, value in activities.items()
+                   if key != 'recent_activities' and previous_activities.get(key) != value}
+        if changed:
+            changes['user_activities'] = changed
+        shown = previous_activities['recent_activities']
+        new = [activity for activity in activities['recent_activities'] if activity not in shown]
+        if new:
+            changes['new_activities'] = new
+        return changes
+
+live_stats = LiveStats(os.path.join(app.config["METRICS_SPOOL_DIR"], 'live'), app.config["LIVE_STATS_INTERVAL"])
+log_writer.add_commit_hook(live_stats.observe, guard=live_stats.spool_lock)
+
+class NullSpan:
+    """Stand-in returned by profile_span() when the request is not being profiled"""
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+NULL_SPAN = NullSpan()
+
+
+class Span:
+    """Times one phase of a profiled request"""
+
+    def __init__(self, capture, name):
+        self.capture = capture
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        self.capture.depth += 1
+        return self
+
+    def __exit__(self, *exc):
+        end = time.perf_counter()
+        self.capture.depth -= 1
+        self.capture.spans.append({
+            'name': self.name,
+            'depth': self.capture.depth,
+            'start_ms': round((self.start - self.capture.start) * 1000, 3),
+            'duration_ms': round((end - self.start) * 1000, 3)
+        })
+        return False
+
+
+class ProfileCapture:
+    """Stack samples and spans collected for one request"""
+
+    def __init__(self, trigger, thread_id):
+        self.trigger = trigger        # 'sampled', 'admin' or 'slow'
+        self.thread_id = thread_id
+        self.start = time.perf_counter()
+        self.samples = Counter()      # folded stack -> count
+        self.spans = []
+        self.depth = 0
+        self.ended = False
+
+
+class RequestProfiler:
+    """Opt-in sampling profiler for requests.
+
+    A request is profiled when it is picked at PROFILE_SAMPLE_RATE, or sends
+    X-Profile: 1 with admin rights; with PROFILE_SLOW_MS set, every request
+    records its spans and is kept only if it turns out slower than that. While
+    requests are watched, a background thread samples their stacks every
+    interval; a request on the slow trigger is only watched once it has run
+    for slow_watch_share of the threshold, so fast requests are never sampled.
+    Kept captures are written as folded stacks (the input format of
+    flamegraph.pl and speedscope) plus a JSON file with the spans, and only
+    the newest `keep` captures are left in the directory.
+    """
+
+    slow_watch_share = 0.5
+
+    def __init__(self, directory, sample_rate=0.0, slow_ms=0.0, interval_ms=2.0, keep=50):
+        self.directory = directory
+        self.sample_rate = sample_rate
+        self.slow_ms = slow_ms
+        self.interval = interval_ms / 1000
+        self.keep = keep
+        self.local = threading.local()
+        self._open = 0
+        self._watched = {}
+        self._pending = deque()       # (watch from, capture) of slow-trigger requests, in start order
+        self._lock = threading.Lock()
+        self._wakeup = threading.Condition(self._lock)
+        self._sampler_pid = None
+        self._sequence = 0
+
+    @property
+    def always_watch(self):
+        return self.slow_ms > 0
+
+    def begin(self, trigger):
+        """Start profiling the current thread's request"""
+        capture = ProfileCapture(trigger, threading.get_ident())
+        self.local.capture = capture
+        if self._sampler_pid != os.getpid():
+            self._sampler_pid = os.getpid()
+            threading.Thread(target=self._sample, name='request-profiler', daemon=True).start()
+        with self._lock:
+            self._open += 1
+            if trigger == 'slow':
+                self._pending.append((capture.start + self.slow_ms * self.slow_watch_share / 1000, capture))
+                if len(self._pending) > 1:
+                    return capture  # the sampler already waits for an earlier one
+            else:
+                self._watched[capture.thread_id] = capture
+            self._wakeup.notify()
+        return capture
+
+    def end(self):
+        """Stop profiling the current request; returns its capture or None"""
+        if not self._open:
+            return None
+        capture = getattr(self.local, 'capture', None)
+        if capture is None:
+            return None
+        self.local.capture = None
+        with self._lock:
+            self._open -= 1
+            capture.ended = True
+            if self._watched.get(capture.thread_id) is capture:
+                del self._watched[capture.thread_id]
+        return capture
+
+    def span(self, name):
+        # Nothing is profiled in this process: skip the thread-local lookup
+        if not self._open:
+            return NULL_SPAN
+        capture = getattr(self.local, 'capture', None)
+        return Span(capture, name) if capture is not None else NULL_SPAN
+
+    def _promote(self):
+        # Start watching slow-trigger requests that are still running at their watch time
+        now = time.perf_counter()
+        while self._pending and self._pending[0][0] <= now:
+            _, capture = self._pending.popleft()
+            if not capture.ended:
+                self._watched[capture.thread_id] = capture
+
+    def _sample(self):
+        while True:
+            with self._lock:
+                self._promote()
+                while not self._watched:
+                    timeout = self._pending[0][0] - time.perf_counter() if self._pending else None
+                    self._wakeup.wait(timeout)
+                    self._promote()
+            time.sleep(self.interval)
+            frames = sys._current_frames()
+            with self._lock:
+                for thread_id, capture in self._watched.items():
+                    frame = frames.get(thread_id)
+                    if frame is not None:
+                        capture.samples[fold_stack(frame)] += 1
+
+    def new_name(self, path):
+        """Unique capture name; names sort by time across workers"""
+        self._sequence += 1
+        slug = ''.join(c if c.isalnum() else '_' for c in path.strip('/'))[:40] or 'root'
+        return f"{time.strftime('%Y%m%dT%H%M%S', time.gmtime())}-{os.getpid()}-{self._sequence:04d}-{slug}"
+
+    def save(self, name, capture, meta):
+        """Write a capture to the ring directory"""
+        os.makedirs(self.directory, exist_ok=True)
+        base = os.path.join(self.directory, name)
+        with open(base + '.folded', 'w') as f:
+            for stack, count in capture.samples.most_common():
+                f.write(f"{stack} {count}\n")
+        meta = dict(meta, name=name, trigger=capture.trigger, samples=sum(capture.samples.values()),
+                    interval_ms=self.interval * 1000, spans=sorted(capture.spans, key=lambda s: s['start_ms']))
+        with open(base + '.json', 'w') as f:
+            json.dump(meta, f)
+        self.prune()
+
+    def prune(self):
+        """Delete all but the newest `keep` captures"""
+        names = sorted(self.list_names(), reverse=True)
+        for name in names[self.keep:]:
+            for suffix in ('.folded', '.json'):
+                try:
+                    os.remove(os.path.join(self.directory, name + suffix))
+                except OSError:
+                    pass  # another worker got there first
+
+    def list_names(self):
+        try:
+            return [f[:-len('.json')] for f in os.listdir(self.directory) if f.endswith('.json')]
+        except OSError:
+            return []
+
+    def list(self):
+        """Metadata of the stored captures, newest first"""
+        captures = []
+        for name in sorted(self.list_names(), reverse=True):
+            try:
+                with open(os.path.join(self.directory, name + '.json')) as f:
+                    meta = json.load(f)
+            except (OSError, ValueError):
+                continue
+            meta.pop('spans', None)
+            captures.append(meta)
+        return captures
+
+    def path_of(self, name, suffix):
+        """File of a stored capture, or None for unknown names"""
+        if name not in self.list_names():
+            return None
+        return os.path.join(self.directory, name + suffix)
+
+def fold_stack(frame):
+    """'outer;...;inner' frame names, the folded stack format used by flame graphs"""
+    names = []
+    while frame is not None:
+        code = frame.f_code
+        names.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})")
+        frame = frame.f_back
+    return ';'.join(reversed(names))
+
+request_profiler = RequestProfiler(
+    app.config["PROFILE_DIR"],
+    sample_rate=app.config["PROFILE_SAMPLE_RATE"],
+    slow_ms=app.config["PROFILE_SLOW_MS"],
+    interval_ms=app.config["PROFILE_INTERVAL_MS"],
+    keep=app.config["PROFILE_KEEP"]
+)
+profile_span = request_profiler.span
 
 # Custom statistics middleware
 @app.before_request
 def before_request():
     g.start_time = time.time()
+    g.traffic, g.traffic_label = ingest_policy.classify(request.path, request.headers.get('User-Agent', ''))
+    # Starts once per worker process; a no-op afterwards
+    scheduler.start_watcher(app.config["COURSE_DATA_WATCH_INTERVAL"])
+    datasets.start_watcher()
+    log_retention.start()
+
+    profiler = request_profiler
+    if request.headers.get('X-Profile') == '1' and is_admin_request():
+        profiler.begin('admin')
+    elif profiler.sample_rate and random.random() < profiler.sample_rate:
+        profiler.begin('sampled')
+    elif profiler.always_watch:
+        profiler.begin('slow')
 
 @app.after_request
 def after_request(response):
     try:
         response_time = (time.time() - g.start_time) * 1000  # Convert to milliseconds
         
-        # Log the request
-        log_entry = RequestLog(
-            method=request.method,
-            path=request.path,
-            status_code=response.status_code,
-            response_time=response_time,
-            remote_addr=request.remote_addr,
-            user_agent=request.headers.get('User-Agent', '')
-        )
+        with profile_span('logging'):
+            # Group by URL rule so unknown paths don't each get a histogram
+            route = request.url_rule.rule if request.url_rule else 'unmatched'
+            latency_metrics.record(route, response.status_code, response_time)
+            
+            # Log the request (written in the background by log_writer). Every request
+            # reaches the rollups; the ingest policy decides which get a request_log row
+            row = {
+                'timestamp': datetime.utcnow(),
+                'method': request.method,
+                'path': request.path,
+                'status_code': response.status_code,
+                'response_time': response_time
+            }
+            traffic = g.get('traffic')
+            weight = ingest_policy.sample(route) if traffic is None else None
+            if weight is not None:
+                row.update({
+                    'remote_addr': request.remote_addr,
+                    'user_agent': request.headers.get('User-Agent', ''),
+                    'weight': weight
+                })
+                log_writer.submit(RequestLog, row)
+            else:
+                row.update({'category': traffic or 'sampled', 'label': g.get('traffic_label') or ''})
+                log_writer.submit(RequestCount, row)
         
-        db.session.add(log_entry)
-        db.session.commit()
+        capture = request_profiler.end()
+        if capture is not None and (capture.trigger != 'slow' or response_time >= request_profiler.slow_ms):
+            meta = {
+                'method': request.method,
+                'path': request.path,
+                'query': request.query_string.decode('utf-8', 'replace'),
+                'route': route,
+                'status_code': response.status_code,
+                'response_time': response_time,
+                'timestamp': datetime.utcnow().isoformat()
+            }
+            name = request_profiler.new_name(request.path)
+            # Written once the response has been sent
+            response.call_on_close(lambda: save_profile(name, capture, meta))
+            response.headers['X-Profile-Id'] = name
     except Exception as e:
         # Don't let logging errors crash the app
         print(f"Logging error: {e}")
-        db.session.rollback()
     
     return response
 
+@app.teardown_request
+def teardown_request(exc):
+    # Requests that failed before after_request must not stay watched
+    request_profiler.end()
+
+def save_profile(name, capture, meta):
+    try:
+        request_profiler.save(name, capture, meta)
+    except Exception as e:
+        print(f"Profile write error: {e}")
+
 def log_user_activity(activity_type, details=None):
     """Helper function to log user activities"""
+    if g.get('traffic'):
+        return  # health checks and bots are only counted
     try:
-        activity = UserActivity(
-            activity_type=activity_type,
-            details=json.dumps(details) if details else None,
-            remote_addr=request.remote_addr,
-            user_agent=request.headers.get('User-Agent', '')
-        )
-        db.session.add(activity)
-        db.session.commit()
+        with profile_span('logging'):
+            log_writer.submit(UserActivity, {
+                'timestamp': datetime.utcnow(),
+                'activity_type': activity_type,
+                'details': json.dumps(details) if details else None,
+                'remote_addr': request.remote_addr,
+                'user_agent': request.headers.get('User-Agent', '')
+            })
     except Exception as e:
         print(f"Activity logging error: {e}")
-        db.session.rollback()
+
+def log_course_selection(activity_type, course_ids):
+    """Log one row per selected course for the /stats/courses analytics.
+
+    The analytics tables and the course names they are shown with belong to
+    the default term, so selections made in other terms are not logged.
+    """
+    if g.get('traffic') or g.scheduler is not datasets.default:
+        return
+    try:
+        with profile_span('logging'):
+            if not course_ids:
+                return
+            rows = selection_rows(activity_type, course_ids, g.scheduler.get_conflict_matrix(),
+                                  datetime.utcnow(), uuid.uuid4().hex)
+            for row in rows:
+                log_writer.submit(CourseSelection, row)
+    except Exception as e:
+        print(f"Selection logging error: {e}")
 
 # Create tables within application context
 with app.app_context():
     try:
         db.create_all()
+        run_migration('backfill_rollups', backfill_rollups)
+        run_migration('create_log_indexes', create_log_indexes)
+        run_migration('add_ingest_columns', add_ingest_columns)
         print("Database tables created successfully")
     except Exception as e:
         print(f"Error creating database tables: {e}")
 
+class LRUCache:
+    """Thread-safe bounded mapping that evicts the least recently used entry"""
+
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            try:
+                value = self._data[key]
+            except KeyError:
+                self.misses += 1
+                return default
+            self._data.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def put(self, key, value):
+        with self._lock:
+            self._data[key] = value
+            self._data.move_to_end(key)
+            while len(self._data) > self.capacity:
+                self._data.popitem(last=False)
+                self.evictions += 1
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def __len__(self):
+        return len(self._data)
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            'size': len(self._data),
+            'capacity': self.capacity,
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+            'hit_rate': round(self.hits / lookups, 4) if lookups else 0.0
+        }
+
+def parse_sample_rates(text):
+    """{'route': rate} from 'route=rate,route=rate'"""
+    rates = {}
+    for item in (text or '').split(','):
+        route, _, rate = item.strip().rpartition('=')
+        if route:
+            rates[route] = min(max(float(rate), 0.0), 1.0)
+    return rates
+
+class IngestPolicy:
+    """Decide which requests get a detailed request_log row.
+
+    Health checks and bots (matched on path or User-Agent) are only counted.
+    Other requests are kept with their route's sampling rate and then, once
+    more than `budget` rows per second would be written, with probability
+    budget / (last second's rate). A kept row's weight is 1 / (combined
+    probability), so summing weights estimates the requests it stands for.
+    """
+
+    def __init__(self, sample_rates=None, budget=0, health_paths=(), health_agents=None, bot_agents=None):
+        self.sample_rates = dict(sample_rates or {})
+        self.budget = budget
+        self.health_paths = set(health_paths)
+        self.health_agents = re.compile(health_agents) if health_agents else None
+        self.bot_agents = re.compile(bot_agents, re.IGNORECASE) if bot_agents else None
+        self.counts = Counter()
+        self._lock = threading.Lock()
+        self._second = None
+        self._seen = 0
+        self._keep = 1.0
+
+    def classify(self, path, user_agent):
+        """('health', path), ('bot', name) or (None, None) for ordinary traffic"""
+        if path in self.health_paths or (self.health_agents and self.health_agents.search(user_agent)):
+            self.count('health')
+            return 'health', path
+        match = self.bot_agents.search(user_agent) if self.bot_agents else None
+        if match:
+            self.count('bot')
+            return 'bot', match.group(0)
+        return None, None
+
+    def sample(self, route):
+        """Weight of the detailed row to write for a request to route, or None to only count it"""
+        rate = self.sample_rates.get(route, 1.0)
+        if rate < 1.0 and random.random() >= rate:
+            self.count('sampled_out')
+            return None
+        keep = self.keep_probability()
+        if keep < 1.0 and random.random() >= keep:
+            self.count('throttled')
+            return None
+        self.count('detailed')
+        return 1.0 / (rate * keep)
+
+    def count(self, key):
+        # Called from every request thread; Counter updates are not atomic
+        with self._lock:
+            self.counts[key] += 1
+
+    def keep_probability(self):
+        if not self.budget:
+            return 1.0
+        with self._lock:
+            second = int(time.monotonic())
+            if second != self._second:
+                # Rows offered in the previous second set this second's keep probability
+                offered = self._seen if self._second == second - 1 else 0
+                self._keep = min(1.0, self.budget / offered) if offered else 1.0
+                self._second, self._seen = second, 0
+            self._seen += 1
+            return self._keep
+
+    def stats(self):
+        return {
+            'budget': self.budget,
+            'keep_probability': self._keep,
+            'sample_rates': self.sample_rates,
+            **{key: self.counts[key] for key in ('detailed', 'sampled_out', 'throttled', 'health', 'bot')}
+        }
+
+class UserAgentTable:
+    """Map User-Agent texts to user_agent ids, remembering recent ones in memory.
+
+    New texts are inserted in their own short transaction, so a cached id
+    always refers to a committed row even if the log batch using it fails.
+    """
+
+    max_length = 512
+
+    def __init__(self, cache_size=10000):
+        self.cache = LRUCache(cache_size)
+
+    def ids_of(self, texts):
+        ids, missing = {}, []
+        for text in texts:
+            cached = self.cache.get(text)
+            if cached is None:
+                missing.append(text)
+            else:
+                ids[text] = cached
+        if missing:
+            stmt = upsert(UserAgent).on_conflict_do_nothing(index_elements=['user_agent'])
+            with db.engine.begin() as connection:
+                now = datetime.utcnow()
+                connection.execute(stmt, [{'user_agent': text, 'timestamp': now} for text in missing])
+                found = connection.execute(db.select(UserAgent.user_agent, UserAgent.id).where(
+                    UserAgent.user_agent.in_(missing))).all()
+            for text, user_agent_id in found:
+                self.cache.put(text, user_agent_id)
+                ids[text] = user_agent_id
+        return ids
+
+    def intern_rows(self, rows_by_model):
+        """Replace the user_agent text of queued log rows with a user_agent_id"""
+        rows = [row for model in (RequestLog, UserActivity) for row in rows_by_model.get(model, ())]
+        for row in rows:
+            row['user_agent'] = (row.get('user_agent') or '')[:self.max_length]
+        ids = self.ids_of({row['user_agent'] for row in rows if row['user_agent']})
+        for row in rows:
+            row['user_agent_id'] = ids.get(row.pop('user_agent'))
+
+ingest_policy = IngestPolicy(
+    parse_sample_rates(app.config["LOG_SAMPLE_RATES"]),
+    budget=app.config["LOG_DETAIL_BUDGET"],
+    health_paths=[path for path in app.config["LOG_HEALTH_PATHS"].split(',') if path],
+    health_agents=app.config["LOG_HEALTH_AGENTS"],
+    bot_agents=app.config["LOG_BOT_AGENTS"]
+)
+user_agents = UserAgentTable(app.config["USER_AGENT_CACHE_SIZE"])
+log_writer.add_prepare_hook(user_agents.intern_rows)
+
+def sweep_overlaps(start, end, day, group):
+    """Find overlapping interval pairs with a sort-and-sweep over start times.
+
+    Intervals are integer minutes. Returns index arrays (left, right) for every
+    pair that overlaps on the same day and belongs to different groups.
+    """
+    empty = np.empty(0, dtype=np.int64)
+    n = len(start)
+    if n < 2:
+        return empty, empty
+
+    order = np.argsort(start, kind='stable')
+    start, end, day, group = start[order], end[order], day[order], group[order]
+
+    # Every interval starting before end[k] (and not before start[k]) is a candidate
+    hi = np.searchsorted(start, end, side='left')
+    counts = np.maximum(hi - np.arange(n) - 1, 0)
+    total = int(counts.sum())
+    if total == 0:
+        return empty, empty
+    left = np.repeat(np.arange(n), counts)
+    offsets = np.arange(total) - np.repeat(np.cumsum(counts) - counts, counts)
+    right = left + 1 + offsets
+
+    keep = (end[right] > start[left]) & (day[left] == day[right]) & (group[left] != group[right])
+    return order[left[keep]], order[right[keep]]
+
+
+COURSE_COLUMNS = ['course_id', 'course_name', 'instructor', 'location', 'program']
+WEEKDAYS = ('Monday', 'Tuesday', 'Wednesday', 'Thursday', 'Friday', 'Saturday', 'Sunday')
+
+
+class SessionColumns:
+    """Every session row as parallel arrays, in CSV order.
+
+    Course IDs and the date/time strings are stored as indices into small
+    lookup tables, so the columns can be written to and mapped from a
+    snapshot file as plain arrays.
+    """
+
+    def __init__(self, course_ids, course, strings, date, start_time, end_time, start, end):
+        self.course_ids = course_ids  # course_id for each code in `course`
+        self.course = course          # int32 course code per row
+        self.strings = strings        # table for the date/start_time/end_time columns
+        self.date = date              # int32 indices into strings
+        self.start_time = start_time
+        self.end_time = end_time
+        self.start = start            # minutes since epoch (int64)
+        self.end = end
+
+    def __len__(self):
+        return len(self.start)
+
+    def lookup(self, column, rows):
+        """Original strings of a string-table column for the given rows"""
+        strings = self.strings
+        return [strings[i] for i in column[rows].tolist()]
+
+    @classmethod
+    def empty(cls):
+        no_rows = np.empty(0, dtype=np.int32)
+        no_minutes = np.empty(0, dtype=np.int64)
+        return cls([], no_rows, [], no_rows, no_rows, no_rows, no_minutes, no_minutes)
+
+
+def parse_date_days(value):
+    """Days since epoch for a 'YYYY-MM-DD' date (other formats via dateutil)"""
+    try:
+        parsed = datetime.strptime(value, '%Y-%m-%d')
+    except ValueError:
+        from dateutil import parser
+        parsed = parser.parse(value)
+    return (parsed - EPOCH).days
+
+def parse_time_minutes(value):
+    """Minutes after midnight for an 'H:MM' or 'H:MM:SS' time"""
+    parts = value.strip().split(':')
+    if len(parts) not in (2, 3):
+        raise ValueError(f"Invalid time: {value!r}")
+    hours, minutes = int(parts[0]), int(parts[1])
+    if not (0 <= hours < 24 and 0 <= minutes < 60):
+        raise ValueError(f"Invalid time: {value!r}")
+    return hours * 60 + minutes
+
+def read_courses_csv(path):
+    """Read courses_info.csv into a list of course records"""
+    with open(path, newline='', encoding='utf-8') as f:
+        reader = csv.reader(f)
+        header = next(reader, None) or COURSE_COLUMNS
+        records = []
+        for line_no, row in enumerate(reader, 2):
+            if not row:
+                continue
+            if len(row) != len(header):
+                raise ValueError(f"{path} line {line_no}: expected {len(header)} fields, saw {len(row)}")
+            records.append(dict(zip(header, row)))
+    return records
+
+def read_sessions_csv(path):
+    """Read course_sessions.csv into SessionColumns"""
+    course_codes, string_ids = {}, {}
+    days_cache, minutes_cache = {}, {}
+    course, date, start_time, end_time, start, end = [], [], [], [], [], []
+
+    def intern(value):
+        index = string_ids.get(value)
+        if index is None:
+            index = string_ids[value] = len(string_ids)
+        return index
+
+    def minutes_of(value):
+        minutes = minutes_cache.get(value)
+        if minutes is None:
+            minutes = minutes_cache[value] = parse_time_minutes(value)
+        return minutes
+
+    with open(path, newline='', encoding='utf-8') as f:
+        reader = csv.reader(f)
+        header = next(reader, None)
+        if header is None:
+            return SessionColumns.empty()
+        cols = [header.index(name) for name in ('course_id', 'date', 'start_time', 'end_time')]
+        for line_no, row in enumerate(reader, 2):
+            if not row:
+                continue
+            if len(row) != len(header):
+                raise ValueError(f"{path} line {line_no}: expected {len(header)} fields, saw {len(row)}")
+            course_id, day, start_str, end_str = (row[i] for i in cols)
+            days = days_cache.get(day)
+            if days is None:
+                days = days_cache[day] = parse_date_days(day)
+            code = course_codes.get(course_id)
+            if code is None:
+                code = course_codes[course_id] = len(course_codes)
+            course.append(code)
+            date.append(intern(day))
+            start_time.append(intern(start_str))
+            end_time.append(intern(end_str))
+            start.append(days * 1440 + minutes_of(start_str))
+            end.append(days * 1440 + minutes_of(end_str))
+
+    return SessionColumns(
+        list(course_codes), np.array(course, dtype=np.int32), list(string_ids),
+        np.array(date, dtype=np.int32), np.array(start_time, dtype=np.int32),
+        np.array(end_time, dtype=np.int32), np.array(start, dtype=np.int64), np.array(end, dtype=np.int64)
+    )
+
+
+SNAPSHOT_MAGIC = b'CSNAP001'
+SNAPSHOT_ARRAYS = (
+    ('course', np.int32), ('date', np.int32), ('start_time', np.int32),
+    ('end_time', np.int32), ('start', np.int64), ('end', np.int64)
+)
+
+def write_snapshot(path, index, signature):
+    """Write an index's data to a versioned binary snapshot file.
+
+    Layout: magic, header length (uint64), JSON header, then the session
+    arrays, each 8-byte aligned so they can be mapped in place.
+    """
+    columns = index.session_columns
+    arrays, offsets, offset = [], {}, 0
+    for name, dtype in SNAPSHOT_ARRAYS:
+        data = np.ascontiguousarray(getattr(columns, name), dtype=dtype).tobytes()
+        offsets[name] = [offset, len(columns)]
+        arrays.append(data)
+        offset += len(data) + (-len(data)) % 8
+    header = json.dumps({
+        'version': index.version,
+        'signature': signature,
+        'courses': index.course_records,
+        'course_ids': columns.course_ids,
+        'strings': columns.strings,
+        'arrays': offsets
+    }).encode('utf-8')
+
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    with open(tmp_path, 'wb') as f:
+        f.write(SNAPSHOT_MAGIC)
+        f.write(len(header).to_bytes(8, 'little'))
+        f.write(header)
+        f.write(b'\0' * ((-f.tell()) % 8))
+        for data in arrays:
+            f.write(data)
+            f.write(b'\0' * ((-len(data)) % 8))
+    os.replace(tmp_path, path)  # readers see the old or the new file, never a partial one
+
+def read_snapshot(path):
+    """Map a snapshot file; returns (header, SessionColumns backed by the mapping)"""
+    with open(path, 'rb') as f:
+        if f.read(len(SNAPSHOT_MAGIC)) != SNAPSHOT_MAGIC:
+            raise ValueError(f"{path} is not a course data snapshot")
+        header_length = int.from_bytes(f.read(8), 'little')
+        header = json.loads(f.read(header_length))
+        data_start = f.tell() + (-f.tell()) % 8
+        mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+    arrays = {}
+    for name, dtype in SNAPSHOT_ARRAYS:
+        offset, count = header['arrays'][name]
+        arrays[name] = np.frombuffer(mapped, dtype=dtype, count=count, offset=data_start + offset)
+    columns = SessionColumns(
+        header['course_ids'], arrays['course'], header['strings'], arrays['date'],
+        arrays['start_time'], arrays['end_time'], arrays['start'], arrays['end']
+    )
+    return header, columns
+
+
+class CourseSessions:
+    """Sessions of a single course, in CSV order"""
+
+    def __init__(self, columns, rows):
+        self.columns = columns          # SessionColumns shared by every course
+        self.rows = rows                # row numbers in course_sessions.csv order
+        self.start = columns.start[rows]
+        self.end = columns.end[rows]
+        self.day = self.start // 1440   # days since epoch, used for same-date checks
+        # Date-sorted view for window lookups
+        self.by_start = np.argsort(self.start, kind='stable')
+        self.sorted_start = self.start[self.by_start]
+
+    def __len__(self):
+        return len(self.rows)
+
+    def rows_between(self, start, end):
+        """Rows of the sessions starting in [start, end) minutes, by binary search"""
+        lo, hi = np.searchsorted(self.sorted_start, (start, end), side='left')
+        return self.rows[self.by_start[lo:hi]]
+
+    @functools.cached_property
+    def dates(self):
+        return self.columns.lookup(self.columns.date, self.rows)
+
+    @functools.cached_property
+    def start_times(self):
+        return self.columns.lookup(self.columns.start_time, self.rows)
+
+    @functools.cached_property
+    def end_times(self):
+        return self.columns.lookup(self.columns.end_time, self.rows)
+
+
+class ConflictMatrix:
+    """All-pairs course conflicts, computed once per CourseIndex.
+
+    rows[i] is a bitmask (a Python int) of the courses with a session that
+    overlaps a session of course i on the same date, so checking a selection
+    takes one AND per course. Bit positions are the SessionColumns course codes.
+    """
+
+    def __init__(self, session_columns):
+        self.session_columns = session_columns
+        self.course_ids = session_columns.course_ids
+        self.position = {course_id: code for code, course_id in enumerate(self.course_ids)}
+        self.rows = [0] * len(self.course_ids)
+        # (lower code, higher code) -> (rows of the lower course, rows of the higher one)
+        self.pairs = {}
+
+        codes = session_columns.course
+        left, right = sweep_overlaps(session_columns.start, session_columns.end,
+                                     session_columns.start // 1440, codes)
+        if not len(left):
+            return
+        swap = codes[left] > codes[right]
+        left, right = np.where(swap, right, left), np.where(swap, left, right)
+        order = np.lexsort((right, left, codes[right], codes[left]))
+        left, right = left[order], right[order]
+
+        key = codes[left].astype(np.int64) * len(self.course_ids) + codes[right]
+        bounds = np.flatnonzero(np.diff(key)) + 1
+        for lefts, rights in zip(np.split(left, bounds), np.split(right, bounds)):
+            a, b = int(codes[lefts[0]]), int(codes[rights[0]])
+            self.rows[a] |= 1 << b
+            self.rows[b] |= 1 << a
+            self.pairs[(a, b)] = (lefts, rights)
+
+    def __len__(self):
+        return len(self.course_ids)
+
+    def mask_of(self, course_ids):
+        """Bitmask of the given courses (courses without sessions are ignored)"""
+        mask = 0
+        for course_id in course_ids:
+            code = self.position.get(course_id)
+            if code is not None:
+                mask |= 1 << code
+        return mask
+
+    def ids_of(self, mask):
+        """Course IDs of the bits set in mask, in code order"""
+        return [self.course_ids[code] for code in iter_bits(mask)]
+
+    def conflicts_of(self, course_id):
+        """IDs of the courses that conflict with course_id"""
+        code = self.position.get(course_id)
+        return self.ids_of(self.rows[code]) if code is not None else []
+
+    def conflicts(self, course1, course2):
+        """True when the two courses have overlapping sessions"""
+        code1, code2 = self.position.get(course1), self.position.get(course2)
+        return code1 is not None and code2 is not None and bool(self.rows[code1] >> code2 & 1)
+
+    def has_conflicts(self, course_ids):
+        """True when any two of the given courses conflict"""
+        mask = self.mask_of(course_ids)
+        return any(self.rows[code] & mask for code in iter_bits(mask))
+
+    def session_pairs(self, course1, course2):
+        """Overlapping (course1 row, course2 row) session pairs in CSV order"""
+        code1, code2 = self.position[course1], self.position[course2]
+        pair = self.pairs.get((min(code1, code2), max(code1, code2)))
+        if pair is None:
+            return []
+        lower, higher = pair
+        if code1 < code2:
+            return list(zip(lower.tolist(), higher.tolist()))
+        order = np.lexsort((lower, higher))
+        return list(zip(higher[order].tolist(), lower[order].tolist()))
+
+    def conflict_details(self, course1, course2, window=None):
+        """Date and times of every overlapping session pair (starting in window, if given)"""
+        columns = self.session_columns
+        strings = columns.strings
+        pairs = self.session_pairs(course1, course2)
+        if window is not None:
+            pairs = [(r1, r2) for r1, r2 in pairs if window[0] <= columns.start[r1] < window[1]]
+        return [{
+            'date': strings[columns.date[r1]],
+            'session1': {
+                'start_time': strings[columns.start_time[r1]],
+                'end_time': strings[columns.end_time[r1]]
+            },
+            'session2': {
+                'start_time': strings[columns.start_time[r2]],
+                'end_time': strings[columns.end_time[r2]]
+            }
+        } for r1, r2 in pairs]
+
+    def to_dict(self):
+        """Course order and each course's row as a hex bitmask"""
+        return {
+            'courses': self.course_ids,
+            'matrix': [format(row, 'x') for row in self.rows]
+        }
+
+
+UNASSIGNED_LOCATIONS = {'', 'unspecified', 'tba', 'tbc', 'online'}
+
+def format_day(day):
+    return str(np.datetime64(int(day), 'D'))
+
+def format_minute(minute):
+    return f"{int(minute) // 60:02d}:{int(minute) % 60:02d}"
+
+class RoomOccupancy:
+    """Every session of the catalogue on a per-location, per-day minute timeline.
+
+    Sessions are binned by (location, date). Each bin's timeline is kept
+    run-length encoded: start and end minutes are sorted once for the whole
+    catalogue and a cumulative sum gives the number of concurrent sessions
+    between consecutive change points. Double bookings, peaks and hourly
+    occupancy per weekday are all read off those segments. Courses whose
+    location is empty, 'Unspecified', 'TBA', 'TBC' or 'Online' are left out.
+    """
+
+    def __init__(self, session_columns, location_of, hours=(8, 22)):
+        self.hours = hours
+        columns = session_columns
+        course_locations = [location_of.get(course_id, '') or '' for course_id in columns.course_ids]
+        self.locations = sorted({location for location in course_locations
+                                 if location.strip().lower() not in UNASSIGNED_LOCATIONS})
+        position = {location: code for code, location in enumerate(self.locations)}
+        course_location = np.array([position.get(location, -1) for location in course_locations] or [0],
+                                   dtype=np.int64)
+
+        row_location = course_location[columns.course] if len(columns) else np.empty(0, dtype=np.int64)
+        keep = (row_location >= 0) & (columns.end > columns.start)
+        self.unassigned_sessions = int(len(columns) - keep.sum())
+        location = row_location[keep]
+        start, end = columns.start[keep], columns.end[keep]
+        day = start // 1440
+        start_minute = start - day * 1440
+        end_minute = np.minimum(end - day * 1440, 1440)  # sessions past midnight end with the day
+        self.course_ids = columns.course_ids
+
+        n = len(self.locations)
+        self.sessions = np.bincount(location, minlength=n)
+        self.booked_minutes = np.bincount(location, weights=end_minute - start_minute, minlength=n)
+        self.occupied_minutes = np.zeros(n, dtype=np.int64)
+        self.double_booked_minutes = np.zeros(n, dtype=np.int64)
+        self.days = np.zeros(n, dtype=np.int64)
+        self.peak = np.zeros(n, dtype=np.int64)
+        self.peak_at = [None] * n
+        self.hourly = np.zeros((n, 7, 24), dtype=np.int64)  # occupied minutes per weekday and hour
+        self.clash_location = np.empty(0, dtype=np.int64)
+        self.first_day = self.last_day = None
+        if not len(start):
+            return
+        self.first_day, self.last_day = int(day.min()), int(day.max())
+
+        # A bin is location * span + day offset. All change points are sorted at once;
+        # at equal minutes ends come first, so back-to-back sessions do not overlap
+        span = self.last_day - self.first_day + 1
+        row_bin = location * span + (day - self.first_day)
+        key = np.concatenate([(row_bin * 1441 + start_minute) * 2 + 1, (row_bin * 1441 + end_minute) * 2])
+        key.sort()
+        point_bin, point_minute = key // 2882, key // 2 % 1441
+        concurrent = np.cumsum(np.where(key & 1, 1, -1))
+
+        # Segment i runs from change point i to i + 1 within the same bin
+        same_bin = point_bin[:-1] == point_bin[1:]
+        seg_bin = point_bin[:-1][same_bin]
+        seg_start = point_minute[:-1][same_bin]
+        seg_end = point_minute[1:][same_bin]
+        seg_count = concurrent[:-1][same_bin]
+        seg_location = seg_bin // span
+        seg_day = seg_bin % span + self.first_day
+        seg_length = seg_end - seg_start
+
+        new_bin = np.concatenate(([True], seg_bin[1:] != seg_bin[:-1]))
+        self.days = np.bincount(seg_location[new_bin], minlength=n)
+        occupied = (seg_count > 0) & (seg_length > 0)
+        double = (seg_count > 1) & (seg_length > 0)
+        self.occupied_minutes = np.bincount(seg_location, weights=seg_length * occupied, minlength=n).astype(np.int64)
+        self.double_booked_minutes = np.bincount(seg_location, weights=seg_length * double,
+                                                 minlength=n).astype(np.int64)
+
+        # Segments are ordered by location, day and minute, so the first one at a location's maximum is the earliest
+        location_heads = np.flatnonzero(np.concatenate(([True], seg_location[1:] != seg_location[:-1])))
+        self.peak[seg_location[location_heads]] = np.maximum.reduceat(seg_count, location_heads)
+        at_peak = np.flatnonzero(seg_count == self.peak[seg_location])
+        at_peak = at_peak[np.concatenate(([True], seg_location[at_peak][1:] != seg_location[at_peak][:-1]))]
+        for i in at_peak.tolist():
+            self.peak_at[seg_location[i]] = (int(seg_day[i]), int(seg_start[i]))
+
+        # Occupied minutes per location, weekday and hour. A segment [a, b) adds
+        # clip(b - 60h, 0, 60) - clip(a - 60h, 0, 60) to hour h: 60 to every hour
+        # before the point's hour and the leftover minutes to its own hour
+        cell = np.concatenate([seg_location[occupied] * 7 + (seg_day[occupied] + 3) % 7] * 2)  # day 0 was a Thursday
+        point = np.concatenate([seg_end[occupied], seg_start[occupied]])
+        sign = np.repeat([1, -1], occupied.sum())
+        index = cell * 25 + point // 60
+        per_point = np.bincount(index, weights=sign, minlength=n * 7 * 25).reshape(n * 7, 25)
+        leftover = np.bincount(index, weights=sign * (point % 60), minlength=n * 7 * 25).reshape(n * 7, 25)
+        later = np.cumsum(per_point[:, ::-1], axis=1)[:, ::-1]  # points in this hour or later
+        self.hourly = (60 * later[:, 1:] + leftover[:, :24]).astype(np.int64).reshape(n, 7, 24)
+
+        # Consecutive double-booked segments of a bin form one clash
+        runs = np.flatnonzero(double)
+        if not len(runs):
+            return
+        heads = np.flatnonzero(np.concatenate(([True], (seg_bin[runs[1:]] != seg_bin[runs[:-1]])
+                                               | (seg_start[runs[1:]] != seg_end[runs[:-1]]))))
+        tails = np.concatenate((heads[1:], [len(runs)])) - 1
+        peaks = np.maximum.reduceat(seg_count[runs], heads)
+        run_bin, run_start, run_end = seg_bin[runs[heads]], seg_start[runs[heads]], seg_end[runs[tails]]
+
+        # Only sessions on a clashing bin need to be matched to the clashes
+        nearest = np.minimum(np.searchsorted(run_bin, row_bin), len(run_bin) - 1)  # run_bin is sorted
+        candidates = np.flatnonzero(run_bin[nearest] == row_bin)
+        candidates = candidates[np.argsort(row_bin[candidates], kind='stable')]
+        self.clash_location = run_bin // span
+        self.clash_day = run_bin % span + self.first_day
+        self.clash_start, self.clash_end, self.clash_peak = run_start, run_end, peaks
+        self.clash_rows = (candidates,
+                           np.searchsorted(row_bin[candidates], run_bin, side='left'),
+                           np.searchsorted(row_bin[candidates], run_bin, side='right'))
+        self.row_course = columns.course[keep]
+        self.row_start, self.row_end = start_minute, end_minute
+
+    def clash(self, i):
+        """Details of the i-th double booking (ordered by location, date and time)"""
+        candidates, lo, hi = self.clash_rows
+        start, end = self.clash_start[i], self.clash_end[i]
+        rows = candidates[lo[i]:hi[i]]
+        rows = rows[(self.row_start[rows] < end) & (self.row_end[rows] > start)]
+        return {
+            'location': self.locations[self.clash_location[i]],
+            'date': format_day(self.clash_day[i]),
+            'start_time': format_minute(start),
+            'end_time': format_minute(end),
+            'concurrent': int(self.clash_peak[i]),
+            'courses': sorted({self.course_ids[code] for code in self.row_course[rows].tolist()})
+        }
+
+    def weekday_counts(self):
+        """How often each weekday occurs between the first and last session date"""
+        counts = np.zeros(7, dtype=np.int64)
+        if self.first_day is None:
+            return counts
+        weeks, extra = divmod(self.last_day - self.first_day + 1, 7)
+        counts += weeks
+        counts[(self.first_day + 3 + np.arange(extra)) % 7] += 1
+        return counts
+
+    def summary(self, location, weekday_counts):
+        code = self.locations.index(location)
+        open_hours = range(*self.hours)
+        open_minutes = int(weekday_counts.sum()) * 60 * len(open_hours)
+        heatmap = {}
+        for weekday, name in enumerate(WEEKDAYS):
+            available = weekday_counts[weekday] * 60
+            heatmap[name] = [round(float(self.hourly[code, weekday, hour]) / available, 4) if available else 0.0
+                             for hour in open_hours]
+        peak_at = self.peak_at[code]
+        return {
+            'location': location,
+            'sessions': int(self.sessions[code]),
+            'days': int(self.days[code]),
+            'booked_minutes': int(self.booked_minutes[code]),
+            'occupied_minutes': int(self.occupied_minutes[code]),
+            'double_booked_minutes': int(self.double_booked_minutes[code]),
+            'peak_concurrent': int(self.peak[code]),
+            'peak_at': {'date': format_day(peak_at[0]), 'time': format_minute(peak_at[1])} if peak_at else None,
+            'utilization': round(int(self.hourly[code][:, open_hours.start:open_hours.stop].sum()) / open_minutes, 4)
+                           if open_minutes else 0.0,
+            'heatmap': heatmap
+        }
+
+    def to_dict(self, location=None, limit=100):
+        """Per-location summaries (or one location's) and the first `limit` clashes"""
+        locations = [location] if location is not None else self.locations
+        clashes = np.arange(len(self.clash_location))
+        if location is not None:
+            clashes = clashes[self.clash_location == self.locations.index(location)]
+        return {
+            'date_range': [format_day(self.first_day), format_day(self.last_day)] if self.first_day is not None else None,
+            'hours': [format_minute(hour * 60) for hour in self.hours],
+            'unassigned_sessions': self.unassigned_sessions,
+            'locations': [self.summary(name, self.weekday_counts()) for name in locations],
+            'clash_count': len(clashes),
+            'clashes': [self.clash(i) for i in clashes[:limit].tolist()]
+        }
+
+SEARCH_FIELDS = (('course_id', 5), ('course_name', 3), ('instructor', 2), ('program', 1), ('location', 1))
+
+SEARCH_WORD = re.compile(r'[a-z0-9]+')
+SEARCH_WORD_PART = re.compile(r'[a-z]+|[0-9]+')
+
+def search_tokens(text, split=True):
+    """Lowercase words of text; with split, codes such as 'PMBA6013' also yield 'pmba' and '6013'"""
+    tokens = []
+    for word in SEARCH_WORD.findall(str(text or '').lower()):
+        tokens.append(word)
+        parts = SEARCH_WORD_PART.findall(word) if split else ()
+        if len(parts) > 1:
+            tokens.extend(parts)
+    return tokens
+
+def trigrams(text):
+    """Character trigrams of text, padded so the start of each word counts"""
+    text = f"  {text} "
+    return {text[i:i + 3] for i in range(len(text) - 2)}
+
+class CourseSearchIndex:
+    """Prefix and trigram index over the searchable course fields.
+
+    Every posting list is a bitmask (a Python int) over the courses in
+    catalogue order, like ConflictMatrix rows, so AND-ing query terms and
+    filters is a few big-int operations. Prefixes are resolved with a binary
+    search over the sorted vocabulary of each field. Ranking splits the
+    candidates into score classes instead of scoring courses one by one: a
+    term adds twice the field weight for an exact token match and the field
+    weight for a prefix match, best field first. Ties keep catalogue order.
+    When no course matches every term, courses sharing enough trigrams with
+    the query are returned instead (marked fuzzy).
+    """
+
+    def __init__(self, courses):
+        self.courses = courses
+        self.all = (1 << len(courses)) - 1
+        self.fields = []  # (weight, sorted vocabulary, masks aligned with it)
+        postings_by_field = [{} for _ in SEARCH_FIELDS]
+        filter_postings = {'program': {}, 'location': {}}
+        trigram_postings = {}
+        analysed = {}  # field value -> (tokens, trigrams); instructors and programs repeat a lot
+        # Positions are collected first and turned into masks once per token
+        for position, course in enumerate(courses):
+            grams = set()
+            for index, ((field, _), postings) in enumerate(zip(SEARCH_FIELDS, postings_by_field)):
+                value = course.get(field)
+                if value not in analysed:
+                    tokens = set(search_tokens(value))
+                    analysed[value] = (tokens, trigrams(' '.join(SEARCH_WORD.findall(str(value or '').lower()))))
+                tokens, value_grams = analysed[value]
+                for token in tokens:
+                    postings.setdefault(token, []).append(position)
+                if index < 3:
+                    grams |= value_grams
+            for field, values in filter_postings.items():
+                values.setdefault(course.get(field) or '', []).append(position)
+            for gram in grams:
+                trigram_postings.setdefault(gram, []).append(position)
+        size = len(courses)
+        for (_, weight), postings in zip(SEARCH_FIELDS, postings_by_field):
+            vocabulary = sorted(postings)
+            self.fields.append((weight, vocabulary, [mask_of_positions(postings[token], size) for token in vocabulary]))
+        self.filters = {field: {value: mask_of_positions(positions, size) for value, positions in values.items()}
+                        for field, values in filter_postings.items()}
+        self.trigrams = {gram: mask_of_positions(positions, size) for gram, positions in trigram_postings.items()}
+        self.prefix_cache = LRUCache(2048)
+
+    def term_levels(self, term):
+        """(score, mask) pairs for one query term, highest score first"""
+        cached = self.prefix_cache.get(term)
+        if cached is not None:
+            return cached
+        levels = []
+        for weight, vocabulary, masks in self.fields:
+            lo = bisect.bisect_left(vocabulary, term)
+            hi = bisect.bisect_left(vocabulary, term + '\x7f')
+            if lo == hi:
+                continue
+            exact = masks[lo] if vocabulary[lo] == term else 0
+            prefix = 0
+            for mask in masks[lo:hi]:
+                prefix |= mask
+            if exact:
+                levels.append((2 * weight, exact))
+            levels.append((weight, prefix))
+        levels.sort(key=lambda level: -level[0])
+        self.prefix_cache.put(term, levels)
+        return levels
+
+    def filter_mask(self, filters):
+        """Courses matching any of the values given for each filter field"""
+        mask = self.all
+        for field, values in filters.items():
+            if values:
+                field_mask = 0
+                for value in values:
+                    field_mask |= self.filters[field].get(value, 0)
+                mask &= field_mask
+        return mask
+
+    def search(self, query, filters=None, limit=10):
+        """Top `limit` courses for query; returns (results, total matches, fuzzy)"""
+        candidates = self.filter_mask(filters or {})
+        terms = list(dict.fromkeys(search_tokens(query, split=False)))
+        classes = {0: candidates}
+        for term in terms:
+            levels = self.term_levels(term)
+            split = {}
+            for score, mask in classes.items():
+                for level_score, level_mask in levels:
+                    hit = mask & level_mask
+                    if hit:
+                        split[score + level_score] = split.get(score + level_score, 0) | hit
+                        mask &= ~hit
+            classes = split
+        fuzzy = False
+        if terms and not classes:
+            classes = self.fuzzy_classes(' '.join(terms), candidates)
+            fuzzy = True
+        return self.top(classes, limit), sum(bin(mask).count('1') for mask in classes.values()), fuzzy
+
+    def fuzzy_classes(self, text, candidates, min_share=0.5):
+        """Score classes by the number of shared trigrams, keeping courses with at least min_share of them"""
+        grams = trigrams(text)
+        counts = {0: candidates}
+        for gram in grams:
+            mask = self.trigrams.get(gram, 0)
+            if not mask:
+                continue
+            shifted = {}
+            for count, members in counts.items():
+                hit = members & mask
+                if hit:
+                    shifted[count + 1] = shifted.get(count + 1, 0) | hit
+                if members & ~mask:
+                    shifted[count] = shifted.get(count, 0) | (members & ~mask)
+            counts = shifted
+        needed = max(1, math.ceil(len(grams) * min_share))
+        return {count: members for count, members in counts.items() if count >= needed}
+
+    def top(self, classes, limit):
+        results = []
+        for score in sorted(classes, reverse=True):
+            for position in iter_bits(classes[score]):
+                if len(results) == limit:
+                    return results
+                results.append((self.courses[position], score))
+        return results
+
+def search_schedules(matrix, wishlist, must_have=(), limit=5, time_budget=0.5):
+    """Largest conflict-free subsets of a wishlist, by branch-and-bound over conflict bitsets.
+
+    Every schedule holds all must-have courses and is maximal: no other
+    wishlist course fits without a conflict. Schedules are ranked by course
+    count. Raises ValueError when the must-have courses conflict with each
+    other. If the time budget runs out, the best schedules found so far are
+    returned with complete=False.
+    """
+    wishlist = list(dict.fromkeys(list(wishlist) + list(must_have)))
+    rows, position = matrix.rows, matrix.position
+    must_mask = matrix.mask_of(must_have)
+    for code in iter_bits(must_mask):
+        if rows[code] & must_mask:
+            clashes = matrix.ids_of(rows[code] & must_mask)
+            raise ValueError(f"must-have course {matrix.course_ids[code]} conflicts with {', '.join(clashes)}")
+
+    pool = matrix.mask_of(wishlist) & ~must_mask
+    blocked = 0
+    for code in iter_bits(must_mask):
+        blocked |= rows[code]
+    candidates = pool & ~blocked
+
+    deadline = time.monotonic() + time_budget
+    best = []  # (count, chosen mask), best first; ties keep discovery order
+    complete = True
+    nodes = 0
+    stack = [(must_mask, candidates)]
+    while stack:
+        chosen, cand = stack.pop()
+        nodes += 1
+        if nodes % 256 == 0 and time.monotonic() > deadline:
+            complete = False
+            break
+
+        # Courses that conflict with nothing left to decide can always be taken
+        free = 0
+        for code in iter_bits(cand):
+            if not rows[code] & cand:
+                free |= 1 << code
+        chosen |= free
+        cand &= ~free
+
+        full = len(best) == limit
+        if full and chosen.bit_count() + clique_cover_size(cand, rows) <= best[-1][0]:
+            continue
+        if not cand:
+            # Skip subsets that a left-out candidate could still be added to
+            if all(rows[code] & chosen for code in iter_bits(candidates & ~chosen)):
+                count = chosen.bit_count()
+                at = next((i for i, (c, _) in enumerate(best) if c < count), len(best))
+                best.insert(at, (count, chosen))
+                del best[limit:]
+            continue
+
+        # Branch on the course with the most conflicts among the undecided ones
+        code = max(iter_bits(cand), key=lambda c: (rows[c] & cand).bit_count())
+        bit = 1 << code
+        stack.append((chosen, cand & ~bit))
+        stack.append((chosen | bit, cand & ~bit & ~rows[code]))
+
+    unscheduled = [course_id for course_id in wishlist if course_id not in position]
+    schedules = []
+    for _, chosen in best:
+        courses = [course_id for course_id in wishlist
+                   if course_id not in position or chosen >> position[course_id] & 1]
+        schedules.append({
+            'courses': courses,
+            'count': len(courses),
+            'left_out': [course_id for course_id in wishlist if course_id not in courses]
+        })
+    return {
+        'schedules': schedules,
+        'complete': complete,
+        'nodes': nodes,
+        'without_sessions': unscheduled
+    }
+
+def clique_cover_size(mask, rows):
+    """Number of mutually conflicting groups a greedy pass splits mask into.
+
+    A schedule takes at most one course per group, so this bounds how many
+    courses of mask can still be added.
+    """
+    groups = 0
+    while mask:
+        low = mask & -mask
+        mask ^= low
+        # Grow the group with courses that conflict with every member so far
+        joinable = rows[low.bit_length() - 1] & mask
+        while joinable:
+            member = joinable & -joinable
+            mask ^= member
+            joinable &= rows[member.bit_length() - 1]
+        groups += 1
+    return groups
+
+def iter_bits(mask):
+    """Positions of the set bits of mask, lowest first"""
+    while mask:
+        low = mask & -mask
+        yield low.bit_length() - 1
+        mask ^= low
+
+def mask_of_positions(positions, size):
+    """Bitmask with the given bit positions set; size is an upper bound on them"""
+    buffer = bytearray((size + 7) // 8)
+    for position in positions:
+        buffer[position >> 3] |= 1 << (position & 7)
+    return int.from_bytes(buffer, 'little')
+
+
+# Heap cost of the Python objects behind one course (its record, index entries and
+# search postings) and one conflicting pair, measured on generated catalogues
+COURSE_RECORD_BYTES = 4096
+CONFLICT_PAIR_BYTES = 256
+
+def array_bytes(obj):
+    """(heap, mapped) bytes of the NumPy arrays among obj's attributes"""
+    heap, mapped = 0, 0
+    for value in vars(obj).values():
+        if isinstance(value, np.ndarray):
+            base = value
+            while isinstance(base.base, np.ndarray):
+                base = base.base
+            # Arrays read from the snapshot end in its mapping, whose pages belong to the page cache
+            if base.base is None:
+                heap += value.nbytes
+            else:
+                mapped += value.nbytes
+    return heap, mapped
+
+class CourseIndex:
+    """Lookup structures built once from the loaded course data.
+
+    The request path reads course lists, program filters and per-course
+    sessions from here instead of scanning the DataFrames on every call.
+    """
+
+    def __init__(self, course_records, session_columns, version='empty', revised=None):
+        self.version = version
+        # When the course data last changed (UTC), the DTSTAMP of exported events
+        self.revised = revised or datetime.utcnow().replace(microsecond=0)
+        self.course_records = course_records
+        self.session_columns = session_columns
+        self.course_by_id = {}
+        self.record_positions = {}
+        for pos, course in enumerate(self.course_records):
+            self.course_by_id.setdefault(course['course_id'], course)
+            self.record_positions.setdefault(course['course_id'], []).append(pos)
+
+        self.sessions = self.build_sessions(session_columns)
+        self.first_sessions = {
+            course_id: self.first_session_of(sessions)
+            for course_id, sessions in self.sessions.items()
+        }
+        self.sorted_courses = self.build_sorted_courses()
+
+        # Per-program lists keep the first-session order of sorted_courses
+        self.courses_by_program = {}
+        for course in self.sorted_courses:
+            self.courses_by_program.setdefault(course['program'], []).append(course)
+        self.programs = sorted(self.courses_by_program)
+
+        # Filled lazily: course_id -> (VEVENT text, digest)
+        self.ics_blocks = {}
+
+    @functools.cached_property
+    def courses_info_df(self):
+        """The course records as a DataFrame (pandas is only imported on first use)"""
+        import pandas as pd
+        columns = list(self.course_records[0]) if self.course_records else COURSE_COLUMNS
+        return pd.DataFrame(self.course_records, columns=columns)
+
+    @functools.cached_property
+    def course_sessions_df(self):
+        """All sessions as a DataFrame, with start/end datetimes (pandas imported on first use)"""
+        import pandas as pd
+        columns = self.session_columns
+        rows = slice(None)
+        return pd.DataFrame({
+            'course_id': [columns.course_ids[code] for code in columns.course.tolist()],
+            'date': columns.lookup(columns.date, rows),
+            'start_time': columns.lookup(columns.start_time, rows),
+            'end_time': columns.lookup(columns.end_time, rows),
+            'start_datetime': columns.start.astype('datetime64[m]').astype('datetime64[ns]'),
+            'end_datetime': columns.end.astype('datetime64[m]').astype('datetime64[ns]')
+        })
+
+    @staticmethod
+    def build_sessions(session_columns):
+        """Group session rows by course into CourseSessions objects"""
+        if not len(session_columns):
+            return {}
+        codes = session_columns.course
+        # Stable sort keeps each course's sessions in CSV order
+        order = np.argsort(codes, kind='stable')
+        counts = np.bincount(codes, minlength=len(session_columns.course_ids))
+        bounds = np.cumsum(counts)[:-1]
+
+        sessions = {}
+        for course_id, rows in zip(session_columns.course_ids, np.split(order, bounds)):
+            if len(rows):
+                sessions[course_id] = CourseSessions(session_columns, rows)
+        return sessions
+
+    @staticmethod
+    def first_session_of(sessions):
+        """Return the earliest session (first one in CSV order on ties)"""
+        if not len(sessions):
+            return None
+        i = int(np.argmin(sessions.start))
+        return {
+            'date': sessions.dates[i],
+            'start_time': sessions.start_times[i],
+            'datetime': EPOCH + timedelta(minutes=int(sessions.start[i]))
+        }
+
+    def build_sorted_courses(self):
+        """Attach first session info to every course and sort by it"""
+        courses = []
+        for record in self.course_records:
+            course = dict(record)
+            first_session = self.first_sessions.get(course['course_id'])
+            course['first_session_date'] = first_session['date'] if first_session else '9999-12-31'
+            course['first_session_time'] = first_session['start_time'] if first_session else '23:59'
+            course['first_session_datetime'] = first_session['datetime'] if first_session else None
+            courses.append(course)
+
+        courses.sort(key=lambda x: x['first_session_datetime'] if x['first_session_datetime'] else datetime.max)
+        return courses
+
+    def get_courses_by_ids(self, course_ids):
+        """Return the course records for the given IDs in catalogue order"""
+        wanted = sorted({pos for course_id in set(course_ids) for pos in self.record_positions.get(course_id, ())})
+        return [self.course_records[pos] for pos in wanted]
+
+    @functools.cached_property
+    def conflict_matrix(self):
+        """All-pairs conflicts, built on first use"""
+        return ConflictMatrix(self.session_columns)
+
+    @functools.cached_property
+    def room_occupancy(self):
+        """Per-location minute timelines of all sessions, built on first use"""
+        start, _, end = app.config["ROOM_HOURS"].partition('-')
+        locations = {course_id: course.get('location', '') for course_id, course in self.course_by_id.items()}
+        return RoomOccupancy(self.session_columns, locations, (int(start), int(end)))
+
+    @functools.cached_property
+    def search_index(self):
+        """Course search index, built on first use"""
+        return CourseSearchIndex(self.sorted_courses)
+
+    def memory_usage(self):
+        """Array bytes on the heap and mapped from the snapshot, plus a fixed cost per record.
+
+        heap_bytes is the NumPy arrays of the sessions and of the indexes built
+        so far, plus COURSE_RECORD_BYTES per course and CONFLICT_PAIR_BYTES per
+        conflicting course pair for the Python objects, a rate rather than a
+        measurement, so the same data always reports the same size.
+        """
+        built = [self.__dict__[name] for name in ('conflict_matrix', 'room_occupancy') if name in self.__dict__]
+        heap, mapped = 0, 0
+        for part in [self.session_columns, *built]:
+            part_heap, part_mapped = array_bytes(part)
+            heap += part_heap
+            mapped += part_mapped
+        pairs = len(self.__dict__['conflict_matrix'].pairs) if 'conflict_matrix' in self.__dict__ else 0
+        heap += len(self.course_records) * COURSE_RECORD_BYTES + pairs * CONFLICT_PAIR_BYTES
+        return {'heap_bytes': heap, 'mapped_bytes': mapped, 'courses': len(self.course_records),
+                'sessions': len(self.session_columns), 'conflict_pairs': pairs}
+
+    def find_overlapping_courses(self, selected_courses, window=None):
+        """Find courses that have time conflicts, optionally only those starting in window"""
+        course_ids = [course['course_id'] for course in selected_courses]
+        if len(set(course_ids)) != len(course_ids):
+            # A course listed twice conflicts with itself, which the matrix does not record
+            overlaps = self.scan_overlapping_courses(selected_courses)
+            if window is not None:
+                overlaps = [dict(o, conflicts=[c for c in o['conflicts']
+                                               if window[0] <= parse_date_days(c['date']) * 1440 < window[1]])
+                            for o in overlaps]
+                overlaps = [o for o in overlaps if o['conflicts']]
+            return overlaps
+
+        matrix = self.conflict_matrix
+        codes = [matrix.position.get(course_id) for course_id in course_ids]
+        mask = matrix.mask_of(course_ids)
+        overlaps = []
+        for g1, code1 in enumerate(codes):
+            if code1 is None or not matrix.rows[code1] & mask:
+                continue
+            for g2 in range(g1 + 1, len(codes)):
+                code2 = codes[g2]
+                if code2 is not None and matrix.rows[code1] >> code2 & 1:
+                    conflicts = matrix.conflict_details(course_ids[g1], course_ids[g2], window)
+                    if conflicts:
+                        overlaps.append({
+                            'course1': selected_courses[g1],
+                            'course2': selected_courses[g2],
+                            'conflict_type': 'time_overlap',
+                            'conflicts': conflicts
+                        })
+        return overlaps
+
+    def has_overlaps(self, selection, window=None):
+        """Whether the calendar of a sorted, de-duplicated selection has overlaps, without building it"""
+        if len(selection) <= 1:
+            return False
+        course_ids = [course['course_id'] for course in self.get_courses_by_ids(selection)]
+        if len(set(course_ids)) != len(course_ids):
+            return bool(self.find_overlapping_courses(self.get_courses_by_ids(selection), window))
+        matrix = self.conflict_matrix
+        if window is None:
+            return matrix.has_conflicts(course_ids)
+        return any(matrix.conflict_details(a, b, window)
+                   for a, b in itertools.combinations(course_ids, 2) if matrix.conflicts(a, b))
+
+    def calendar_delta(self, selection, added, removed, window=None):
+        """Changes to a selection's calendar when courses are added and removed.
+
+        Only the changed courses are looked at: their events, and their rows
+        of the conflict matrix ANDed with the selection. Overlaps are reported
+        as in find_overlapping_courses(), course1 being the one listed first
+        in courses_info.csv; removed overlaps as [course1_id, course2_id].
+        """
+        known = lambda course_id: course_id in self.course_by_id
+        first_position = lambda course_id: self.record_positions[course_id][0]
+        selection = {c for c in selection if known(c)}
+        added = sorted({c for c in added if known(c)} - selection, key=first_position)
+        removed = sorted(({c for c in removed if known(c)} & selection) - set(added), key=first_position)
+        remaining = selection - set(removed)
+
+        matrix = self.conflict_matrix
+
+        def pairs_with(course_id, others):
+            code = matrix.position.get(course_id)
+            if code is None:
+                return []
+            others = matrix.ids_of(matrix.rows[code] & matrix.mask_of(others))
+            return sorted((tuple(sorted((course_id, other), key=first_position)) for other in others),
+                          key=lambda pair: (first_position(pair[0]), first_position(pair[1])))
+
+        add_overlaps, seen = [], set()
+        for course_id in added:
+            # Against the courses kept and the other added ones, each pair once
+            for course1, course2 in pairs_with(course_id, remaining | set(added)):
+                if (course1, course2) in seen:
+                    continue
+                seen.add((course1, course2))
+                conflicts = matrix.conflict_details(course1, course2, window)
+                if conflicts:
+                    add_overlaps.append({
+                        'course1': self.course_by_id[course1],
+                        'course2': self.course_by_id[course2],
+                        'conflict_type': 'time_overlap',
+                        'conflicts': conflicts
+                    })
+
+        remove_overlaps = []
+        for course_id in removed:
+            for pair in pairs_with(course_id, selection):
+                if list(pair) not in remove_overlaps:
+                    remove_overlaps.append(list(pair))
+
+        return {
+            'added': added,
+            'removed': removed,
+            'add_events': self.get_calendar_events(added, window),
+            'add_overlaps': add_overlaps,
+            'remove_overlaps': remove_overlaps
+        }
+
+    def scan_overlapping_courses(self, selected_courses):
+        """Find conflicts by sweeping the sessions of the selected courses"""
+        groups, rows, by_group = [], [], {}
+        for pos, course in enumerate(selected_courses):
+            course_sessions = self.sessions.get(course['course_id'])
+            if course_sessions is None or not len(course_sessions):
+                continue
+            groups.append(np.full(len(course_sessions), pos))
+            rows.append(np.arange(len(course_sessions)))
+            by_group[pos] = course_sessions
+        if len(by_group) < 2:
+            return []
+
+        sessions = list(by_group.values())
+        group = np.concatenate(groups)
+        row = np.concatenate(rows)
+        left, right = sweep_overlaps(
+            np.concatenate([s.start for s in sessions]),
+            np.concatenate([s.end for s in sessions]),
+            np.concatenate([s.day for s in sessions]),
+            group
+        )
+        # Report each pair as (earlier selected course, later selected course)
+        swap = group[left] > group[right]
+        left, right = np.where(swap, right, left), np.where(swap, left, right)
+        order = np.lexsort((row[right], row[left], group[right], group[left]))
+        left, right = left[order], right[order]
+
+        overlaps = []
+        current_pair = None
+        for g1, g2, r1, r2 in zip(group[left].tolist(), group[right].tolist(), row[left].tolist(), row[right].tolist()):
+            if (g1, g2) != current_pair:
+                current_pair = (g1, g2)
+                overlaps.append({
+                    'course1': selected_courses[g1],
+                    'course2': selected_courses[g2],
+                    'conflict_type': 'time_overlap',
+                    'conflicts': []
+                })
+            sessions1, sessions2 = by_group[g1], by_group[g2]
+            overlaps[-1]['conflicts'].append({
+                'date': sessions1.dates[r1],
+                'session1': {
+                    'start_time': sessions1.start_times[r1],
+                    'end_time': sessions1.end_times[r1]
+                },
+                'session2': {
+                    'start_time': sessions2.start_times[r2],
+                    'end_time': sessions2.end_times[r2]
+                }
+            })
+        return overlaps
+
+    def get_ics_events(self, course_id):
+        """Return the cached VEVENT block and its digest for a course"""
+        block = self.ics_blocks.get(course_id)
+        if block is None:
+            course = self.course_by_id[course_id]
+            sessions = self.sessions.get(course_id)
+            text = render_vevents(course, sessions, self.revised) if sessions is not None else ''
+            block = self.ics_blocks[course_id] = (text, hashlib.sha1(text.encode('utf-8')).hexdigest())
+        return block
+
+    def get_calendar_events(self, selected_course_ids, window=None):
+        """Convert selected courses to calendar events format.
+
+        window is an optional (start, end) range in minutes since epoch; only
+        sessions starting inside it are returned.
+        """
+        selected = [self.sessions[course_id] for course_id in set(selected_course_ids)
+                    if course_id in self.course_by_id and course_id in self.sessions]
+        if window is not None:
+            rows = [sessions.rows_between(*window) for sessions in selected]
+        else:
+            rows = [sessions.rows for sessions in selected]
+        rows = [r for r in rows if len(r)]
+        if not rows:
+            return []
+        # Events are listed in course_sessions.csv order
+        rows = np.sort(np.concatenate(rows))
+        columns = self.session_columns
+        codes = columns.course[rows].tolist()
+        dates = columns.lookup(columns.date, rows)
+        start_times = columns.lookup(columns.start_time, rows)
+        end_times = columns.lookup(columns.end_time, rows)
+        weekdays = ((columns.start[rows] // 1440 + 3) % 7).tolist()  # 1970-01-01 was a Thursday
+
+        events = []
+        for code, date, start_time, end_time, weekday in zip(codes, dates, start_times, end_times, weekdays):
+            course = self.course_by_id[columns.course_ids[code]]
+            events.append({
+                'id': course['course_id'],
+                'title': f"{course['course_id']}: {course['course_name']}",
+                'instructor': course['instructor'],
+                'location': course['location'],
+                'start_time': start_time,
+                'end_time': end_time,
+                'date': date,  # Keep original date string to avoid timezone issues
+                'program': course['program'],
+                'day': WEEKDAYS[weekday]  # Add the day of week
+            })
+        return events
+
+
+ICS_HEADER = (
+    'BEGIN:VCALENDAR\r\n'
+    'VERSION:2.0\r\n'
+    'PRODID:-//MBA Course Schedule Manager//EN\r\n'
+    'CALSCALE:GREGORIAN\r\n'
+    'X-WR-TIMEZONE:Asia/Shanghai\r\n'
+    # Session times are local to Asia/Shanghai, which has been UTC+8 without DST since 1991
+    'BEGIN:VTIMEZONE\r\n'
+    'TZID:Asia/Shanghai\r\n'
+    'BEGIN:STANDARD\r\n'
+    'DTSTART:19910915T020000\r\n'
+    'TZOFFSETFROM:+0800\r\n'
+    'TZOFFSETTO:+0800\r\n'
+    'TZNAME:CST\r\n'
+    'END:STANDARD\r\n'
+    'END:VTIMEZONE\r\n'
+)
+ICS_FOOTER = 'END:VCALENDAR\r\n'
+
+def ics_escape(value):
+    """Escape a TEXT property value (RFC 5545 section 3.3.11)"""
+    return (str(value).replace('\\', '\\\\').replace(';', '\\;')
+            .replace(',', '\\,').replace('\n', '\\n'))
+
+def ics_line(line):
+    """Fold a content line at 75 octets and terminate it with CRLF"""
+    if len(line.encode('utf-8')) <= 75:
+        return line + '\r\n'
+    parts, current, size = [], '', 0
+    for char in line:
+        width = len(char.encode('utf-8'))
+        if size + width > 75:
+            parts.append(current)
+            current, size = ' ', 1  # continuation lines start with a space
+        current += char
+        size += width
+    parts.append(current)
+    return '\r\n'.join(parts) + '\r\n'
+
+def render_vevents(course, sessions, revised):
+    """Render one VEVENT per session of a course; revised (UTC) is their DTSTAMP"""
+    course_id = course['course_id']
+    dtstamp = revised.strftime('%Y%m%dT%H%M%SZ')
+    summary = f"{course_id}: {course['course_name']}"
+    description = (f"Course ID: {course_id}\nInstructor: {course['instructor']}\n"
+                   f"Location: {course['location']}\nProgram: {course['program']}")
+    lines = []
+    for start, end in zip(sessions.start.tolist(), sessions.end.tolist()):
+        dtstart = (EPOCH + timedelta(minutes=start)).strftime('%Y%m%dT%H%M00')
+        dtend = (EPOCH + timedelta(minutes=end)).strftime('%Y%m%dT%H%M00')
+        lines += [
+            'BEGIN:VEVENT',
+            f"UID:{ics_escape(course_id)}-{dtstart}@mba-course-schedule",
+            f"DTSTAMP:{dtstamp}",
+            f"SUMMARY:{ics_escape(summary)}",
+            f"DESCRIPTION:{ics_escape(description)}",
+            f"DTSTART;TZID=Asia/Shanghai:{dtstart}",
+            f"DTEND;TZID=Asia/Shanghai:{dtend}",
+            f"LOCATION:{ics_escape(course['location'])}",
+            'END:VEVENT'
+        ]
+    return ''.join(ics_line(line) for line in lines)
+
+
+def signature_time(signature):
+    """Latest modification time (naive UTC) in a file signature, None without files"""
+    mtimes = [s[0] for s in signature if s]
+    return datetime.utcfromtimestamp(max(mtimes) // 10**9) if mtimes else None
+
+
 class CourseScheduler:
-    def __init__(self, courses_info='courses_info.csv', course_sessions='course_sessions.csv'):
+    """Serves course data from an immutable CourseIndex that can be swapped on reload.
+
+    Every public method reads self.index once, so a request that overlaps a
+    reload sees either the old or the new data, never a mix of both.
+    """
+
+    def __init__(self, courses_info='courses_info.csv', course_sessions='course_sessions.csv',
+                 calendar_cache_size=1024, reload_trigger=None, snapshot=None):
         self.courses_info_file = courses_info
         self.course_sessions_file = course_sessions
-        self.courses_info_df = self.load_courses_info()
-        self.course_sessions_df = self.load_course_sessions()
+        self.snapshot = snapshot
+        self.reload_trigger = reload_trigger
+        self.calendar_cache = LRUCache(calendar_cache_size)
+        self.reload_count = 0
+        self.last_reload = None
+        self.last_reload_error = None
+        self._reload_lock = threading.Lock()
+        self._watcher_pid = None
+        self._wake = threading.Event()
+        self._force_reload = False
+        self._pending_signature = None
+        self._signature = self.file_signature()
+        self.index = self.build_index()
+    
+    @property
+    def data_version(self):
+        """Content hash of the course data currently being served"""
+        return self.index.version
+    
+    @property
+    def courses_info_df(self):
+        return self.index.courses_info_df
+    
+    @property
+    def course_sessions_df(self):
+        return self.index.course_sessions_df
+    
+    def compute_data_version(self):
+        """Hash the raw bytes of both CSV files"""
+        digest = hashlib.sha1()
+        for path in (self.courses_info_file, self.course_sessions_file):
+            try:
+                with open(path, 'rb') as f:
+                    digest.update(f.read())
+            except OSError:
+                digest.update(b'missing')
+            digest.update(b'\0')
+        return digest.hexdigest()[:16]
+    
+    def build_index(self, strict=False):
+        """Build a CourseIndex from the snapshot when it is fresh, else from the CSV files"""
+        signature = self.file_signature()[:2]
+        index = self.load_snapshot(signature)
+        if index is not None:
+            return index
+        version = self.compute_data_version()
+        index = CourseIndex(self.load_courses_info(strict), self.load_course_sessions(strict), version,
+                            signature_time(signature))
+        if self.snapshot and None not in signature:
+            try:
+                self.write_snapshot(index, signature)
+            except OSError as e:
+                print(f"Warning: could not write course data snapshot: {e}")
+        return index
     
-    def load_courses_info(self):
+    def load_snapshot(self, signature):
+        """Return an index mapped from the snapshot file, or None when it is missing or stale.
+
+        The snapshot is fresh when the CSVs still have the (mtime, size) it was
+        compiled from, or failing that, the same content hash. Without any CSV
+        files the snapshot is served as is.
+        """
+        if not self.snapshot or not os.path.exists(self.snapshot):
+            return None
+        try:
+            header, columns = read_snapshot(self.snapshot)
+        except Exception as e:
+            print(f"Warning: ignoring unreadable snapshot {self.snapshot}: {e}")
+            return None
+        csv_missing = signature == (None, None)
+        if not csv_missing and [list(s) if s else None for s in signature] != header['signature']:
+            if header['version'] != self.compute_data_version():
+                return None
+        return CourseIndex(header['courses'], columns, header['version'], signature_time(header['signature']))
+    
+    def write_snapshot(self, index=None, signature=None):
+        """Compile the course data into the snapshot file"""
+        index = index or self.index
+        signature = signature or self.file_signature()[:2]
+        os.makedirs(os.path.dirname(os.path.abspath(self.snapshot)), exist_ok=True)
+        write_snapshot(self.snapshot, index, [list(s) if s else None for s in signature])
+    
+    def load_courses_info(self, strict=False):
         """Load basic course information from CSV file"""
         try:
             if not os.path.exists(self.courses_info_file):
-                print(f"Warning: {self.courses_info_file} not found, creating empty DataFrame")
-                return pd.DataFrame(columns=['course_id', 'course_name', 'instructor', 'location', 'program'])
-            return pd.read_csv(self.courses_info_file)
+                if strict:
+                    raise FileNotFoundError(self.courses_info_file)
+                print(f"Warning: {self.courses_info_file} not found, using empty course list")
+                return []
+            return read_courses_csv(self.courses_info_file)
         except Exception as e:
+            if strict:
+                raise
             print(f"Error loading course info: {e}")
-            return pd.DataFrame(columns=['course_id', 'course_name', 'instructor', 'location', 'program'])
+            return []
+    
+    def load_course_sessions(self, strict=False):
+        """Load course sessions from CSV file"""
+        try:
+            if not os.path.exists(self.course_sessions_file):
+                if strict:
+                    raise FileNotFoundError(self.course_sessions_file)
+                print(f"Warning: {self.course_sessions_file} not found, using empty sessions")
+                return SessionColumns.empty()
+            return read_sessions_csv(self.course_sessions_file)
+        except Exception as e:
+            if strict:
+                raise
+            print(f"Error loading course sessions: {e}")
+            return SessionColumns.empty()
+    
+    def file_signature(self):
+        """(mtime, size) of the CSV files and the reload trigger file"""
+        signature = []
+        for path in (self.courses_info_file, self.course_sessions_file, self.reload_trigger):
+            try:
+                stat = os.stat(path) if path else None
+                signature.append((stat.st_mtime_ns, stat.st_size) if stat else None)
+            except OSError:
+                signature.append(None)
+        return tuple(signature)
     
-    def load_course_sessions(self):
-        """Load course sessions from CSV file"""
+    def reload(self):
+        """Rebuild the course data and swap it in atomically.
+
+        Loading happens before the swap, so requests keep using the old index
+        until the new one is complete. Raises if a CSV cannot be parsed, leaving
+        the current data in place. Returns True when the data version changed.
+        """
+        with self._reload_lock:
+            signature = self.file_signature()
+            index = self.build_index(strict=True)
+            self._signature = signature
+            if index.version == self.index.version:
+                return False
+            self.index = index
+            self.calendar_cache.clear()
+            self.reload_count += 1
+            self.last_reload = datetime.utcnow()
+            print(f"Course data reloaded, version {index.version}")
+            return True
+    
+    def check_for_changes(self):
+        """Reload when the files changed and have stayed unchanged for one poll"""
+        signature = self.file_signature()
+        if not self._force_reload:
+            if signature == self._signature:
+                self._pending_signature = None
+                return False
+            if signature != self._pending_signature:
+                # Let a CSV that is still being written settle first
+                self._pending_signature = signature
+                return False
+        self._force_reload = False
+        self._pending_signature = None
         try:
-            if not os.path.exists(self.course_sessions_file):
-                print(f"Warning: {self.course_sessions_file} not found, creating empty DataFrame")
-                return pd.DataFrame(columns=['course_id', 'date', 'start_time', 'end_time'])
-            df = pd.read_csv(self.course_sessions_file)
-            df['start_datetime'] = pd.to_datetime(df['date'] + ' ' + df['start_time'])
-            df['end_datetime'] = pd.to_datetime(df['date'] + ' ' + df['end_time'])
-            return df
+            changed = self.reload()
+            self.last_reload_error = None
+            return changed
         except Exception as e:
-            print(f"Error loading course sessions: {e}")
-            return pd.DataFrame(columns=['course_id', 'date', 'start_time', 'end_time', 'start_datetime', 'end_datetime'])
+            # Keep serving the old data; retry once the files change again
+            print(f"Error reloading course data: {e}")
+            self.last_reload_error = str(e)
+            self._signature = signature
+            return False
+    
+    def start_watcher(self, interval):
+        """Poll the data files from a background thread in this process"""
+        if interval <= 0 or self._watcher_pid == os.getpid():
+            return
+        self._watcher_pid = os.getpid()
+        thread = threading.Thread(target=self._watch, args=(interval,), name='course-data-watcher', daemon=True)
+        thread.start()
+    
+    def _watch(self, interval):
+        while True:
+            self._wake.wait(interval)
+            self._wake.clear()
+            self.check_for_changes()
+    
+    def request_reload(self):
+        """Ask every worker to reload: touch the trigger file and wake this worker's watcher"""
+        if self.reload_trigger:
+            os.makedirs(os.path.dirname(self.reload_trigger), exist_ok=True)
+            with open(self.reload_trigger, 'w') as f:
+                f.write(datetime.utcnow().isoformat())
+        self._force_reload = True
+        if self._watcher_pid == os.getpid():
+            self._wake.set()
+        else:
+            threading.Thread(target=self.check_for_changes, name='course-data-reload', daemon=True).start()
+    
+    def reload_status(self):
+        return {
+            'data_version': self.data_version,
+            'reload_count': self.reload_count,
+            'last_reload': self.last_reload.isoformat() if self.last_reload else None,
+            'last_error': self.last_reload_error,
+            'watching': self._watcher_pid == os.getpid()
+        }
     
     def get_all_courses(self):
         """Return all courses as a list of dictionaries with first session info"""
-        courses = self.courses_info_df.to_dict('records')
-        
-        # Add first session information to each course for sorting
-        for course in courses:
-            first_session = self.get_first_session(course['course_id'])
-            course['first_session_date'] = first_session['date'] if first_session else '9999-12-31'
-            course['first_session_time'] = first_session['start_time'] if first_session else '23:59'
-            course['first_session_datetime'] = first_session['datetime'] if first_session else None
-        
-        # Sort courses by first session datetime
-        courses.sort(key=lambda x: x['first_session_datetime'] if x['first_session_datetime'] else datetime.max)
-        
-        return courses
+        # Sorted by first session datetime when the index is built
+        return list(self.index.sorted_courses)
     
     def get_first_session(self, course_id):
         """Get the first session for a given course"""
-        course_sessions = self.course_sessions_df[self.course_sessions_df['course_id'] == course_id]
-        if course_sessions.empty:
-            return None
-        
-        # Sort by date and time to get the earliest session
-        first_session = course_sessions.loc[course_sessions['start_datetime'].idxmin()]
-        return {
-            'date': first_session['date'],
-            'start_time': first_session['start_time'],
-            'datetime': first_session['start_datetime']
-        }
+        return self.index.first_sessions.get(course_id)
     
     def get_courses_by_program(self, program):
         """Filter courses by program and sort by first session"""
         if program == 'All':
             return self.get_all_courses()
-        
-        # Get all courses first (which includes sorting)
-        all_courses = self.get_all_courses()
-        
-        # Filter by program while maintaining the sort order
-        filtered_courses = [course for course in all_courses if course['program'] == program]
-        
-        return filtered_courses
+        return list(self.index.courses_by_program.get(program, []))
     
     def get_programs(self):
         """Get all unique programs"""
-        try:
-            if self.courses_info_df.empty:
-                return ['Core Courses', 'Elective Courses', 'Other Events']  # Default programs
-            return sorted(self.courses_info_df['program'].unique().tolist())
-        except Exception as e:
-            print(f"Error getting programs: {e}")
-            return ['Core Courses', 'Elective Courses', 'Other Events']
+        programs = self.index.programs
+        if not programs:
+            return ['Core Courses', 'Elective Courses', 'Other Events']  # Default programs
+        return list(programs)
+    
+    def get_courses_by_ids(self, course_ids):
+        """Return the course records for the given IDs in catalogue order"""
+        return self.index.get_courses_by_ids(course_ids)
     
     def find_overlapping_courses(self, selected_courses):
         """Find courses that have time conflicts"""
+        return self.index.find_overlapping_courses(selected_courses)
+    
+    def get_conflict_matrix(self):
+        """All-pairs conflict matrix for the current data version"""
+        return self.index.conflict_matrix
+
+    def has_overlaps(self, course_ids, window=None):
+        """Whether get_calendar() of these courses would report overlaps, from the conflict matrix"""
+        return self.index.has_overlaps(tuple(sorted(set(course_ids))), window)
+    
+    def get_room_occupancy(self):
+        """Room occupancy and double bookings for the current data version"""
+        return self.index.room_occupancy
+
+    def search_courses(self, query, programs=(), locations=(), limit=10):
+        """Best matches for query as (course, score) pairs, the match count and whether they are fuzzy"""
+        return self.index.search_index.search(query, {'program': programs, 'location': locations}, limit)
+
+    def get_course_conflicts(self, course_id):
+        """Courses conflicting with course_id, with the overlapping sessions of each"""
+        index = self.index
+        matrix = index.conflict_matrix
+        return [{
+            'course': index.course_by_id.get(other, {'course_id': other}),
+            'conflicts': matrix.conflict_details(course_id, other)
+        } for other in matrix.conflicts_of(course_id)]
+    
+    def find_schedules(self, wishlist, must_have=(), limit=5, time_budget=0.5):
+        """Largest conflict-free subsets of a wishlist; see search_schedules()"""
+        index = self.index
+        matrix = index.conflict_matrix
+        known = lambda course_id: course_id in index.course_by_id or course_id in matrix.position
+        result = search_schedules(matrix, [c for c in wishlist if known(c)],
+                                  [c for c in must_have if known(c)], limit, time_budget)
+        result['unknown'] = [c for c in dict.fromkeys(list(wishlist) + list(must_have)) if not known(c)]
+        return result
+    
+    def get_calendar(self, course_ids, window=None):
+        """Return {'events', 'overlaps'} for a selection, memoized per data version.
+
+        window is an optional (start, end) range in minutes since epoch that
+        limits both the events and the overlap check to sessions starting in it.
+        The result is shared between callers and must be treated as read-only.
+        """
+        index = self.index
+        selection = tuple(sorted(set(course_ids)))
+        key = (index.version, selection, window)
+        calendar = self.calendar_cache.get(key)
+        if calendar is None:
+            calendar = self.build_calendar(index, selection, window)
+            self.calendar_cache.put(key, calendar)
+        return calendar
+    
+    def get_calendar_delta(self, selection, version, added=(), removed=(), window=None):
+        """Calendar changes for adding/removing courses to a selection the client holds.
+
+        version must be the selection_version() of selection under the current
+        data; otherwise returns None and the client has to fetch the full
+        calendar again. The result carries the version of the new selection.
+        """
+        index = self.index
+        selection = sorted(set(selection))
+        if version != selection_version(index.version, selection):
+            return None
+        delta = index.calendar_delta(selection, added, removed, window)
+        new_selection = sorted((set(selection) - set(delta['removed'])) | set(delta['added']))
+        delta['version'] = selection_version(index.version, new_selection)
+        return delta
+    
+    @staticmethod
+    def build_calendar(index, selection, window=None):
+        """Events and overlaps of a sorted, de-duplicated selection"""
         overlaps = []
-        
-        for i, course1 in enumerate(selected_courses):
-            sessions1 = self.course_sessions_df[self.course_sessions_df['course_id'] == course1['course_id']]
-            for j, course2 in enumerate(selected_courses[i+1:], i+1):
-                sessions2 = self.course_sessions_df[self.course_sessions_df['course_id'] == course2['course_id']]
-                conflict_details = self.sessions_overlap(sessions1, sessions2)
-                if conflict_details:
-                    overlaps.append({
-                        'course1': course1,
-                        'course2': course2,
-                        'conflict_type': 'time_overlap',
-                        'conflicts': conflict_details
-                    })
-        
-        return overlaps
+        if len(selection) > 1:
+            with profile_span('overlap_detection'):
+                overlaps = index.find_overlapping_courses(index.get_courses_by_ids(selection), window)
+        with profile_span('data_lookup'):
+            events = index.get_calendar_events(selection, window)
+        return {'events': events, 'overlaps': overlaps}
     
-    def sessions_overlap(self, sessions1, sessions2):
-        """Check if any sessions between two courses overlap and return conflict details"""
-        conflicts = []
-        for _, session1 in sessions1.iterrows():
-            for _, session2 in sessions2.iterrows():
-                if session1['date'] == session2['date']:
-                    start1 = parser.parse(session1['start_time']).time()
-                    end1 = parser.parse(session1['end_time']).time()
-                    start2 = parser.parse(session2['start_time']).time()
-                    end2 = parser.parse(session2['end_time']).time()
-                    if start1 < end2 and start2 < end1:
-                        conflicts.append({
-                            'date': session1['date'],
-                            'session1': {
-                                'start_time': session1['start_time'],
-                                'end_time': session1['end_time']
-                            },
-                            'session2': {
-                                'start_time': session2['start_time'],
-                                'end_time': session2['end_time']
-                            }
-                        })
-        return conflicts if conflicts else False
+    def iter_calendars(self, selections, render=None, workers=1, window=64):
+        """Yield render(calendar) for every selection, in order.
+
+        All selections are answered from the index current at call time. Each
+        distinct selection is computed and rendered once, on a thread pool
+        when workers > 1 with at most `window` selections ahead of the
+        output, and its result is only kept until its last duplicate is
+        yielded. Calendars are not added to the per-selection cache, so a
+        large batch does not evict the entries serving interactive users.
+        """
+        index = self.index
+        render = render or (lambda calendar: calendar)
+        keys = [tuple(sorted(set(selection))) for selection in selections]
+
+        def compute(key):
+            return render(self.build_calendar(index, key))
+
+        def generate():
+            remaining = Counter(keys)
+            distinct = list(remaining)
+            results, futures, submitted = {}, {}, 0
+            executor = ThreadPoolExecutor(workers, thread_name_prefix='calendar-batch') if workers > 1 else None
+            try:
+                for key in keys:
+                    if key not in results:
+                        if executor is None:
+                            results[key] = compute(key)
+                        else:
+                            while submitted < len(distinct) and (key not in futures or len(futures) < window):
+                                futures[distinct[submitted]] = executor.submit(compute, distinct[submitted])
+                                submitted += 1
+                            results[key] = futures.pop(key).result()
+                    yield results[key]
+                    remaining[key] -= 1
+                    if not remaining[key]:
+                        del results[key]
+            finally:
+                if executor is not None:
+                    executor.shutdown(wait=False, cancel_futures=True)
+
+        return generate()
+    
+    def get_ics_events(self, course_id):
+        """Return the cached VEVENT block and its digest for a course"""
+        return self.index.get_ics_events(course_id)
     
-    def get_calendar_events(self, selected_course_ids):
+    def get_calendar_events(self, selected_course_ids, window=None):
         """Convert selected courses to calendar events format"""
-        events = []
-        selected_courses = self.courses_info_df[self.courses_info_df['course_id'].isin(selected_course_ids)]
-        selected_sessions = self.course_sessions_df[self.course_sessions_df['course_id'].isin(selected_course_ids)]
-        
-        for _, session in selected_sessions.iterrows():
-            course = selected_courses[selected_courses['course_id'] == session['course_id']].iloc[0]
-            # Parse date without timezone conversion to avoid day shifts
-            date_obj = pd.to_datetime(session['date'], format='%Y-%m-%d')
-            events.append({
-                'id': course['course_id'],
-                'title': f"{course['course_id']}: {course['course_name']}",
-                'instructor': course['instructor'],
-                'location': course['location'],
-                'start_time': session['start_time'],
-                'end_time': session['end_time'],
-                'date': session['date'],  # Keep original date string to avoid timezone issues
-                'program': course['program'],
-                'day': date_obj.strftime('%A')  # Add the day of week
+        return self.index.get_calendar_events(selected_course_ids, window)
+
+    def memory_usage(self):
+        """Size of the course data: see CourseIndex.memory_usage"""
+        return self.index.memory_usage()
+
+
+class CourseDatasets:
+    """Named course datasets (terms), loaded on first use and evicted least recently used first.
+
+    The default dataset is the scheduler for the top-level CSV files and is
+    always resident. Every other term is a directory under terms_dir with its
+    own courses_info.csv and course_sessions.csv (and its own snapshot). It is
+    loaded the first time a request names it and dropped again once more than
+    max_resident datasets are loaded or their heap size (as counted by
+    CourseIndex.memory_usage) exceeds memory_budget bytes; the next request
+    for it loads it again. One
+    background thread per process checks the resident terms' files every
+    watch_interval seconds and reloads changed ones off the request path;
+    an evicted term is simply no longer checked.
+    """
+
+    NAME = re.compile(r'[\w-][\w.-]*')
+
+    def __init__(self, default, default_name='current', terms_dir='terms', max_resident=4, memory_budget=0,
+                 snapshot_dir=None, watch_interval=5.0, scheduler_options=None, load_seconds=None):
+        self.default = default
+        self.default_name = default_name
+        self.terms_dir = terms_dir
+        self.max_resident = max_resident
+        self.memory_budget = memory_budget
+        self.snapshot_dir = snapshot_dir
+        self.watch_interval = watch_interval
+        self.scheduler_options = scheduler_options or {}
+        self.resident = OrderedDict()  # name -> CourseScheduler, least recently used first
+        self.info = {default_name: {'loads': 1, 'evictions': 0, 'load_seconds': load_seconds, 'last_used': None}}
+        self._lock = threading.Lock()
+        self._loading = {}  # name -> lock held while that term loads
+        self._watcher_pid = None
+
+    def directory_of(self, name):
+        """The data directory of a term; raises KeyError for unknown names"""
+        if not self.NAME.fullmatch(name or ''):
+            raise KeyError(name)
+        directory = os.path.join(self.terms_dir, name)
+        if not os.path.isfile(os.path.join(directory, 'courses_info.csv')):
+            raise KeyError(name)
+        return directory
+
+    def names(self):
+        """The default term followed by every term directory, sorted"""
+        try:
+            entries = sorted(os.listdir(self.terms_dir))
+        except OSError:
+            entries = []
+        terms = [self.default_name]
+        for name in entries:
+            try:
+                self.directory_of(name)
+            except KeyError:
+                continue
+            if name != self.default_name:
+                terms.append(name)
+        return terms
+
+    def get(self, name=None):
+        """The scheduler of a term (the default one without a name), loading it if needed"""
+        if not name or name == self.default_name:
+            self.info[self.default_name]['last_used'] = datetime.utcnow()
+            return self.default
+        with self._lock:
+            scheduler = self.resident.get(name)
+            if scheduler is not None:
+                self.resident.move_to_end(name)
+                self.info[name]['last_used'] = datetime.utcnow()
+        return scheduler if scheduler is not None else self.load(name)
+
+    def start_watcher(self):
+        """Poll the resident terms' data files from a background thread in this process"""
+        if self.watch_interval <= 0 or self._watcher_pid == os.getpid():
+            return
+        self._watcher_pid = os.getpid()
+        threading.Thread(target=self._watch, name='term-data-watcher', daemon=True).start()
+
+    def _watch(self):
+        while True:
+            time.sleep(self.watch_interval)
+            with self._lock:
+                resident = list(self.resident.values())
+            for scheduler in resident:
+                scheduler.check_for_changes()
+
+    def load(self, name):
+        directory = self.directory_of(name)
+        with self._lock:
+            loading = self._loading.setdefault(name, threading.Lock())
+        # Concurrent requests for the same term wait for one load instead of each building it
+        with loading:
+            with self._lock:
+                scheduler = self.resident.get(name)
+            if scheduler is not None:
+                return scheduler
+            started = time.perf_counter()
+            scheduler = CourseScheduler(
+                os.path.join(directory, 'courses_info.csv'),
+                os.path.join(directory, 'course_sessions.csv'),
+                snapshot=os.path.join(self.snapshot_dir, f"course_data.{name}.snapshot") if self.snapshot_dir else None,
+                **self.scheduler_options
+            )
+            load_seconds = time.perf_counter() - started
+            with self._lock:
+                others = list(self.resident.items())
+            # Sized outside the lock; lazily built indexes have grown the older entries since their load
+            memory = {other: data.memory_usage() for other, data in [(name, scheduler), *others]}
+            with self._lock:
+                self.resident[name] = scheduler
+                info = self.info.setdefault(name, {'loads': 0, 'evictions': 0})
+                info.update(loads=info['loads'] + 1, load_seconds=load_seconds, last_used=datetime.utcnow())
+                for other, usage in memory.items():
+                    if other in self.info:
+                        self.info[other]['memory'] = usage
+                self.evict(keep=name)
+        print(f"Loaded term {name} in {load_seconds * 1000:.0f} ms "
+              f"({memory[name]['heap_bytes'] / 2**20:.1f} MB)")
+        return scheduler
+
+    def evict(self, keep):
+        """Drop the least recently used terms over the limits; the caller holds the lock"""
+        def heap_bytes():
+            return sum(self.info[name].get('memory', {}).get('heap_bytes', 0) for name in self.resident)
+
+        for name in list(self.resident):
+            count = len(self.resident) + 1  # the default dataset counts as resident
+            if count <= self.max_resident and not (self.memory_budget and heap_bytes() > self.memory_budget):
+                break
+            if name == keep:
+                continue
+            del self.resident[name]
+            self.info[name]['evictions'] += 1
+
+    def status(self):
+        """Residency, load time, memory and use of every term, default first"""
+        with self._lock:
+            resident = dict(self.resident, **{self.default_name: self.default})
+            info = {name: dict(entry) for name, entry in self.info.items()}
+        terms = []
+        for name in dict.fromkeys(self.names() + list(info)):
+            entry = info.get(name, {'loads': 0, 'evictions': 0})
+            scheduler = resident.get(name)
+            if scheduler is not None:
+                entry['memory'] = scheduler.memory_usage()
+            terms.append({
+                'term': name,
+                'default': name == self.default_name,
+                'resident': scheduler is not None,
+                'data_version': scheduler.data_version if scheduler is not None else None,
+                'courses': len(scheduler.get_all_courses()) if scheduler is not None else None,
+                'loads': entry['loads'],
+                'evictions': entry['evictions'],
+                'load_seconds': entry.get('load_seconds'),
+                'last_used': entry['last_used'].isoformat() if entry.get('last_used') else None,
+                'memory': entry.get('memory') if scheduler is not None else None
             })
-        
-        return events
+        return {
+            'max_resident': self.max_resident,
+            'memory_budget_bytes': self.memory_budget,
+            'resident_heap_bytes': sum(term['memory']['heap_bytes'] for term in terms if term['memory']),
+            'terms': terms
+        }
 
 
 # Initialize the course scheduler with error handling
+started = time.perf_counter()
 try:
-    scheduler = CourseScheduler()
+    scheduler = CourseScheduler(
+        calendar_cache_size=app.config["CALENDAR_CACHE_SIZE"],
+        reload_trigger=app.config["COURSE_DATA_RELOAD_TRIGGER"],
+        snapshot=app.config["COURSE_SNAPSHOT"]
+    )
     print("Course scheduler initialized successfully")
 except Exception as e:
     print(f"Error initializing course scheduler: {e}")
     # Create a dummy scheduler with empty data
     class DummyScheduler:
+        data_version = 'empty'
         def get_programs(self):
             return ['Core Courses', 'Elective Courses', 'Other Events']
         def get_all_courses(self):
             return []
         def get_courses_by_program(self, program):
             return []
-        def get_calendar_events(self, course_ids):
+        def get_calendar_events(self, course_ids, window=None):
             return []
+        def get_courses_by_ids(self, course_ids):
+            return []
+        def get_ics_events(self, course_id):
+            return '', ''
+        def get_calendar(self, course_ids, window=None):
+            return {'events': [], 'overlaps': []}
+        def get_calendar_delta(self, selection, version, added=(), removed=(), window=None):
+            return None
+        def iter_calendars(self, selections, render=None, workers=1, window=64):
+            render = render or (lambda calendar: calendar)
+            return (render({'events': [], 'overlaps': []}) for _ in selections)
         def find_overlapping_courses(self, courses):
             return []
+        def get_conflict_matrix(self):
+            return ConflictMatrix(SessionColumns.empty())
+        def has_overlaps(self, course_ids, window=None):
+            return False
+        def get_course_conflicts(self, course_id):
+            return []
+        def get_room_occupancy(self):
+            return RoomOccupancy(SessionColumns.empty(), {})
+        def search_courses(self, query, programs=(), locations=(), limit=10):
+            return [], 0, False
+        def find_schedules(self, wishlist, must_have=(), limit=5, time_budget=0.5):
+            return {'schedules': [], 'complete': True, 'nodes': 0, 'without_sessions': [], 'unknown': list(wishlist)}
+        def start_watcher(self, interval):
+            pass
+        def request_reload(self):
+            pass
+        def reload_status(self):
+            return {'data_version': self.data_version, 'reload_count': 0}
+        def memory_usage(self):
+            return {'heap_bytes': 0, 'mapped_bytes': 0, 'courses': 0, 'sessions': 0, 'conflict_pairs': 0}
     scheduler = DummyScheduler()
 
+datasets = CourseDatasets(
+    scheduler,
+    load_seconds=time.perf_counter() - started,
+    default_name=app.config["DEFAULT_TERM"],
+    terms_dir=app.config["COURSE_TERMS_DIR"],
+    max_resident=app.config["DATASET_MAX_RESIDENT"],
+    memory_budget=int(app.config["DATASET_MEMORY_BUDGET_MB"] * 2**20),
+    snapshot_dir=os.path.dirname(app.config["COURSE_SNAPSHOT"]) if app.config["COURSE_SNAPSHOT"] else None,
+    watch_interval=app.config["COURSE_DATA_WATCH_INTERVAL"],
+    scheduler_options={'calendar_cache_size': app.config["CALENDAR_CACHE_SIZE"],
+                       'reload_trigger': app.config["COURSE_DATA_RELOAD_TRIGGER"]}
+)
+
+# Needs the conflict matrix, so it runs once the scheduler exists
+with app.app_context():
+    run_migration('backfill_course_selections', backfill_course_selections)
+
+@app.cli.command('compile-snapshot')
+def compile_snapshot():
+    """Compile the course CSVs into the binary snapshot loaded at startup"""
+    if not app.config["COURSE_SNAPSHOT"]:
+        print("COURSE_SNAPSHOT is empty, nothing to compile")
+        return
+    index = CourseIndex(scheduler.load_courses_info(strict=True), scheduler.load_course_sessions(strict=True),
+                        scheduler.compute_data_version())
+    scheduler.write_snapshot(index)
+    print(f"Wrote {app.config['COURSE_SNAPSHOT']} (version {index.version}, "
+          f"{len(index.course_records)} courses, {len(index.session_columns)} sessions)")
+
+@app.cli.command('room-report')
+@click.option('--location', help='Only this location')
+@click.option('--limit', default=20, show_default=True, help='Clashes to list')
+def room_report(location, limit):
+    """Print room utilization, peaks and double bookings for the loaded course data"""
+    started = time.perf_counter()
+    occupancy = scheduler.get_room_occupancy()
+    if location is not None and location not in occupancy.locations:
+        raise click.BadParameter(f"unknown location, expected one of {', '.join(occupancy.locations)}")
+    report = occupancy.to_dict(location, limit)
+    elapsed = time.perf_counter() - started
+    if report['date_range']:
+        print(f"{report['date_range'][0]} to {report['date_range'][1]}, "
+              f"utilization over {report['hours'][0]}-{report['hours'][1]}")
+    for row in report['locations']:
+        peak = row['peak_at']
+        print(f"{row['location']}: {row['sessions']} sessions on {row['days']} days, "
+              f"utilization {row['utilization']:.1%}, peak {row['peak_concurrent']}"
+              + (f" on {peak['date']} {peak['time']}" if peak else '')
+              + f", double-booked {row['double_booked_minutes']} min")
+    print(f"{report['clash_count']} double bookings; {report['unassigned_sessions']} sessions without a room")
+    for clash in report['clashes']:
+        print(f"  {clash['date']} {clash['start_time']}-{clash['end_time']} {clash['location']}: "
+              f"{', '.join(clash['courses'])}")
+    print(f"Analysed in {elapsed * 1000:.1f} ms")
+
+@app.cli.command('prune-logs')
+def prune_logs():
+    """Archive and delete expired log rows and minute rollups now"""
+    result = log_retention.run()
+    if result is None:
+        print("Another process is applying the retention policy")
+        return
+    for table, count in result['deleted'].items():
+        archived = result['archived'].get(table)
+        print(f"{table}: deleted {count}" + (f", archived {archived}" if archived is not None else ''))
+    print(f"Wrote {len(result['files'])} archive file(s) in {result['duration']}s")
+
+@app.cli.command('read-archive')
+@click.argument('table')
+@click.option('--since', type=click.DateTime(), help='Only rows logged at or after this time (UTC)')
+@click.option('--until', type=click.DateTime(), help='Only rows logged before this time (UTC)')
+def read_archive_command(table, since, until):
+    """Print archived rows of TABLE as JSON Lines"""
+    for row in read_archive(app.config["LOG_ARCHIVE_DIR"], table, since, until):
+        click.echo(json.dumps(row))
+
+class CachedResponse:
+    """Serialized JSON body, its gzip encoding and the caller's metadata"""
+
+    def __init__(self, body, meta):
+        self.body = body
+        self.gzip_body = gzip.compress(body, compresslevel=6, mtime=0)
+        self.meta = meta
+
+response_cache = LRUCache(app.config["RESPONSE_CACHE_SIZE"])
+
+def cached_json_response(key, build, cacheable=None, cache_control=None, recompute_meta=None):
+    """Serve a JSON payload that only depends on key and the course data version.
+
+    build() returns (payload, meta), meta being a dict of details for activity
+    logging. Bodies are serialized and gzipped once per data version and
+    answered with strong ETags derived from the data version and key, so a
+    matching If-None-Match gets a 304 without building, even in a worker that
+    has not cached the body. Returns (response, meta); meta is the cached
+    entry's. A 304 answered without a cached entry gets its meta from
+    recompute_meta(), which must be cheap, or else is {'revalidated': True}:
+    such activity rows say so instead of silently lacking the build details.
+
+    A payload for which cacheable(payload) is false is sent uncached, without
+    an ETag, so it is never revalidated or served again. cache_control
+    replaces the default public Cache-Control, e.g. for admin-only data.
+    """
+    etag = hashlib.sha1(json.dumps([g.scheduler.data_version, key]).encode('utf-8')).hexdigest()
+    entry = response_cache.get(etag)
+    # Each content coding is its own representation, so it gets its own strong ETag
+    use_gzip = request.accept_encodings['gzip'] > 0
+    representation_etag = etag + '-gzip' if use_gzip else etag
+    if request.if_none_match.contains(etag) or request.if_none_match.contains(etag + '-gzip'):
+        response = Response(status=304)
+        if entry is not None:
+            meta = entry.meta
+        else:
+            meta = recompute_meta() if recompute_meta is not None else {'revalidated': True}
+    else:
+        if entry is None:
+            with profile_span('build'):
+                payload, meta = build()
+            if cacheable is not None and not cacheable(payload):
+                response = jsonify(payload)
+                response.headers['Cache-Control'] = 'no-store'
+                return response, meta
+            with profile_span('serialization'):
+                entry = CachedResponse(app.json.dumps(payload).encode('utf-8') + b'\n', meta)
+            response_cache.put(etag, entry)
+        response = Response(entry.gzip_body if use_gzip else entry.body, mimetype='application/json')
+        if use_gzip:
+            response.headers['Content-Encoding'] = 'gzip'
+        meta = entry.meta
+    response.set_etag(representation_etag)
+    response.headers['Cache-Control'] = (cache_control or
+                                         f"public, max-age={app.config['API_CACHE_MAX_AGE']}, must-revalidate")
+    response.vary.add('Accept-Encoding')
+    return response, meta
+
+def is_admin_request():
+    """True with the ADMIN_TOKEN header, or for a local client when no token is configured"""
+    token = app.config["ADMIN_TOKEN"]
+    if token:
+        return hmac.compare_digest(request.headers.get('X-Admin-Token', ''), token)
+    return request.remote_addr in ('127.0.0.1', '::1')
+
+def admin_required(view):
+    """Require the ADMIN_TOKEN header, or a local client when no token is configured"""
+    @functools.wraps(view)
+    def wrapper(*args, **kwargs):
+        if not is_admin_request():
+            return jsonify({'error': 'forbidden'}), 403
+        return view(*args, **kwargs)
+    return wrapper
+
+def term_data(view):
+    """Serve course data from the ?term= dataset (g.scheduler), loaded on first use; 404 for unknown terms"""
+    @functools.wraps(view)
+    def wrapper(*args, **kwargs):
+        term = request.args.get('term')
+        try:
+            with profile_span('data_lookup'):
+                g.scheduler = datasets.get(term)
+        except KeyError:
+            return jsonify({'error': f"unknown term: {term}", 'terms': datasets.names()}), 404
+        return view(*args, **kwargs)
+    return wrapper
+
 @app.route('/')
+@term_data
 def index():
     """Main page with course calendar"""
-    programs = scheduler.get_programs()
-    courses = scheduler.get_all_courses()
+    programs = g.scheduler.get_programs()
+    courses = g.scheduler.get_all_courses()
     
     # Log site visit
     log_user_activity('site_visit', {'page': 'homepage'})
@@ -272,41 +3899,288 @@ def index():
     return render_template('index.html', programs=programs, courses=courses)
 
 @app.route('/api/courses')
+@term_data
 def api_courses():
     """API endpoint to get courses by program"""
     program = request.args.get('program', 'All')
-    courses = scheduler.get_courses_by_program(program)
+
+    def build():
+        with profile_span('data_lookup'):
+            courses = g.scheduler.get_courses_by_program(program)
+        return courses, {'course_count': len(courses)}
+
+    response, details = cached_json_response(
+        ('courses', program), build,
+        recompute_meta=lambda: {'course_count': len(g.scheduler.get_courses_by_program(program))})
     
     # Log course browsing activity
-    log_user_activity('course_browsing', {'program': program, 'course_count': len(courses)})
+    log_user_activity('course_browsing', {'program': program, **details})
     
-    return jsonify(courses)
+    return response
+
+def selection_version(data_version, selection):
+    """Short hash naming a sorted selection under one version of the course data"""
+    return hashlib.sha1('\0'.join([data_version, *selection]).encode('utf-8')).hexdigest()[:16]
+
+def parse_calendar_window(args):
+    """(start, end) minutes for the start/end dates in args, both inclusive; None without either.
+
+    start_date/end_date are accepted as aliases. Raises ValueError for bad dates.
+    """
+    start = args.get('start') or args.get('start_date')
+    end = args.get('end') or args.get('end_date')
+    if not start and not end:
+        return None
+    lo = parse_date_days(start) * 1440 if start else np.iinfo(np.int64).min
+    hi = (parse_date_days(end) + 1) * 1440 if end else np.iinfo(np.int64).max
+    return int(lo), int(hi)
 
 @app.route('/api/calendar')
+@term_data
 def api_calendar():
-    """API endpoint to get calendar events for selected courses"""
+    """API endpoint to get calendar events for selected courses.
+
+    Optional start/end dates (inclusive) limit the events and the overlap
+    check to sessions in that window. With limit, events are paged: the
+    response carries next_cursor, to be passed back as cursor, and the
+    overlaps of the whole window are sent with the first page only.
+    """
     course_ids = request.args.getlist('courses')
-    events = scheduler.get_calendar_events(course_ids)
-    overlaps = []
-    
-    if len(course_ids) > 1:
-        selected_courses = scheduler.courses_info_df[scheduler.courses_info_df['course_id'].isin(course_ids)]
-        overlaps = scheduler.find_overlapping_courses(selected_courses.to_dict('records'))
+    # The payload does not depend on order or duplicates in the selection
+    selection = sorted(set(course_ids))
+    try:
+        window = parse_calendar_window(request.args)
+        limit = request.args.get('limit', type=int)
+        offset = decode_cursor(request.args.get('cursor'))
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+
+    def build():
+        calendar = g.scheduler.get_calendar(selection, window)
+        has_overlaps = len(calendar['overlaps']) > 0
+        if limit is None and offset == 0:
+            return calendar, {'has_overlaps': has_overlaps}
+        events = calendar['events']
+        end = len(events) if limit is None else offset + max(limit, 1)
+        return {
+            'events': events[offset:end],
+            'overlaps': calendar['overlaps'] if offset == 0 else [],
+            'total_events': len(events),
+            'next_cursor': encode_cursor(end) if end < len(events) else None
+        }, {'has_overlaps': has_overlaps}
+
+    response, details = cached_json_response(
+        ('calendar', selection, window, limit, offset), build,
+        recompute_meta=lambda: {'has_overlaps': g.scheduler.has_overlaps(selection, window)})
+    # Lets the client ask /api/calendar/delta for later changes to this selection
+    response.headers['X-Selection-Version'] = selection_version(g.scheduler.data_version, selection)
     
     # Log course selection activity
     log_user_activity('course_selection', {
         'selected_courses': course_ids, 
         'course_count': len(course_ids),
-        'has_overlaps': len(overlaps) > 0
+        **details
     })
+    if offset == 0:
+        # Later pages of the same calendar are not new selections
+        log_course_selection('course_selection', selection)
     
-    return jsonify({
-        'events': events,
-        'overlaps': overlaps
+    return response
+
+@app.route('/api/calendar/delta')
+@term_data
+def api_calendar_delta():
+    """API endpoint for the calendar changes caused by toggling courses.
+
+    ?courses= is the selection the client already shows and ?version= its
+    X-Selection-Version (or the version of the previous delta); ?add= and
+    ?remove= list the toggled courses, and start/end the same window as
+    /api/calendar. Returns the events to add, the course IDs whose events to
+    drop, the overlaps to add and the [course1, course2] overlaps to drop.
+    Answers 409 when the version does not match, e.g. after a data reload.
+    """
+    selection = sorted(set(request.args.getlist('courses')))
+    added = request.args.getlist('add')
+    removed = request.args.getlist('remove')
+    try:
+        window = parse_calendar_window(request.args)
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+
+    delta = g.scheduler.get_calendar_delta(selection, request.args.get('version'), added, removed, window)
+    if delta is None:
+        return jsonify({'error': 'selection version mismatch; fetch /api/calendar again'}), 409
+
+    log_user_activity('course_selection', {
+        'added': delta['added'],
+        'removed': delta['removed'],
+        'course_count': len(selection) + len(delta['added']) - len(delta['removed']),
+        'has_overlaps': bool(delta['add_overlaps'])
+    })
+    removed = set(delta['removed'])
+    log_course_selection('course_selection', [c for c in selection if c not in removed] + delta['added'])
+    return jsonify(delta)
+
+def encode_cursor(offset):
+    """Page cursor: the event offset, tied to the data version it was issued for"""
+    return f"{g.scheduler.data_version}.{offset}"
+
+def decode_cursor(cursor):
+    """Event offset of a cursor; raises ValueError when it is malformed or stale"""
+    if not cursor:
+        return 0
+    version, _, offset = cursor.rpartition('.')
+    if version != g.scheduler.data_version:
+        raise ValueError('cursor is from an older version of the course data; start again without it')
+    if not offset.isdigit():
+        raise ValueError('invalid cursor')
+    return int(offset)
+
+def summarize_calendar(calendar):
+    """Counts and conflicting course pairs of a calendar"""
+    return {
+        'courses': len({event['id'] for event in calendar['events']}),
+        'events': len(calendar['events']),
+        'overlaps': len(calendar['overlaps']),
+        'conflicts': [[o['course1']['course_id'], o['course2']['course_id']] for o in calendar['overlaps']]
+    }
+
+@app.route('/api/calendar/batch', methods=['POST'])
+@term_data
+def api_calendar_batch():
+    """API endpoint computing calendars for many selections in one call.
+
+    The JSON body is {"selections": [...], "summary": false}, where each
+    selection is a list of course IDs or {"id": ..., "courses": [...]}. The
+    response is JSON Lines, one {"id", "calendar"} (or {"id", "summary"})
+    line per selection in request order; the id defaults to the position.
+    """
+    data = request.get_json(silent=True)
+    items = data.get('selections') if isinstance(data, dict) else data
+    if not isinstance(items, list):
+        return jsonify({'error': 'expected a list of selections'}), 400
+    if len(items) > app.config["BATCH_CALENDAR_MAX_SELECTIONS"]:
+        return jsonify({'error': f"at most {app.config['BATCH_CALENDAR_MAX_SELECTIONS']} selections per batch"}), 413
+
+    ids, selections = [], []
+    for position, item in enumerate(items):
+        courses = item.get('courses') if isinstance(item, dict) else item
+        if not isinstance(courses, list) or not all(isinstance(c, str) for c in courses):
+            return jsonify({'error': f'selection {position} must be a list of course IDs'}), 400
+        ids.append(item.get('id', position) if isinstance(item, dict) else position)
+        selections.append(courses)
+
+    if isinstance(data, dict) and data.get('summary'):
+        field, render = 'summary', lambda calendar: json.dumps(summarize_calendar(calendar))
+    else:
+        field, render = 'calendar', app.json.dumps
+    distinct = len({tuple(sorted(set(courses))) for courses in selections})
+    workers = app.config["BATCH_CALENDAR_WORKERS"] if distinct >= app.config["BATCH_CALENDAR_PARALLEL_MIN"] else 1
+    bodies = g.scheduler.iter_calendars(selections, render, workers)
+
+    def generate():
+        for selection_id, body in zip(ids, bodies):
+            yield f'{{"id": {json.dumps(selection_id)}, "{field}": {body}}}\n'
+
+    # One activity row for the whole batch instead of one per student
+    log_user_activity('calendar_batch', {
+        'selections': len(selections),
+        'distinct': distinct,
+        'summary': field == 'summary'
+    })
+    response = Response(generate(), mimetype='application/x-ndjson')
+    response.headers['X-Data-Version'] = g.scheduler.data_version
+    return response
+
+@app.route('/api/conflicts')
+@term_data
+def api_conflicts():
+    """API endpoint for the precomputed course conflicts.
+
+    Without parameters returns the whole matrix: course IDs and, per course, a
+    hex bitmask of the courses it conflicts with. With ?course=<id> returns
+    that course's conflicts and the overlapping sessions of each.
+    """
+    course_id = request.args.get('course')
+    if course_id is None:
+        def build():
+            matrix = g.scheduler.get_conflict_matrix()
+            return matrix.to_dict(), {}
+        response, _ = cached_json_response(('conflicts',), build)
+        return response
+
+    if course_id not in g.scheduler.get_conflict_matrix().position and not g.scheduler.get_courses_by_ids([course_id]):
+        return jsonify({'error': f'unknown course {course_id}'}), 404
+
+    def build():
+        return {'course_id': course_id, 'conflicts': g.scheduler.get_course_conflicts(course_id)}, {}
+    response, _ = cached_json_response(('conflicts', course_id), build)
+    return response
+
+@app.route('/api/schedules')
+@term_data
+def api_schedules():
+    """API endpoint for the largest conflict-free subsets of a wishlist.
+
+    ?courses= lists the wishlist, ?must= the courses every schedule has to
+    contain and ?limit= how many alternatives to return, largest first.
+    """
+    wishlist = list(dict.fromkeys(request.args.getlist('courses')))
+    must_have = sorted(set(request.args.getlist('must')))
+    try:
+        limit = min(max(int(request.args.get('limit', 5)), 1), app.config["SCHEDULE_SEARCH_MAX_RESULTS"])
+    except ValueError:
+        return jsonify({'error': 'limit must be an integer'}), 400
+
+    def build():
+        result = g.scheduler.find_schedules(wishlist, must_have, limit, app.config["SCHEDULE_SEARCH_TIME_BUDGET"])
+        best = result['schedules'][0]['count'] if result['schedules'] else 0
+        return result, {'best_count': best}
+
+    try:
+        # A search cut short by the time budget depends on the load at the time; it is not the answer to keep
+        response, details = cached_json_response(('schedules', wishlist, must_have, limit), build,
+                                                 cacheable=lambda result: result['complete'])
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+
+    log_user_activity('schedule_search', {
+        'wishlist': wishlist,
+        'must_have': must_have,
+        **details
     })
+    return response
+
+@app.route('/api/search')
+@term_data
+def api_search():
+    """API endpoint for course search and autocomplete.
+
+    ?q= is matched word by word against the course ID, name, instructor,
+    program and location, each word as a prefix, so it can be called on
+    every keystroke. ?program= and ?location= (repeatable) restrict the
+    results and ?limit= caps them; total counts every match.
+    """
+    terms = search_tokens(request.args.get('q', ''), split=False)
+    programs = sorted(set(request.args.getlist('program')) - {'All'})
+    locations = sorted(set(request.args.getlist('location')))
+    try:
+        limit = min(max(int(request.args.get('limit', 10)), 1), app.config["COURSE_SEARCH_MAX_RESULTS"])
+    except ValueError:
+        return jsonify({'error': 'limit must be an integer'}), 400
+
+    def build():
+        query = ' '.join(terms)
+        matches, total, fuzzy = g.scheduler.search_courses(query, programs, locations, limit)
+        results = [dict(course, score=score) for course, score in matches]
+        return {'query': query, 'results': results, 'total': total, 'fuzzy': fuzzy}, {}
+
+    response, _ = cached_json_response(('search', terms, programs, locations, limit), build)
+    return response
 
 # Add a new route to specifically track calendar exports
 @app.route('/api/track/export')
+@term_data
 def track_export():
     """Track calendar export activity"""
     course_ids = request.args.getlist('courses')
@@ -318,26 +4192,134 @@ def track_export():
         'course_count': len(course_ids),
         'format': export_format
     })
+    log_course_selection('calendar_export', course_ids)
     
     return jsonify({'status': 'tracked'})
 
+@app.route('/api/export.ics')
+@term_data
+def export_ics():
+    """Stream an iCalendar file for the selected courses"""
+    course_ids = request.args.getlist('courses')
+    courses = g.scheduler.get_courses_by_ids(course_ids)
+    blocks = [g.scheduler.get_ics_events(course['course_id']) for course in courses]
+
+    etag = hashlib.sha1('|'.join(digest for _, digest in blocks).encode('utf-8')).hexdigest()
+    cache_control = f"public, max-age={app.config['API_CACHE_MAX_AGE']}, must-revalidate"
+    if request.if_none_match.contains(etag):
+        return Response(status=304, headers={'ETag': f'"{etag}"', 'Cache-Control': cache_control})
+
+    log_user_activity('calendar_export', {
+        'exported_courses': course_ids,
+        'course_count': len(course_ids),
+        'format': 'ics'
+    })
+    log_course_selection('calendar_export', course_ids)
+
+    def generate():
+        yield ICS_HEADER
+        for text, _ in blocks:
+            yield text
+        yield ICS_FOOTER
+
+    response = Response(generate(), mimetype='text/calendar')
+    response.headers['Content-Disposition'] = 'attachment; filename="mba_courses.ics"'
+    response.headers['Cache-Control'] = cache_control
+    response.set_etag(etag)
+    return response
+
 @app.route('/api/programs')
+@term_data
 def api_programs():
     """API endpoint to get all programs"""
-    programs = scheduler.get_programs()
-    return jsonify(programs)
+    response, _ = cached_json_response(('programs',), lambda: (g.scheduler.get_programs(), {}))
+    return response
+
+@app.route('/api/terms')
+def api_terms():
+    """Terms that can be passed as ?term=, the default one first"""
+    return jsonify({'default': datasets.default_name, 'terms': datasets.names()})
+
+@app.route('/admin/datasets')
+@admin_required
+def admin_datasets():
+    """Residency, load time and memory of every term in this worker"""
+    return jsonify(datasets.status())
+
+@app.route('/admin/reload', methods=['GET', 'POST'])
+@admin_required
+@term_data
+def admin_reload():
+    """Show the course data version, or (POST) ask all workers to reload the CSVs"""
+    if request.method == 'POST':
+        g.scheduler.request_reload()
+        return jsonify(g.scheduler.reload_status()), 202
+    return jsonify(g.scheduler.reload_status())
+
+@app.route('/admin/rooms')
+@admin_required
+@term_data
+def admin_rooms():
+    """Room utilization, peak concurrency, weekday/hour heatmaps and double bookings.
+
+    ?location= limits the report to one location and ?limit= the clashes listed.
+    """
+    location = request.args.get('location')
+    try:
+        limit = max(int(request.args.get('limit', 100)), 0)
+    except ValueError:
+        return jsonify({'error': 'limit must be an integer'}), 400
+    occupancy = g.scheduler.get_room_occupancy()
+    if location is not None and location not in occupancy.locations:
+        return jsonify({'error': 'unknown location', 'locations': occupancy.locations}), 404
+    # Admin only: shared caches must not keep the report
+    response, _ = cached_json_response(('rooms', location, limit), lambda: (occupancy.to_dict(location, limit), {}),
+                                       cache_control='private, no-store')
+    return response
+
+@app.route('/admin/profiles')
+@admin_required
+def admin_profiles():
+    """List the stored request profiles, newest first"""
+    profiler = request_profiler
+    return jsonify({
+        'sample_rate': profiler.sample_rate,
+        'slow_ms': profiler.slow_ms,
+        'keep': profiler.keep,
+        'profiles': profiler.list()
+    })
+
+@app.route('/admin/profiles/<name>')
+@admin_required
+def admin_profile(name):
+    """One stored profile: folded stacks, or ?format=json for its metadata and spans"""
+    as_json = request.args.get('format') == 'json'
+    path = request_profiler.path_of(name, '.json' if as_json else '.folded')
+    if path is None:
+        return jsonify({'error': f'unknown profile {name}'}), 404
+    with open(path) as f:
+        body = f.read()
+    if as_json:
+        return Response(body, mimetype='application/json')
+    return Response(body, mimetype='text/plain', headers={
+        'Content-Disposition': f'attachment; filename="{name}.folded"'
+    })
 
 @app.route('/stats')
 def view_stats():
     """View application statistics dashboard"""
     try:
-        total_requests = RequestLog.query.count()
-        recent_requests = RequestLog.query.order_by(RequestLog.timestamp.desc()).limit(10).all()
+        total_requests = request_totals()[0]
+        # Newest rows by primary key, which avoids sorting the whole table
+        recent_requests = RequestLog.query.order_by(RequestLog.id.desc()).limit(10).all()
         
         # Basic statistics
         stats = {
             'total_requests': total_requests,
-            'recent_requests': []
+            'recent_requests': [],
+            'log_writer': log_writer.stats(),
+            'ingest': ingest_policy.stats(),
+            'retention': log_retention.stats()
         }
         
         for req in recent_requests:
@@ -354,83 +4336,319 @@ def view_stats():
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
+def request_totals():
+    """Total request count and response time sum from the hourly rollups"""
+    count, response_time_sum = db.session.query(
+        func.coalesce(func.sum(RequestRollup.count), 0),
+        func.coalesce(func.sum(RequestRollup.response_time_sum), 0.0)
+    ).filter(RequestRollup.granularity == 'hour').one()
+    return count, response_time_sum
+
+@app.route('/stats/cache')
+def stats_cache():
+    """Hit, miss and eviction counters for this worker's in-memory caches"""
+    return jsonify({
+        'data_version': scheduler.data_version,
+        'calendar': scheduler.calendar_cache.stats() if hasattr(scheduler, 'calendar_cache') else None,
+        'responses': response_cache.stats()
+    })
+
+def summary_counts():
+    """Request, activity and filtered-traffic totals from the rollup tables, plus the latest activities"""
+    # Request statistics, read from the hourly rollups only
+    hourly = RequestRollup.granularity == 'hour'
+    total_requests, response_time_sum = request_totals()
+
+    def totals(column, model, *criteria):
+        return Counter(dict(db.session.query(column, func.sum(model.count)).filter(*criteria).group_by(column).all()))
+
+    status_codes = totals(RequestRollup.status_code, RequestRollup, hourly)
+    # Health checks and bots, counted without request_log rows
+    traffic = totals(TrafficCounter.category, TrafficCounter)
+    recent_activities = UserActivity.query.order_by(UserActivity.id.desc()).limit(LiveStats.RECENT).all()
+    return {
+        'requests': total_requests,
+        'response_time_sum': response_time_sum,
+        'paths': totals(RequestRollup.path, RequestRollup, hourly),
+        'status_codes': Counter({str(code): count for code, count in status_codes.items()}),
+        'methods': totals(RequestRollup.method, RequestRollup, hourly),
+        'activities': totals(ActivityRollup.activity_type, ActivityRollup, ActivityRollup.granularity == 'hour'),
+        'filtered': Counter({category: traffic[category] for category in ('health', 'bot') if category in traffic}),
+        'recent': [{
+            'timestamp': activity.timestamp.isoformat() if activity.timestamp else None,
+            'type': activity.activity_type,
+            'details': json.loads(activity.details) if activity.details else None,
+            'remote_addr': activity.remote_addr
+        } for activity in recent_activities]
+    }
+
+def summary_payload(counts):
+    """The /stats/summary response for counts shaped like summary_counts()"""
+    total_requests = counts['requests']
+    activity_distribution = {activity: count for activity, count in counts['activities'].items() if count}
+    return {
+        'total_requests': total_requests,
+        'avg_response_time': round(counts['response_time_sum'] / total_requests if total_requests else 0, 3),
+        'top_paths': [{'path': path, 'count': count} for path, count in counts['paths'].most_common(5)],
+        'status_codes': {code: count for code, count in counts['status_codes'].items() if count},
+        'methods': {method: count for method, count in counts['methods'].items() if count},
+        'filtered_traffic': {'health': counts['filtered']['health'], 'bot': counts['filtered']['bot']},
+        'user_activities': {
+            'total_activities': sum(activity_distribution.values()),
+            'site_visits': activity_distribution.get('site_visit', 0),
+            'calendar_exports': activity_distribution.get('calendar_export', 0),
+            'course_selections': activity_distribution.get('course_selection', 0),
+            'course_browsing': activity_distribution.get('course_browsing', 0),
+            'activity_distribution': activity_distribution,
+            'recent_activities': counts['recent']
+        }
+    }
+
 @app.route('/stats/summary')
 def stats_summary():
     """Get summary statistics including user activities"""
     try:
-        # Request statistics
-        total_requests = RequestLog.query.count()
-        if total_requests == 0:
-            avg_response_time = 0
-            top_paths = []
-            status_codes = {}
-            methods = {}
-        else:
-            from sqlalchemy import func
-            avg_response_time = db.session.query(func.avg(RequestLog.response_time)).scalar() or 0
-            
-            # Top requested paths
-            top_paths = db.session.query(
-                RequestLog.path, 
-                func.count(RequestLog.path).label('count')
-            ).group_by(RequestLog.path).order_by(func.count(RequestLog.path).desc()).limit(5).all()
-            
-            # Status code distribution
-            status_codes_query = db.session.query(
-                RequestLog.status_code,
-                func.count(RequestLog.status_code).label('count')
-            ).group_by(RequestLog.status_code).all()
-            
-            # HTTP methods distribution
-            methods_query = db.session.query(
-                RequestLog.method,
-                func.count(RequestLog.method).label('count')
-            ).group_by(RequestLog.method).all()
-            
-            status_codes = {str(code): count for code, count in status_codes_query}
-            methods = {method: count for method, count in methods_query}
-        
-        # User activity statistics
-        total_activities = UserActivity.query.count()
-        site_visits = UserActivity.query.filter_by(activity_type='site_visit').count()
-        calendar_exports = UserActivity.query.filter_by(activity_type='calendar_export').count()
-        course_selections = UserActivity.query.filter_by(activity_type='course_selection').count()
-        course_browsing = UserActivity.query.filter_by(activity_type='course_browsing').count()
-        
-        # Activity distribution
-        from sqlalchemy import func
-        activity_distribution = db.session.query(
-            UserActivity.activity_type,
-            func.count(UserActivity.activity_type).label('count')
-        ).group_by(UserActivity.activity_type).all()
-        
-        # Recent activities
-        recent_activities = UserActivity.query.order_by(UserActivity.timestamp.desc()).limit(10).all()
-        
-        return jsonify({
-            'total_requests': total_requests,
-            'avg_response_time': round(avg_response_time, 3),
-            'top_paths': [{'path': path, 'count': count} for path, count in top_paths],
-            'status_codes': status_codes,
-            'methods': methods,
-            'user_activities': {
-                'total_activities': total_activities,
-                'site_visits': site_visits,
-                'calendar_exports': calendar_exports,
-                'course_selections': course_selections,
-                'course_browsing': course_browsing,
-                'activity_distribution': {activity: count for activity, count in activity_distribution},
-                'recent_activities': [{
-                    'timestamp': activity.timestamp.isoformat() if activity.timestamp else None,
-                    'type': activity.activity_type,
-                    'details': json.loads(activity.details) if activity.details else None,
-                    'remote_addr': activity.remote_addr
-                } for activity in recent_activities]
-            }
-        })
+        with profile_span('data_lookup'):
+            counts = summary_counts()
+        return jsonify(summary_payload(counts))
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
+@app.route('/stats/stream')
+def stats_stream():
+    """Server-sent events for the dashboard: a 'snapshot' event with the
+    /stats/summary payload plus a latency window, then 'update' events with
+    only what changed, every LIVE_STATS_INTERVAL seconds. The stream ends
+    after LIVE_STATS_STREAM_SECONDS and the browser reconnects by itself.
+    Each stream holds a worker thread for that long, so a worker serves at
+    most LIVE_STATS_MAX_STREAMS; more get a 503 and retry later.
+    """
+    if not live_stats.open_stream(app.config["LIVE_STATS_MAX_STREAMS"]):
+        return jsonify({'error': 'too many dashboard streams'}), 503, {'Retry-After': '10'}
+    interval = live_stats.interval
+    duration = app.config["LIVE_STATS_STREAM_SECONDS"]
+
+    def event(name, data):
+        return f"event: {name}\ndata: {app.json.dumps(data)}\n\n"
+
+    def generate():
+        with app.app_context():
+            state = live_stats.current()
+        yield f"retry: {int(interval * 1000)}\n" + event('snapshot', state)
+        deadline = time.monotonic() + duration
+        idle = 0.0
+        while time.monotonic() < deadline:
+            time.sleep(interval)
+            with app.app_context():
+                current = live_stats.current()
+            changes = LiveStats.delta(state, current)
+            state = current
+            idle += interval
+            if changes:
+                idle = 0.0
+                yield event('update', changes)
+            elif idle >= 15:
+                idle = 0.0
+                yield ": keepalive\n\n"  # keeps proxies from closing an idle stream
+
+    response = Response(generate(), mimetype='text/event-stream')
+    # Runs however the stream ends, including viewers that disconnect
+    response.call_on_close(live_stats.close_stream)
+    response.headers['Cache-Control'] = 'no-cache'
+    response.headers['X-Accel-Buffering'] = 'no'
+    return response
+
+def selection_activity_arg():
+    """The ?type= of a /stats/courses request; raises ValueError for other activities"""
+    activity_type = request.args.get('type', 'course_selection')
+    if activity_type not in SELECTION_ACTIVITIES:
+        raise ValueError(f"type must be one of {', '.join(SELECTION_ACTIVITIES)}")
+    return activity_type
+
+def course_names(course_ids):
+    return {course['course_id']: course.get('course_name') for course in scheduler.get_courses_by_ids(course_ids)}
+
+@app.route('/stats/courses')
+def stats_courses():
+    """Most selected (or exported, with ?type=calendar_export) courses and how often each was in a conflict"""
+    try:
+        activity_type = selection_activity_arg()
+        limit = min(max(int(request.args.get('limit', 20)), 1), 500)
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+
+    with profile_span('data_lookup'):
+        rows = CourseSelectionCount.query.filter_by(activity_type=activity_type).order_by(
+            CourseSelectionCount.count.desc(), CourseSelectionCount.course_id).limit(limit).all()
+    names = course_names([row.course_id for row in rows])
+    return jsonify({
+        'type': activity_type,
+        'courses': [{
+            'course_id': row.course_id,
+            'course_name': names.get(row.course_id),
+            'count': row.count,
+            'conflict_count': row.conflict_count,
+            'conflict_rate': round(row.conflict_count / row.count, 4) if row.count else 0.0
+        } for row in rows]
+    })
+
+@app.route('/stats/courses/<course_id>')
+def stats_course(course_id):
+    """Selection count and conflict rate of one course plus the ?k= courses most often picked with it"""
+    try:
+        activity_type = selection_activity_arg()
+        k = min(max(int(request.args.get('k', 10)), 1), 100)
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+
+    with profile_span('data_lookup'):
+        counts = CourseSelectionCount.query.filter_by(activity_type=activity_type, course_id=course_id).first()
+        # Each pair is stored once, so look the course up on both sides
+        co_selected = []
+        for column, other in ((CoSelectionCount.course1, CoSelectionCount.course2),
+                              (CoSelectionCount.course2, CoSelectionCount.course1)):
+            co_selected += db.session.query(other, CoSelectionCount.count).filter(
+                CoSelectionCount.activity_type == activity_type, column == course_id
+            ).order_by(CoSelectionCount.count.desc()).limit(k).all()
+        co_selected = sorted(co_selected, key=lambda pair: (-pair[1], pair[0]))[:k]
+
+    count = counts.count if counts else 0
+    conflict_count = counts.conflict_count if counts else 0
+    names = course_names([course_id] + [other for other, _ in co_selected])
+    return jsonify({
+        'type': activity_type,
+        'course_id': course_id,
+        'course_name': names.get(course_id),
+        'count': count,
+        'conflict_count': conflict_count,
+        'conflict_rate': round(conflict_count / count, 4) if count else 0.0,
+        'co_selected': [{
+            'course_id': other,
+            'course_name': names.get(other),
+            'count': together,
+            'share': round(together / count, 4) if count else 0.0
+        } for other, together in co_selected]
+    })
+
+EXPORT_TABLES = {model.__tablename__: model for model in (RequestLog, UserActivity, CourseSelection, UserAgent)}
+
+def parse_export_time(value):
+    """ISO date or datetime from an export query parameter as naive UTC, like the timestamp columns, or None.
+
+    Times without an offset are taken as UTC; ones with an offset (or Z) are converted.
+    """
+    if not value:
+        return None
+    try:
+        parsed = datetime.fromisoformat(value)
+    except ValueError:
+        raise ValueError(f"invalid time '{value}', expected YYYY-MM-DD or YYYY-MM-DDTHH:MM:SS")
+    if parsed.tzinfo is not None:
+        parsed = parsed.astimezone(timezone.utc).replace(tzinfo=None)
+    return parsed
+
+def iter_log_rows(model, start=None, end=None, chunk_rows=5000):
+    """Yield lists of row tuples (column order, times as ISO strings) with start <= timestamp < end.
+
+    Keyset pagination on id: every chunk is one short query continuing after
+    the last id seen, and its read transaction is ended before the rows are
+    handed out, so a slow client never holds a lock the log writer needs.
+    Each query runs in its own app context, which is popped (returning the
+    session's connection to the pool) before the rows are yielded.
+    """
+    columns = list(model.__table__.columns)
+    times = [i for i, column in enumerate(columns) if isinstance(column.type, db.DateTime)]
+    condition = model.timestamp.isnot(None)
+    if start is not None:
+        condition &= model.timestamp >= start
+    if end is not None:
+        condition &= model.timestamp < end
+    with app.app_context():
+        # The timestamp index finds where the range begins without scanning older ids
+        last_id = db.session.query(func.min(model.id)).filter(condition).scalar()
+        db.session.commit()
+    if last_id is None:
+        return
+    last_id -= 1
+    query = db.select(*columns).where(condition).order_by(model.id).limit(chunk_rows)
+    while True:
+        with app.app_context():
+            rows = db.session.connection().execute(query.where(model.id > last_id)).all()
+            db.session.commit()
+        if not rows:
+            return
+        last_id = rows[-1].id
+        if times:
+            rows = [list(row) for row in rows]
+            for row in rows:
+                for i in times:
+                    if row[i] is not None:
+                        row[i] = row[i].isoformat()
+        yield rows
+
+def format_csv_rows(rows):
+    buffer = io.StringIO()
+    csv.writer(buffer).writerows(rows)
+    return buffer.getvalue()
+
+@app.route('/stats/export/<table>')
+@admin_required
+def stats_export(table):
+    """Stream the rows of a log table for a time range as CSV or JSON Lines.
+
+    ?start= and ?end= bound the timestamps (end exclusive), ?format= is
+    jsonl (default) or csv, and ?gzip=1 compresses the download.
+    """
+    model = EXPORT_TABLES.get(table)
+    if model is None:
+        return jsonify({'error': f"unknown table, expected one of {', '.join(EXPORT_TABLES)}"}), 404
+    export_format = request.args.get('format', 'jsonl')
+    if export_format not in ('jsonl', 'csv'):
+        return jsonify({'error': 'format must be jsonl or csv'}), 400
+    try:
+        start = parse_export_time(request.args.get('start'))
+        end = parse_export_time(request.args.get('end'))
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    compress = request.args.get('gzip') in ('1', 'true')
+    chunks = iter_log_rows(model, start, end, app.config["EXPORT_CHUNK_ROWS"])
+    names = [column.name for column in model.__table__.columns]
+
+    def generate_text():
+        if export_format == 'csv':
+            yield format_csv_rows([names])
+        for rows in chunks:
+            if export_format == 'csv':
+                yield format_csv_rows(rows)
+            else:
+                yield ''.join(json.dumps(dict(zip(names, row))) + '\n' for row in rows)
+
+    def generate():
+        if not compress:
+            for text in generate_text():
+                yield text.encode('utf-8')
+            return
+        compressor = zlib.compressobj(6, zlib.DEFLATED, 31)  # wbits 31: gzip container
+        for text in generate_text():
+            data = compressor.compress(text.encode('utf-8'))
+            if data:
+                yield data
+        yield compressor.flush()
+
+    filename = f"{table}.{export_format}" + ('.gz' if compress else '')
+    if compress:
+        mimetype = 'application/gzip'
+    else:
+        mimetype = 'text/csv' if export_format == 'csv' else 'application/x-ndjson'
+    response = Response(generate(), mimetype=mimetype)
+    response.headers['Content-Disposition'] = f'attachment; filename="{filename}"'
+    return response
+
+@app.route('/metrics')
+def metrics():
+    """Per-route latency percentiles and request counts across all workers"""
+    return latency_metrics.render(), 200, {'Content-Type': 'text/plain; version=0.0.4; charset=utf-8'}
+
 @app.route('/stats/dashboard')
 def stats_dashboard():
     """Render a simple HTML dashboard for statistics"""
@@ -466,96 +4684,139 @@ def stats_dashboard():
         <div id="stats-container">Loading...</div>
         
         <script>
-            fetch('/stats/summary')
-                .then(response => response.json())
-                .then(data => {
-                    const activities = data.user_activities || {};
-                    document.getElementById('stats-container').innerHTML = `
-                        <div class="dashboard-grid">
-                            <div class="stat-card">
-                                <h3>Total HTTP Requests</h3>
-                                <div class="stat-value">${data.total_requests}</div>
-                            </div>
-                            <div class="stat-card">
-                                <h3>Average Response Time</h3>
-                                <div class="stat-value">${data.avg_response_time}ms</div>
-                            </div>
-                            <div class="stat-card activity-card">
-                                <h3>Site Visits</h3>
-                                <div class="activity-value">${activities.site_visits || 0}</div>
-                            </div>
-                            <div class="stat-card activity-card">
-                                <h3>Calendar Exports</h3>
-                                <div class="activity-value">${activities.calendar_exports || 0}</div>
-                            </div>
-                            <div class="stat-card activity-card">
-                                <h3>Course Selections</h3>
-                                <div class="activity-value">${activities.course_selections || 0}</div>
-                            </div>
-                            <div class="stat-card activity-card">
-                                <h3>Course Browsing</h3>
-                                <div class="activity-value">${activities.course_browsing || 0}</div>
-                            </div>
+            // The stream sends the whole state once, then only what changed
+            let state = null;
+
+            function render(data) {
+                const activities = data.user_activities || {};
+                const latency = data.latency || {};
+                document.getElementById('stats-container').innerHTML = `
+                    <div class="dashboard-grid">
+                        <div class="stat-card">
+                            <h3>Total HTTP Requests</h3>
+                            <div class="stat-value">${data.total_requests}</div>
                         </div>
-                        
-                        <div class="stat-card full-width">
-                            <h3>User Activity Distribution</h3>
-                            <table>
-                                <tr><th>Activity Type</th><th>Count</th></tr>
-                                ${Object.entries(activities.activity_distribution || {}).map(([activity, count]) => 
-                                    `<tr><td>${activity.replace('_', ' ').toUpperCase()}</td><td>${count}</td></tr>`
-                                ).join('')}
-                            </table>
+                        <div class="stat-card">
+                            <h3>Average Response Time</h3>
+                            <div class="stat-value">${data.avg_response_time}ms</div>
                         </div>
-                        
                         <div class="stat-card full-width">
-                            <h3>Top Requested Paths</h3>
+                            <h3>Latency, last ${latency.window_seconds || 60} s (${latency.count || 0} requests)</h3>
+                            <div class="stat-value">p50 ${latency.p50 || 0}ms &middot; p90 ${latency.p90 || 0}ms &middot; p99 ${latency.p99 || 0}ms</div>
+                        </div>
+                        <div class="stat-card activity-card">
+                            <h3>Site Visits</h3>
+                            <div class="activity-value">${activities.site_visits || 0}</div>
+                        </div>
+                        <div class="stat-card activity-card">
+                            <h3>Calendar Exports</h3>
+                            <div class="activity-value">${activities.calendar_exports || 0}</div>
+                        </div>
+                        <div class="stat-card activity-card">
+                            <h3>Course Selections</h3>
+                            <div class="activity-value">${activities.course_selections || 0}</div>
+                        </div>
+                        <div class="stat-card activity-card">
+                            <h3>Course Browsing</h3>
+                            <div class="activity-value">${activities.course_browsing || 0}</div>
+                        </div>
+                    </div>
+                    
+                    <div class="stat-card full-width">
+                        <h3>User Activity Distribution</h3>
+                        <table>
+                            <tr><th>Activity Type</th><th>Count</th></tr>
+                            ${Object.entries(activities.activity_distribution || {}).map(([activity, count]) => 
+                                `<tr><td>${activity.replace('_', ' ').toUpperCase()}</td><td>${count}</td></tr>`
+                            ).join('')}
+                        </table>
+                    </div>
+                    
+                    <div class="stat-card full-width">
+                        <h3>Top Requested Paths</h3>
+                        <table>
+                            <tr><th>Path</th><th>Count</th></tr>
+                            ${data.top_paths.map(item => `<tr><td>${item.path}</td><td>${item.count}</td></tr>`).join('')}
+                        </table>
+                    </div>
+                    
+                    <div class="dashboard-grid">
+                        <div class="stat-card">
+                            <h3>HTTP Status Codes</h3>
                             <table>
-                                <tr><th>Path</th><th>Count</th></tr>
-                                ${data.top_paths.map(item => `<tr><td>${item.path}</td><td>${item.count}</td></tr>`).join('')}
+                                <tr><th>Code</th><th>Count</th></tr>
+                                ${Object.entries(data.status_codes).map(([code, count]) => 
+                                    `<tr><td>${code}</td><td>${count}</td></tr>`
+                                ).join('')}
                             </table>
                         </div>
-                        
-                        <div class="dashboard-grid">
-                            <div class="stat-card">
-                                <h3>HTTP Status Codes</h3>
-                                <table>
-                                    <tr><th>Code</th><th>Count</th></tr>
-                                    ${Object.entries(data.status_codes).map(([code, count]) => 
-                                        `<tr><td>${code}</td><td>${count}</td></tr>`
-                                    ).join('')}
-                                </table>
-                            </div>
-                            <div class="stat-card">
-                                <h3>HTTP Methods</h3>
-                                <table>
-                                    <tr><th>Method</th><th>Count</th></tr>
-                                    ${Object.entries(data.methods).map(([method, count]) => 
-                                        `<tr><td>${method}</td><td>${count}</td></tr>`
-                                    ).join('')}
-                                </table>
-                            </div>
-                        </div>
-                        
-                        <div class="stat-card full-width">
-                            <h3>Recent User Activities</h3>
+                        <div class="stat-card">
+                            <h3>HTTP Methods</h3>
                             <table>
-                                <tr><th>Time</th><th>Activity</th><th>Details</th><th>IP Address</th></tr>
-                                ${(activities.recent_activities || []).map(activity => `
-                                    <tr>
-                                        <td>${new Date(activity.timestamp).toLocaleString()}</td>
-                                        <td>${activity.type.replace('_', ' ').toUpperCase()}</td>
-                                        <td>${activity.details ? JSON.stringify(activity.details) : 'N/A'}</td>
-                                        <td>${activity.remote_addr}</td>
-                                    </tr>
-                                `).join('')}
+                                <tr><th>Method</th><th>Count</th></tr>
+                                ${Object.entries(data.methods).map(([method, count]) => 
+                                    `<tr><td>${method}</td><td>${count}</td></tr>`
+                                ).join('')}
                             </table>
                         </div>
-                    `;
-                })
-                .catch(error => {
-                    document.getElementById('stats-container').innerHTML = 'Error loading statistics: ' + error;
+                    </div>
+                    
+                    <div class="stat-card full-width">
+                        <h3>Recent User Activities</h3>
+                        <table>
+                            <tr><th>Time</th><th>Activity</th><th>Details</th><th>IP Address</th></tr>
+                            ${(activities.recent_activities || []).map(activity => `
+                                <tr>
+                                    <td>${new Date(activity.timestamp).toLocaleString()}</td>
+                                    <td>${activity.type.replace('_', ' ').toUpperCase()}</td>
+                                    <td>${activity.details ? JSON.stringify(activity.details) : 'N/A'}</td>
+                                    <td>${activity.remote_addr}</td>
+                                </tr>
+                            `).join('')}
+                        </table>
+                    </div>
+                `;
+            }
+
+            function applyUpdate(changes) {
+                const { user_activities: activityChanges, new_activities: newActivities, ...rest } = changes;
+                Object.assign(state, rest);
+                const activities = state.user_activities;
+                Object.assign(activities, activityChanges || {});
+                if (newActivities) {
+                    activities.recent_activities = newActivities.concat(activities.recent_activities).slice(0, 10);
+                }
+            }
+
+            function connect() {
+                const source = new EventSource('/stats/stream');
+                source.addEventListener('snapshot', event => {
+                    state = JSON.parse(event.data);
+                    render(state);
                 });
+                source.addEventListener('update', event => {
+                    if (!state) return;
+                    applyUpdate(JSON.parse(event.data));
+                    render(state);
+                });
+                source.onerror = () => {
+                    // The browser retries by itself unless the server refused the stream
+                    if (source.readyState === EventSource.CLOSED) {
+                        setTimeout(connect, 10000);
+                    }
+                };
+            }
+
+            if (window.EventSource) {
+                connect();
+            } else {
+                fetch('/stats/summary')
+                    .then(response => response.json())
+                    .then(render)
+                    .catch(error => {
+                        document.getElementById('stats-container').innerHTML = 'Error loading statistics: ' + error;
+                    });
+            }
         </script>
     </body>
     </html>
@@ -0,0 +1,330 @@
+#!/usr/bin/env python3
+"""
+Benchmark suite for the course scheduler.
+
+Generates a deterministic synthetic catalogue (courses_info.csv and
+course_sessions.csv) at a configurable size and conflict density, times the
+CourseScheduler operations and the Flask endpoints on it, and writes the
+results as JSON so runs can be compared between commits:
+
+    python benchmark.py --courses 2000 --sessions-per-course 30 --output before.json
+    python benchmark.py --courses 2000 --sessions-per-course 30 --compare before.json
+
+--compare exits with status 1 when any median got slower than the baseline by
+more than --tolerance.
+"""
+
+import argparse
+import csv
+import json
+import math
+import os
+import platform
+import random
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import date, timedelta
+
+# Keep benchmark runs away from the bundled database and instance folder
+work_dir = tempfile.mkdtemp(prefix='course-benchmark-')
+os.environ.setdefault('DATABASE_URL', 'sqlite:///' + os.path.join(work_dir, 'benchmark.db'))
+os.environ.setdefault('METRICS_SPOOL_DIR', os.path.join(work_dir, 'metrics'))
+os.environ.setdefault('COURSE_DATA_RELOAD_TRIGGER', os.path.join(work_dir, 'reload.trigger'))
+os.environ.setdefault('COURSE_SNAPSHOT', '')
+os.environ.setdefault('PROFILE_DIR', os.path.join(work_dir, 'profiles'))
+os.environ.setdefault('COURSE_DATA_WATCH_INTERVAL', '0')
+os.environ.setdefault('LOG_RETENTION_INTERVAL', '0')
+
+RESULTS_FORMAT = 1
+
+# Session slots modelled on the real timetable; the full day overlaps the first two
+SLOTS = [('9:30', '12:45'), ('14:00', '17:15'), ('18:30', '21:45'), ('9:30', '17:00')]
+
+
+def generate_catalogue(directory, courses=1000, sessions_per_course=20, programs=8,
+                       density=0.05, seed=42, term_start=date(2025, 8, 18)):
+    """Write a synthetic courses_info.csv and course_sessions.csv into directory.
+
+    Each course gets sessions_per_course distinct (date, slot) pairs drawn at
+    random. The term is stretched so that roughly `density` of all course
+    pairs share at least one slot. The same arguments always produce the
+    same files. Returns the (courses_info, course_sessions) paths.
+    """
+    rng = random.Random(seed)
+    slot_count = len(SLOTS)
+    minutes = [(_minutes(start), _minutes(end)) for start, end in SLOTS]
+    # Average number of slots (itself included) that a slot overlaps
+    overlap_factor = sum(a[0] < b[1] and b[0] < a[1] for a in minutes for b in minutes) / slot_count
+    # P(two courses never overlap) ~ exp(-s^2 * overlap_factor / (days * slots))
+    density = min(max(density, 1e-6), 0.999)
+    term_days = max(1, math.ceil(sessions_per_course ** 2 * overlap_factor / (slot_count * -math.log(1 - density))))
+    term_days = max(term_days, math.ceil(sessions_per_course / slot_count))
+    dates = [(term_start + timedelta(days=d)).isoformat() for d in range(term_days)]
+
+    program_names = ['Core Courses'] + [f'Programme {i:02d}' for i in range(1, max(programs, 1))]
+    instructors = [f'Prof. Synthetic {i:03d}' for i in range(max(courses // 4, 1))]
+    locations = ['Unspecified'] + [f'Room {i:03d}' for i in range(1, 60)]
+
+    os.makedirs(directory, exist_ok=True)
+    courses_info = os.path.join(directory, 'courses_info.csv')
+    course_sessions = os.path.join(directory, 'course_sessions.csv')
+    with open(courses_info, 'w', newline='') as info, open(course_sessions, 'w', newline='') as sessions:
+        info_writer = csv.writer(info)
+        session_writer = csv.writer(sessions)
+        info_writer.writerow(['course_id', 'course_name', 'instructor', 'program', 'location'])
+        session_writer.writerow(['course_id', 'date', 'start_time', 'end_time'])
+        for n in range(courses):
+            course_id = f'SYN{n:05d}'
+            info_writer.writerow([course_id, f'Synthetic Course {n}', rng.choice(instructors),
+                                  rng.choice(program_names), rng.choice(locations)])
+            picks = rng.sample(range(term_days * slot_count), sessions_per_course)
+            for pick in sorted(picks):
+                start_time, end_time = SLOTS[pick % slot_count]
+                session_writer.writerow([course_id, dates[pick // slot_count], start_time, end_time])
+    return courses_info, course_sessions
+
+
+def _minutes(clock):
+    hours, minutes = clock.split(':')
+    return int(hours) * 60 + int(minutes)
+
+
+def measure(fn, repeat=5, min_time=0.05):
+    """Time fn; returns {median_ms, min_ms, runs}.
+
+    Fast calls are looped until a sample takes min_time, so timer resolution
+    does not dominate. One warm-up call runs first.
+    """
+    fn()
+    number = 1
+    while True:
+        start = time.perf_counter()
+        for _ in range(number):
+            fn()
+        elapsed = time.perf_counter() - start
+        if elapsed >= min_time or number >= 1 << 16:
+            break
+        number *= 2
+    samples = [elapsed / number]
+    for _ in range(repeat - 1):
+        start = time.perf_counter()
+        for _ in range(number):
+            fn()
+        samples.append((time.perf_counter() - start) / number)
+    return {
+        'median_ms': round(statistics.median(samples) * 1000, 4),
+        'min_ms': round(min(samples) * 1000, 4),
+        'runs': repeat * number
+    }
+
+
+def measure_once(fn, repeat=3):
+    """Time fn with no warm-up, for cold paths such as loading (fresh state each call)"""
+    samples = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        samples.append(time.perf_counter() - start)
+    return {
+        'median_ms': round(statistics.median(samples) * 1000, 4),
+        'min_ms': round(min(samples) * 1000, 4),
+        'runs': repeat
+    }
+
+
+def run_benchmarks(courses_info, course_sessions, repeat=5, selection_size=8, seed=42):
+    """Time scheduler operations and endpoints on the given CSVs; returns (data stats, results)"""
+    import app as app_module
+    from app import CourseScheduler, CourseIndex, ConflictMatrix, CourseSearchIndex, RoomOccupancy, search_schedules
+
+    rng = random.Random(seed)
+    results = {}
+    snapshot = os.path.join(os.path.dirname(courses_info), 'course_data.snapshot')
+
+    # Startup: parse the CSVs, compile the snapshot, then map it
+    results['load_csv'] = measure_once(lambda: CourseScheduler(courses_info, course_sessions), repeat)
+    scheduler = CourseScheduler(courses_info, course_sessions)
+    scheduler.snapshot = snapshot
+    results['snapshot_write'] = measure_once(scheduler.write_snapshot, repeat)
+    results['load_snapshot'] = measure_once(
+        lambda: CourseScheduler(courses_info, course_sessions, snapshot=snapshot), repeat)
+
+    index = scheduler.index
+    results['index_build'] = measure_once(
+        lambda: CourseIndex(index.course_records, index.session_columns, index.version), repeat)
+    results['conflict_matrix_build'] = measure_once(lambda: ConflictMatrix(index.session_columns), repeat)
+    matrix = index.conflict_matrix
+    locations = {course_id: course.get('location', '') for course_id, course in index.course_by_id.items()}
+    results['room_occupancy_build'] = measure_once(lambda: RoomOccupancy(index.session_columns, locations), repeat)
+    results['search_index_build'] = measure_once(lambda: CourseSearchIndex(index.sorted_courses), repeat)
+
+    course_ids = [course['course_id'] for course in index.course_records]
+    programs = scheduler.get_programs()
+    size = min(selection_size, len(course_ids))
+    selections = [rng.sample(course_ids, size) for _ in range(64)]
+    selected_records = [scheduler.get_courses_by_ids(selection) for selection in selections]
+    picks = iter(range(1 << 62))
+
+    def next_of(items):
+        return items[next(picks) % len(items)]
+
+    results['get_all_courses'] = measure(scheduler.get_all_courses, repeat)
+    results['get_courses_by_program'] = measure(lambda: scheduler.get_courses_by_program(next_of(programs)), repeat)
+    results['get_calendar_events'] = measure(lambda: scheduler.get_calendar_events(next_of(selections)), repeat)
+    results['find_overlapping_courses'] = measure(
+        lambda: scheduler.find_overlapping_courses(next_of(selected_records)), repeat)
+    results['scan_overlapping_courses'] = measure(
+        lambda: index.scan_overlapping_courses(next_of(selected_records)), repeat)
+    results['build_calendar'] = measure(lambda: scheduler.build_calendar(index, tuple(sorted(next_of(selections)))), repeat)
+    wishlists = [rng.sample(course_ids, min(20, len(course_ids))) for _ in range(8)]
+    results['search_schedules'] = measure(
+        lambda: search_schedules(matrix, next_of(wishlists), limit=5, time_budget=1.0), repeat)
+    queries = [word[:length] for course in rng.sample(index.course_records, min(16, len(course_ids)))
+               for word in (course['course_id'], course['course_name'].split()[-1]) for length in (1, 3, 6)]
+    results['search_courses'] = measure(lambda: scheduler.search_courses(next_of(queries)), repeat)
+    results['calendar_delta'] = measure(
+        lambda: index.calendar_delta(next_of(selections), [next_of(course_ids)], [next_of(selections)[0]]), repeat)
+
+    # Endpoints through the test client, against the synthetic data
+    original_scheduler = app_module.scheduler
+    app_module.scheduler = app_module.datasets.default = scheduler
+    app_module.response_cache.clear()
+    try:
+        client = app_module.app.test_client()
+        first_day = index.sorted_courses[0]['first_session_date'] if index.sorted_courses else '2025-08-18'
+        window_end = (date.fromisoformat(first_day) + timedelta(days=41)).isoformat()
+
+        def get(path, **query):
+            response = client.get(path, query_string=query)
+            assert response.status_code == 200, (path, response.status_code)
+            return response
+
+        def uncached(fn):
+            def run():
+                app_module.response_cache.clear()
+                scheduler.calendar_cache.clear()
+                fn()
+            return run
+
+        results['http_courses_all'] = measure(lambda: get('/api/courses', program='All'), repeat)
+        results['http_courses_all_uncached'] = measure(uncached(lambda: get('/api/courses', program='All')), repeat)
+        results['http_programs'] = measure(lambda: get('/api/programs'), repeat)
+        results['http_calendar'] = measure(lambda: get('/api/calendar', courses=next_of(selections)), repeat)
+        results['http_calendar_uncached'] = measure(uncached(lambda: get('/api/calendar', courses=next_of(selections))), repeat)
+        results['http_calendar_window'] = measure(uncached(
+            lambda: get('/api/calendar', courses=next_of(selections), start=first_day, end=window_end)), repeat)
+        results['http_conflicts_course'] = measure(uncached(lambda: get('/api/conflicts', course=next_of(course_ids))), repeat)
+        results['http_schedules'] = measure(uncached(lambda: get('/api/schedules', courses=next_of(wishlists))), repeat)
+        results['http_search_uncached'] = measure(uncached(lambda: get('/api/search', q=next_of(queries))), repeat)
+        results['http_export_ics'] = measure(lambda: get('/api/export.ics', courses=next_of(selections)).get_data(), repeat)
+        results['http_calendar_batch_100'] = measure(
+            lambda: client.post('/api/calendar/batch', json=selections + selections[:36]).get_data(), repeat)
+        app_module.log_writer.flush()
+    finally:
+        app_module.scheduler = app_module.datasets.default = original_scheduler
+        app_module.response_cache.clear()
+
+    data = {
+        'courses': len(index.course_records),
+        'sessions': len(index.session_columns),
+        'conflicting_pairs': len(matrix.pairs),
+        'conflict_density': round(2 * len(matrix.pairs) / max(len(matrix) * (len(matrix) - 1), 1), 4)
+    }
+    return data, results
+
+
+def git_commit():
+    """Current commit hash, or None outside a git checkout"""
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__)), check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(results, baseline, tolerance):
+    """Print median changes against a baseline results dict; returns the names that regressed"""
+    regressions = []
+    print(f"{'benchmark':32} {'baseline ms':>12} {'now ms':>12} {'change':>8}")
+    for name, current in results['results'].items():
+        before = baseline['results'].get(name)
+        if before is None:
+            print(f"{name:32} {'-':>12} {current['median_ms']:12.3f} {'new':>8}")
+            continue
+        ratio = current['median_ms'] / before['median_ms'] if before['median_ms'] else 1.0
+        flag = ''
+        if ratio > 1 + tolerance:
+            regressions.append(name)
+            flag = '  REGRESSION'
+        print(f"{name:32} {before['median_ms']:12.3f} {current['median_ms']:12.3f} {ratio - 1:+8.1%}{flag}")
+    if baseline.get('params') != results.get('params'):
+        print("Warning: baseline was run with different parameters")
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmark the course scheduler on synthetic data')
+    parser.add_argument('--courses', type=int, default=1000)
+    parser.add_argument('--sessions-per-course', type=int, default=20)
+    parser.add_argument('--programs', type=int, default=8)
+    parser.add_argument('--density', type=float, default=0.05,
+                        help='approximate fraction of course pairs that conflict')
+    parser.add_argument('--seed', type=int, default=42)
+    parser.add_argument('--repeat', type=int, default=5, help='samples per benchmark')
+    parser.add_argument('--selection-size', type=int, default=8, help='courses per simulated student')
+    parser.add_argument('--data-dir', help='where to write the CSVs (default: a temporary directory)')
+    parser.add_argument('--output', help='write results JSON here (default: stdout)')
+    parser.add_argument('--compare', help='baseline results JSON to compare against')
+    parser.add_argument('--tolerance', type=float, default=0.25,
+                        help='allowed slowdown of a median before it counts as a regression')
+    args = parser.parse_args(argv)
+
+    params = {
+        'courses': args.courses,
+        'sessions_per_course': args.sessions_per_course,
+        'programs': args.programs,
+        'density': args.density,
+        'seed': args.seed,
+        'selection_size': args.selection_size
+    }
+    data_dir = args.data_dir or os.path.join(work_dir, 'data')
+    start = time.perf_counter()
+    courses_info, course_sessions = generate_catalogue(
+        data_dir, args.courses, args.sessions_per_course, args.programs, args.density, args.seed)
+    print(f"Generated {args.courses} courses x {args.sessions_per_course} sessions in "
+          f"{time.perf_counter() - start:.1f}s", file=sys.stderr)
+
+    data, timings = run_benchmarks(courses_info, course_sessions, args.repeat, args.selection_size, args.seed)
+    results = {
+        'format': RESULTS_FORMAT,
+        'commit': git_commit(),
+        'timestamp': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime()),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'params': params,
+        'data': data,
+        'results': timings
+    }
+
+    text = json.dumps(results, indent=2)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(text + '\n')
+    elif not args.compare:
+        print(text)
+
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        regressions = compare(results, baseline, args.tolerance)
+        if regressions:
+            print(f"{len(regressions)} regression(s): {', '.join(regressions)}", file=sys.stderr)
+            return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
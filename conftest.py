@@ -0,0 +1,13 @@
+import os
+import tempfile
+
+# Keep test runs away from the bundled instance/database.db and instance folder
+test_dir = tempfile.mkdtemp()
+os.environ.setdefault('DATABASE_URL', 'sqlite:///' + os.path.join(test_dir, 'test.db'))
+os.environ.setdefault('METRICS_SPOOL_DIR', os.path.join(test_dir, 'metrics'))
+os.environ.setdefault('COURSE_DATA_RELOAD_TRIGGER', os.path.join(test_dir, 'reload.trigger'))
+os.environ.setdefault('COURSE_SNAPSHOT', os.path.join(test_dir, 'course_data.snapshot'))
+os.environ.setdefault('PROFILE_DIR', os.path.join(test_dir, 'profiles'))
+os.environ.setdefault('LOG_ARCHIVE_DIR', os.path.join(test_dir, 'archive'))
+os.environ.setdefault('LOG_RETENTION_INTERVAL', '0')
+os.environ.setdefault('LOG_DETAIL_BUDGET', '0')
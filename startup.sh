@@ -11,5 +11,8 @@ pip install numpy==1.24.4
 # Install other dependencies
 pip install -r requirements.txt
 
-# Start the application with Gunicorn
-gunicorn --bind 0.0.0.0:$PORT app:app
+# Compile the course data snapshot so workers start without parsing the CSVs
+flask --app app compile-snapshot
+
+# Start the application with Gunicorn; threaded workers keep serving while dashboards hold /stats/stream open
+gunicorn --bind 0.0.0.0:$PORT --worker-class gthread --threads 16 app:app
@@ -18,26 +18,27 @@ def test_course_scheduler():
     
     # Test loading courses
     all_courses = scheduler.get_all_courses()
+    assert all_courses, "courses_info.csv should not be empty"
     print(f"✓ Loaded {len(all_courses)} courses from CSV")
     
     # Test programs
     programs = scheduler.get_programs()
+    assert 'Core Courses' in programs
     print(f"✓ Found {len(programs)} programs: {', '.join(programs)}")
     
     # Test filtering by program
-    cs_courses = scheduler.get_courses_by_program('Computer Science')
-    print(f"✓ Found {len(cs_courses)} Computer Science courses")
+    core_courses = scheduler.get_courses_by_program('Core Courses')
+    assert core_courses and all(course['program'] == 'Core Courses' for course in core_courses)
+    print(f"✓ Found {len(core_courses)} Core Courses")
     
     # Test calendar events
-    selected_courses = ['CS101', 'CS102', 'MATH201']
+    selected_courses = [course['course_id'] for course in core_courses[:3]]
     events = scheduler.get_calendar_events(selected_courses)
+    assert events and {event['id'] for event in events} <= set(selected_courses)
     print(f"✓ Generated {len(events)} calendar events for selected courses")
     
     # Test overlap detection
-    overlaps = scheduler.find_overlapping_courses([
-        course for course in all_courses 
-        if course['course_id'] in selected_courses
-    ])
+    overlaps = scheduler.find_overlapping_courses(scheduler.get_courses_by_ids(selected_courses))
     print(f"✓ Found {len(overlaps)} time conflicts")
     
     # Display sample course information
@@ -47,30 +48,106 @@ def test_course_scheduler():
         print(f"  ID: {course['course_id']}")
         print(f"  Name: {course['course_name']}")
         print(f"  Instructor: {course['instructor']}")
-        print(f"  Time: {course['start_time']} - {course['end_time']}")
-        print(f"  Days: {course['days']}")
+        print(f"  First session: {course['first_session_date']} {course['first_session_time']}")
         print(f"  Location: {course['location']}")
-        print(f"  Credits: {course['credits']}")
         print(f"  Program: {course['program']}")
     
     # Test overlap detection with conflicting courses
     print("\n=== Testing Overlap Detection ===")
-    conflicting_courses = ['CS101', 'PHYS101']  # Both on Tuesday/Thursday 9:00-10:30
-    conflict_events = scheduler.get_calendar_events(conflicting_courses)
-    conflict_overlaps = scheduler.find_overlapping_courses([
-        course for course in all_courses 
-        if course['course_id'] in conflicting_courses
-    ])
+    matrix = scheduler.get_conflict_matrix()
+    first = next(course_id for course_id in matrix.course_ids if matrix.conflicts_of(course_id))
+    conflicting_courses = [first, matrix.conflicts_of(first)[0]]
+    conflict_overlaps = scheduler.find_overlapping_courses(scheduler.get_courses_by_ids(conflicting_courses))
     
-    if conflict_overlaps:
-        print("✓ Conflict detection working!")
-        for overlap in conflict_overlaps:
-            print(f"  Conflict: {overlap['course1']['course_id']} overlaps with {overlap['course2']['course_id']}")
-    else:
-        print("No conflicts detected (may need to check course times)")
+    assert conflict_overlaps, "the sample data contains overlapping sessions"
+    print("✓ Conflict detection working!")
+    for overlap in conflict_overlaps:
+        print(f"  Conflict: {overlap['course1']['course_id']} overlaps with {overlap['course2']['course_id']}")
     
     print("\n=== Test Complete ===")
     print("The Course Schedule Manager is ready for deployment!")
 
+def test_course_index():
+    """Course lists are served from the index built at load time"""
+    scheduler = CourseScheduler()
+    courses = scheduler.get_all_courses()
+    assert len(courses) == len(scheduler.courses_info_df)
+
+    # Sorted by first session, courses without sessions last
+    keys = [c['first_session_datetime'] for c in courses if c['first_session_datetime']]
+    assert keys == sorted(keys)
+
+    for program in scheduler.get_programs():
+        filtered = scheduler.get_courses_by_program(program)
+        assert filtered == [c for c in courses if c['program'] == program]
+
+    course_id = courses[0]['course_id']
+    sessions = scheduler.course_sessions_df[scheduler.course_sessions_df['course_id'] == course_id]
+    first = scheduler.get_first_session(course_id)
+    assert first['datetime'] == sessions['start_datetime'].min()
+    assert scheduler.get_first_session('NO_SUCH_COURSE') is None
+
+def test_reload_swaps_data(tmp_path):
+    """Changed CSVs are picked up once they stop changing, broken ones are ignored"""
+    import shutil
+    courses_info = tmp_path / 'courses_info.csv'
+    course_sessions = tmp_path / 'course_sessions.csv'
+    shutil.copy('courses_info.csv', courses_info)
+    shutil.copy('course_sessions.csv', course_sessions)
+    scheduler = CourseScheduler(str(courses_info), str(course_sessions), reload_trigger=str(tmp_path / 'trigger'))
+    old_index = scheduler.index
+    old_count = len(scheduler.get_all_courses())
+
+    with open(courses_info, 'a') as f:
+        f.write('\nNEW101,New Course,Prof. New,Elective Courses,Online\n')
+    assert not scheduler.check_for_changes()  # waits one poll for writes to settle
+    assert scheduler.check_for_changes()
+    assert scheduler.index is not old_index
+    assert scheduler.data_version != old_index.version
+    assert len(scheduler.get_all_courses()) == old_count + 1
+    assert len(old_index.sorted_courses) == old_count  # in-flight readers keep their snapshot
+
+    with open(course_sessions, 'a') as f:
+        f.write('\nNEW101,not-a-date,9:00,10:00\n')
+    version = scheduler.data_version
+    scheduler.check_for_changes()
+    assert not scheduler.check_for_changes()
+    assert scheduler.data_version == version
+    assert scheduler.reload_status()['last_error']
+
+    scheduler.request_reload()
+    assert (tmp_path / 'trigger').exists()
+
+def test_snapshot_round_trip(tmp_path):
+    """A fresh snapshot is mapped instead of parsing the CSVs; a stale one is rebuilt"""
+    import shutil
+    courses_info = tmp_path / 'courses_info.csv'
+    course_sessions = tmp_path / 'course_sessions.csv'
+    snapshot = tmp_path / 'course_data.snapshot'
+    shutil.copy('courses_info.csv', courses_info)
+    shutil.copy('course_sessions.csv', course_sessions)
+
+    from_csv = CourseScheduler(str(courses_info), str(course_sessions), snapshot=str(snapshot))
+    assert snapshot.exists()
+    from_snapshot = CourseScheduler(str(courses_info), str(course_sessions), snapshot=str(snapshot))
+    assert not from_snapshot.index.session_columns.start.flags.writeable  # read-only mapping
+    assert from_snapshot.data_version == from_csv.data_version
+    assert from_snapshot.get_all_courses() == from_csv.get_all_courses()
+    selection = [course['course_id'] for course in from_csv.get_all_courses()[:6]]
+    assert from_snapshot.get_calendar(selection) == from_csv.get_calendar(selection)
+
+    # Edited CSVs win over the old snapshot, which is then recompiled
+    with open(courses_info, 'a') as f:
+        f.write('\nNEW101,New Course,Prof. New,Elective Courses,Online\n')
+    edited = CourseScheduler(str(courses_info), str(course_sessions), snapshot=str(snapshot))
+    assert edited.data_version != from_csv.data_version
+    assert edited.index.session_columns.start.flags.writeable
+    assert CourseScheduler(str(courses_info), str(course_sessions), snapshot=str(snapshot)).data_version == edited.data_version
+
+    # Without the CSVs the snapshot is served as is
+    courses_info.unlink()
+    course_sessions.unlink()
+    assert CourseScheduler(str(courses_info), str(course_sessions), snapshot=str(snapshot)).data_version == edited.data_version
+
 if __name__ == "__main__":
     test_course_scheduler()
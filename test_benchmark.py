@@ -0,0 +1,39 @@
+"""
+Smoke test for the benchmark suite on a tiny synthetic catalogue
+"""
+
+import json
+import sys
+import os
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+
+import benchmark
+from app import CourseScheduler
+
+def test_generator_is_deterministic(tmp_path):
+    first = benchmark.generate_catalogue(tmp_path / 'a', courses=60, sessions_per_course=8, density=0.2, seed=1)
+    second = benchmark.generate_catalogue(tmp_path / 'b', courses=60, sessions_per_course=8, density=0.2, seed=1)
+    for path_a, path_b in zip(first, second):
+        assert open(path_a).read() == open(path_b).read()
+
+    scheduler = CourseScheduler(*first)
+    assert len(scheduler.get_all_courses()) == 60
+    assert len(scheduler.index.session_columns) == 60 * 8
+    matrix = scheduler.get_conflict_matrix()
+    density = 2 * len(matrix.pairs) / (60 * 59)
+    assert 0.1 < density < 0.3
+
+def test_benchmark_results_compare(tmp_path):
+    output = tmp_path / 'results.json'
+    args = ['--courses', '40', '--sessions-per-course', '5', '--repeat', '1', '--data-dir', str(tmp_path / 'data')]
+    assert benchmark.main(args + ['--output', str(output)]) == 0
+    results = json.loads(output.read_text())
+    assert results['data']['courses'] == 40
+    assert {'load_csv', 'find_overlapping_courses', 'http_calendar'} <= set(results['results'])
+    assert all(timing['median_ms'] >= 0 for timing in results['results'].values())
+
+    # Everything 10x faster in the baseline counts as a regression
+    for timing in results['results'].values():
+        timing['median_ms'] /= 10
+    output.write_text(json.dumps(results))
+    assert benchmark.main(args + ['--compare', str(output)]) == 1
@@ -3,6 +3,7 @@
 Quick test script to verify calendar functionality
 """
 
+import re
 import sys
 import os
 sys.path.append(os.path.dirname(os.path.abspath(__file__)))
@@ -11,36 +12,477 @@ from app import scheduler
 
 def test_calendar_events():
     print("=== Testing Calendar Events Generation ===\n")
+    weekdays = {'Monday', 'Tuesday', 'Wednesday', 'Thursday', 'Friday', 'Saturday', 'Sunday'}
+    matrix = scheduler.get_conflict_matrix()
+    first = next(course_id for course_id in matrix.course_ids if matrix.conflicts_of(course_id))
+    second = matrix.conflicts_of(first)[0]
     
     # Test with a single course
-    print("1. Testing CS101 (Monday, Wednesday, Friday):")
-    events = scheduler.get_calendar_events(['CS101'])
+    print(f"1. Testing {first}:")
+    events = scheduler.get_calendar_events([first])
     for event in events:
-        print(f"   {event['day']}: {event['start_time']}-{event['end_time']} - {event['id']}")
+        print(f"   {event['date']} {event['day']}: {event['start_time']}-{event['end_time']} - {event['id']}")
     print(f"   Total events: {len(events)}")
+    assert events and all(event['id'] == first and event['day'] in weekdays for event in events)
     
-    print("\n2. Testing CS102 (Tuesday, Thursday):")
-    events = scheduler.get_calendar_events(['CS102'])
-    for event in events:
-        print(f"   {event['day']}: {event['start_time']}-{event['end_time']} - {event['id']}")
-    print(f"   Total events: {len(events)}")
+    print(f"\n2. Testing {second}:")
+    second_events = scheduler.get_calendar_events([second])
+    for event in second_events:
+        print(f"   {event['date']} {event['day']}: {event['start_time']}-{event['end_time']} - {event['id']}")
+    print(f"   Total events: {len(second_events)}")
+    assert second_events
     
-    print("\n3. Testing multiple courses (CS101, CS102):")
-    events = scheduler.get_calendar_events(['CS101', 'CS102'])
-    for event in events:
-        print(f"   {event['day']}: {event['start_time']}-{event['end_time']} - {event['id']}")
-    print(f"   Total events: {len(events)}")
+    print(f"\n3. Testing multiple courses ({first}, {second}):")
+    both = scheduler.get_calendar_events([first, second])
+    print(f"   Total events: {len(both)}")
+    assert len(both) == len(events) + len(second_events)
     
     print("\n4. Testing overlap detection:")
-    courses = scheduler.courses_df[scheduler.courses_df['course_id'].isin(['CS101', 'PHYS101'])]
-    overlaps = scheduler.find_overlapping_courses(courses.to_dict('records'))
-    if overlaps:
-        for overlap in overlaps:
-            print(f"   Conflict: {overlap['course1']['course_id']} vs {overlap['course2']['course_id']}")
-    else:
-        print("   No conflicts detected")
+    overlaps = scheduler.find_overlapping_courses(scheduler.get_courses_by_ids([first, second]))
+    for overlap in overlaps:
+        print(f"   Conflict: {overlap['course1']['course_id']} vs {overlap['course2']['course_id']}")
+    assert len(overlaps) == 1
     
     print("\n=== Test Complete ===")
 
+def test_overlap_engine_matches_pairwise_check():
+    """The sweep engine reports the same conflicts as a direct pairwise comparison"""
+    courses = scheduler.get_courses_by_ids(scheduler.courses_info_df['course_id'])
+    sessions = scheduler.course_sessions_df
+
+    position = {course['course_id']: i for i, course in enumerate(courses)}
+    pairs = sessions.merge(sessions, on='date')
+    pairs = pairs[(pairs['start_datetime_x'] < pairs['end_datetime_y']) &
+                  (pairs['start_datetime_y'] < pairs['end_datetime_x']) &
+                  (pairs['course_id_x'].map(position) < pairs['course_id_y'].map(position))]
+    counts = pairs.groupby(['course_id_x', 'course_id_y']).size()
+    expected = sorted(((a, b, n) for (a, b), n in counts.items()),
+                      key=lambda t: (position[t[0]], position[t[1]]))
+
+    overlaps = scheduler.find_overlapping_courses(courses)
+    found = [(o['course1']['course_id'], o['course2']['course_id'], len(o['conflicts'])) for o in overlaps]
+    assert found == expected
+    assert found, "sample data is expected to contain conflicts"
+
+def test_conflict_matrix_matches_session_scan():
+    """Matrix lookups give the same overlaps as sweeping the selected sessions"""
+    import random
+    index = scheduler.index
+    courses = scheduler.get_all_courses()
+    matrix = scheduler.get_conflict_matrix()
+    rng = random.Random(11)
+    for size in (2, 3, 5, 8, 20, len(courses)):
+        selection = rng.sample(courses, size)
+        assert index.find_overlapping_courses(selection) == index.scan_overlapping_courses(selection)
+        ids = [course['course_id'] for course in selection]
+        assert matrix.has_conflicts(ids) == bool(index.scan_overlapping_courses(selection))
+
+    for course_id in matrix.course_ids:
+        for other in matrix.conflicts_of(course_id):
+            assert matrix.conflicts(other, course_id)
+
+def test_conflicts_api():
+    from app import app
+    client = app.test_client()
+    data = client.get('/api/conflicts').get_json()
+    code = next(i for i, row in enumerate(data['matrix']) if row != '0')
+    course_id = data['courses'][code]
+    mask = int(data['matrix'][code], 16)
+    expected = [other for j, other in enumerate(data['courses']) if mask >> j & 1]
+
+    detail = client.get('/api/conflicts', query_string={'course': course_id}).get_json()
+    assert sorted(item['course']['course_id'] for item in detail['conflicts']) == sorted(expected)
+    assert all(item['conflicts'] for item in detail['conflicts'])
+    assert client.get('/api/conflicts', query_string={'course': 'NOPE999'}).status_code == 404
+
+def test_schedule_search_matches_brute_force():
+    """The best schedules are the largest maximal conflict-free subsets"""
+    import itertools
+    import random
+    from app import search_schedules
+    matrix = scheduler.get_conflict_matrix()
+    conflicting = [course_id for course_id in matrix.course_ids if matrix.conflicts_of(course_id)]
+    rng = random.Random(7)
+    for _ in range(15):
+        wishlist = rng.sample(conflicting, 10)
+        must_have = wishlist[:1]
+        free = lambda subset: not any(matrix.conflicts(a, b) for a, b in itertools.combinations(subset, 2))
+        maximal = []
+        for size in range(len(wishlist), 0, -1):
+            for subset in itertools.combinations(wishlist, size):
+                if must_have[0] in subset and free(subset) and not any(
+                        free(subset + (other,)) for other in wishlist if other not in subset):
+                    maximal.append(len(subset))
+
+        result = search_schedules(matrix, wishlist, must_have, limit=3, time_budget=5)
+        assert result['complete']
+        assert [s['count'] for s in result['schedules']] == maximal[:3]
+        for schedule in result['schedules']:
+            assert must_have[0] in schedule['courses'] and free(tuple(schedule['courses']))
+
+def test_schedules_api(monkeypatch):
+    from app import app
+    client = app.test_client()
+    matrix = scheduler.get_conflict_matrix()
+    course_id = next(c for c in matrix.course_ids if matrix.conflicts_of(c))
+    other = matrix.conflicts_of(course_id)[0]
+
+    result = client.get('/api/schedules', query_string={'courses': [course_id, other, 'NOPE999']}).get_json()
+    assert [s['count'] for s in result['schedules']] == [1, 1]
+    assert result['unknown'] == ['NOPE999']
+    response = client.get('/api/schedules', query_string={'courses': [course_id, other], 'must': [course_id, other]})
+    assert response.status_code == 400
+
+    # A search cut short by the time budget is neither cached nor given an ETag
+    partial = {'schedules': [], 'complete': False, 'nodes': 256, 'without_sessions': [], 'unknown': []}
+    monkeypatch.setattr(scheduler, 'find_schedules', lambda *args: partial)
+    query = {'courses': [course_id, 'PARTIAL1']}
+    response = client.get('/api/schedules', query_string=query)
+    assert response.get_json() == partial
+    assert 'ETag' not in response.headers and response.headers['Cache-Control'] == 'no-store'
+    monkeypatch.setattr(scheduler, 'find_schedules', lambda *args: dict(partial, complete=True))
+    assert client.get('/api/schedules', query_string=query).get_json()['complete']
+
+def test_calendar_batch_matches_single_calls():
+    """Every batch line equals the /api/calendar answer, in request order, serial or pooled"""
+    import json
+    import random
+    from app import app
+    client = app.test_client()
+    course_ids = [course['course_id'] for course in scheduler.get_all_courses()]
+    rng = random.Random(3)
+    selections = [rng.sample(course_ids, rng.randint(0, 6)) for _ in range(40)]
+    selections += selections[:10]  # duplicates are computed once but still answered
+    items = [{'id': f'student-{i}', 'courses': courses} for i, courses in enumerate(selections)]
+
+    for parallel_min in (1000, 1):
+        app.config['BATCH_CALENDAR_PARALLEL_MIN'] = parallel_min
+        response = client.post('/api/calendar/batch', json={'selections': items})
+        assert response.mimetype == 'application/x-ndjson'
+        lines = [json.loads(line) for line in response.get_data(as_text=True).splitlines()]
+        assert [line['id'] for line in lines] == [item['id'] for item in items]
+        for line, courses in zip(lines, selections):
+            assert line['calendar'] == client.get('/api/calendar', query_string={'courses': courses}).get_json()
+    app.config['BATCH_CALENDAR_PARALLEL_MIN'] = 32
+
+    response = client.post('/api/calendar/batch', json={'selections': selections[:5], 'summary': True})
+    for position, line in enumerate(response.get_data(as_text=True).splitlines()):
+        summary = json.loads(line)
+        calendar = scheduler.get_calendar(selections[position])
+        assert summary['id'] == position
+        assert summary['summary']['events'] == len(calendar['events'])
+        assert summary['summary']['overlaps'] == len(calendar['overlaps'])
+
+    assert client.post('/api/calendar/batch', json={'selections': 'PMBA6013'}).status_code == 400
+    assert client.post('/api/calendar/batch', json=[[1, 2]]).status_code == 400
+
+def test_calendar_window_and_pages():
+    """A date window keeps only its sessions and conflicts; pages add up to the window"""
+    from app import app
+    client = app.test_client()
+    course_ids = [course['course_id'] for course in scheduler.get_all_courses()]
+    full = client.get('/api/calendar', query_string={'courses': course_ids}).get_json()
+    dates = sorted({event['date'] for event in full['events']})
+    start, end = dates[len(dates) // 3], dates[len(dates) // 2]
+
+    windowed = client.get('/api/calendar', query_string={'courses': course_ids, 'start': start, 'end': end}).get_json()
+    assert windowed['events'] == [e for e in full['events'] if start <= e['date'] <= end]
+    expected = []
+    for overlap in full['overlaps']:
+        conflicts = [c for c in overlap['conflicts'] if start <= c['date'] <= end]
+        if conflicts:
+            expected.append(dict(overlap, conflicts=conflicts))
+    assert windowed['overlaps'] == expected
+    aliases = client.get('/api/calendar', query_string={'courses': course_ids, 'start_date': start, 'end_date': end})
+    assert aliases.get_json() == windowed
+
+    events, cursor, pages = [], None, 0
+    while True:
+        query = {'courses': course_ids, 'start': start, 'end': end, 'limit': 7}
+        if cursor:
+            query['cursor'] = cursor
+        page = client.get('/api/calendar', query_string=query).get_json()
+        assert page['overlaps'] == (windowed['overlaps'] if pages == 0 else [])
+        events += page['events']
+        pages += 1
+        cursor = page['next_cursor']
+        if cursor is None:
+            break
+    assert events == windowed['events'] and pages == -(-len(events) // 7)
+
+    assert client.get('/api/calendar', query_string={'courses': course_ids, 'cursor': 'old.7'}).status_code == 400
+    assert client.get('/api/calendar', query_string={'courses': course_ids, 'start': 'someday'}).status_code == 400
+
+def test_calendar_delta_replays_to_full_calendar():
+    """Applying deltas toggle by toggle gives the same calendar as a full request"""
+    import json
+    import random
+    from app import app
+    client = app.test_client()
+    course_ids = [course['course_id'] for course in scheduler.get_all_courses()]
+    key = lambda item: json.dumps(item, sort_keys=True)
+    rng = random.Random(5)
+
+    for window in ({}, {'start': '2025-09-01', 'end': '2025-10-31'}):
+        selection = rng.sample(course_ids, 5)
+        response = client.get('/api/calendar', query_string={'courses': selection, **window})
+        version = response.headers['X-Selection-Version']
+        events, overlaps = response.get_json()['events'], response.get_json()['overlaps']
+        for _ in range(12):
+            added = rng.sample([c for c in course_ids if c not in selection], rng.randint(0, 2))
+            removed = rng.sample(selection, min(len(selection), rng.randint(0, 2)))
+            delta = client.get('/api/calendar/delta', query_string={
+                'courses': selection, 'version': version, 'add': added, 'remove': removed, **window
+            }).get_json()
+            dropped = set(delta['removed'])
+            events = [e for e in events if e['id'] not in dropped] + delta['add_events']
+            overlaps = [o for o in overlaps
+                        if [o['course1']['course_id'], o['course2']['course_id']] not in delta['remove_overlaps']]
+            overlaps += delta['add_overlaps']
+            selection = sorted((set(selection) - dropped) | set(delta['added']))
+            version = delta['version']
+
+            full = client.get('/api/calendar', query_string={'courses': selection, **window})
+            assert full.headers['X-Selection-Version'] == version
+            assert sorted(map(key, events)) == sorted(map(key, full.get_json()['events']))
+            assert sorted(map(key, overlaps)) == sorted(map(key, full.get_json()['overlaps']))
+
+    stale = client.get('/api/calendar/delta', query_string={'courses': selection, 'version': 'stale', 'add': course_ids[0]})
+    assert stale.status_code == 409
+
+def test_ics_export():
+    """The .ics export has one VEVENT per session and supports conditional requests"""
+    from app import app
+    client = app.test_client()
+    response = client.get('/api/export.ics?courses=PMBA6003&courses=PMBA2963')
+    assert response.status_code == 200
+    assert response.mimetype == 'text/calendar'
+    body = response.get_data(as_text=True)
+    assert body.startswith('BEGIN:VCALENDAR\r\n') and body.endswith('END:VCALENDAR\r\n')
+    sessions = scheduler.course_sessions_df
+    expected = sessions['course_id'].isin(['PMBA6003', 'PMBA2963']).sum()
+    assert body.count('BEGIN:VEVENT') == expected
+    assert all(len(line.encode('utf-8')) <= 75 for line in body.split('\r\n'))
+    # RFC 5545: every VEVENT has a UTC DTSTAMP and every TZID is defined by a VTIMEZONE
+    assert len(re.findall(r'\r\nDTSTAMP:\d{8}T\d{6}Z\r\n', body)) == expected
+    assert 'BEGIN:VTIMEZONE\r\nTZID:Asia/Shanghai\r\n' in body
+    assert 'must-revalidate' in response.headers['Cache-Control']
+
+    cached = client.get('/api/export.ics?courses=PMBA2963&courses=PMBA6003',
+                        headers={'If-None-Match': response.headers['ETag']})
+    assert cached.status_code == 304
+    assert cached.headers['Cache-Control'] == response.headers['Cache-Control']
+
+def test_calendar_http_caching():
+    """Read APIs answer repeat requests with 304 and serve pre-compressed gzip"""
+    import gzip
+    import json
+    from app import app
+    client = app.test_client()
+    url = '/api/calendar?courses=PMBA6003&courses=PMBA2963'
+    first = client.get(url)
+    assert first.status_code == 200
+    assert 'must-revalidate' in first.headers['Cache-Control']
+
+    # Same selection in another order maps to the same representation
+    repeat = client.get('/api/calendar?courses=PMBA2963&courses=PMBA6003',
+                        headers={'If-None-Match': first.headers['ETag']})
+    assert repeat.status_code == 304
+    assert repeat.get_data() == b''
+
+    # Another worker (or an evicted entry) revalidates without building the body,
+    # and still logs the same activity details
+    from app import log_writer, response_cache, UserActivity
+    response_cache.clear()
+    repeat = client.get(url, headers={'If-None-Match': first.headers['ETag']})
+    assert repeat.status_code == 304
+    assert response_cache.stats()['size'] == 0
+    assert log_writer.flush()
+    with app.app_context():
+        details = json.loads(UserActivity.query.filter_by(activity_type='course_selection')
+                             .order_by(UserActivity.id.desc()).first().details)
+    assert details['has_overlaps'] == bool(first.get_json()['overlaps'])
+
+    compressed = client.get(url, headers={'Accept-Encoding': 'gzip'})
+    assert compressed.headers['Content-Encoding'] == 'gzip'
+    assert compressed.headers['ETag'] != first.headers['ETag']
+    assert json.loads(gzip.decompress(compressed.get_data())) == first.get_json()
+
+def test_has_overlaps_matches_calendar():
+    """The conflict matrix answers has_overlaps like a full calendar build"""
+    import random
+    from app import parse_calendar_window
+    course_ids = [course['course_id'] for course in scheduler.get_all_courses()]
+    rng = random.Random(11)
+    windows = [None, parse_calendar_window({'start': '2025-10-01', 'end': '2026-01-31'})]
+    for _ in range(60):
+        selection = sorted(set(rng.sample(course_ids, rng.randint(0, 6))))
+        for window in windows:
+            expected = bool(scheduler.get_calendar(selection, window)['overlaps'])
+            assert scheduler.has_overlaps(selection, window) == expected
+
+def test_calendar_memoized_per_selection():
+    """Repeated selections are served from the scheduler's LRU cache"""
+    from app import CourseScheduler
+    memo = CourseScheduler(calendar_cache_size=2)
+    first = memo.get_calendar(['PMBA6003', 'PMBA2963'])
+    assert memo.get_calendar(['PMBA2963', 'PMBA6003', 'PMBA6003']) is first
+    assert first['events'] == scheduler.get_calendar_events(['PMBA6003', 'PMBA2963'])
+
+    memo.get_calendar(['PMBA6003'])
+    memo.get_calendar(['PMBA2963'])
+    stats = memo.calendar_cache.stats()
+    assert (stats['hits'], stats['misses'], stats['evictions'], stats['size']) == (1, 3, 1, 2)
+
+def test_room_occupancy_matches_minute_scan():
+    """Occupancy figures agree with filling one 1440-minute array per location and date"""
+    import numpy as np
+    from app import UNASSIGNED_LOCATIONS
+    index = scheduler.index
+    occupancy = scheduler.get_room_occupancy()
+    timelines = {}
+    for row in index.course_sessions_df.itertuples():
+        location = index.course_by_id[row.course_id]['location']
+        if location.strip().lower() in UNASSIGNED_LOCATIONS or row.end_datetime <= row.start_datetime:
+            continue
+        start = row.start_datetime.hour * 60 + row.start_datetime.minute
+        end = min(start + int((row.end_datetime - row.start_datetime).total_seconds()) // 60, 1440)
+        timeline = timelines.setdefault((location, row.start_datetime.date()), np.zeros(1440, dtype=int))
+        timeline[start:end] += 1
+
+    report = occupancy.to_dict(limit=1000)
+    clashes = 0
+    for summary in report['locations']:
+        days = {day: timeline for (location, day), timeline in timelines.items() if location == summary['location']}
+        assert summary['days'] == len(days)
+        assert summary['occupied_minutes'] == sum(int((t > 0).sum()) for t in days.values())
+        assert summary['double_booked_minutes'] == sum(int((t > 1).sum()) for t in days.values())
+        assert summary['peak_concurrent'] == max(int(t.max()) for t in days.values())
+        weekday_minutes = {name: sum(int((t[hour * 60:hour * 60 + 60] > 0).sum())
+                                     for day, t in days.items() if day.weekday() == weekday
+                                     for hour in range(*occupancy.hours))
+                           for weekday, name in enumerate(('Monday', 'Tuesday', 'Wednesday', 'Thursday',
+                                                           'Friday', 'Saturday', 'Sunday'))}
+        for name, minutes in weekday_minutes.items():
+            heat = summary['heatmap'][name]
+            occurrences = occupancy.weekday_counts()[list(weekday_minutes).index(name)]
+            assert abs(sum(heat) * occurrences * 60 - minutes) < len(heat) * occurrences * 60 * 1e-4
+        clashes += sum(int(np.count_nonzero(np.diff(np.concatenate(([0], (t > 1).astype(int), [0]))) == 1))
+                       for t in days.values())
+    assert report['clash_count'] == clashes
+    assert clashes, "sample data is expected to contain double-booked rooms"
+    for clash in report['clashes']:
+        assert len(clash['courses']) >= 2 or clash['concurrent'] >= 2
+
+def test_rooms_api_and_cli():
+    from app import app
+    client = app.test_client()
+    response = client.get('/admin/rooms?limit=1')
+    assert response.headers['Cache-Control'] == 'private, no-store'
+    data = response.get_json()
+    assert data['clash_count'] >= len(data['clashes']) == 1
+    location = data['clashes'][0]['location']
+    single = client.get('/admin/rooms', query_string={'location': location}).get_json()
+    assert [row['location'] for row in single['locations']] == [location]
+    assert all(clash['location'] == location for clash in single['clashes'])
+    assert client.get('/admin/rooms?location=Nowhere').status_code == 404
+
+    result = app.test_cli_runner().invoke(args=['room-report', '--limit', '1'])
+    assert result.exit_code == 0
+    assert f"{data['clash_count']} double bookings" in result.output
+
+def test_course_search_matches_prefix_scan():
+    """Every result has a word starting with each query term, best fields first"""
+    import re
+    from app import app
+    courses = scheduler.get_all_courses()
+    fields = ('course_id', 'course_name', 'instructor', 'program', 'location')
+    words = lambda course: {word for field in fields for text in re.findall(r'[a-z0-9]+', str(course.get(field) or '').lower())
+                            for word in [text, *re.findall(r'[a-z]+|[0-9]+', text)]}
+    client = app.test_client()
+    for query in ['fin', 'Strat', 'pmba 60', '6013', 'MANAGERIAL econ']:
+        terms = query.lower().split()
+        expected = [course['course_id'] for course in courses
+                    if all(any(word.startswith(term) for word in words(course)) for term in terms)]
+        data = client.get('/api/search', query_string={'q': query, 'limit': 50}).get_json()
+        assert not data['fuzzy'] and data['total'] == len(expected) > 0
+        assert sorted(result['course_id'] for result in data['results']) == sorted(expected[:50])
+        scores = [result['score'] for result in data['results']]
+        assert scores == sorted(scores, reverse=True)
+
+    exact = client.get('/api/search?q=PMBA6013').get_json()['results']
+    assert exact[0]['course_id'] == 'PMBA6013'
+    program = courses[0]['program']
+    filtered = client.get('/api/search', query_string={'q': 'pmba', 'program': program, 'limit': 50}).get_json()
+    assert filtered['total'] == sum(course['program'] == program and 'pmba' in course['course_id'].lower()
+                                    for course in courses)
+    assert all(result['program'] == program for result in filtered['results'])
+
+    typo = client.get('/api/search?q=finanse').get_json()
+    assert typo['fuzzy'] and any('Finance' in result['course_name'] for result in typo['results'])
+    assert client.get('/api/search?q=zzzzqqqq').get_json()['results'] == []
+    assert client.get('/api/search?q=fin&limit=x').status_code == 400
+
+def test_terms_load_lazily_and_evict_least_recently_used(tmp_path, monkeypatch):
+    import shutil
+    import app as app_module
+    from app import app, CourseDatasets
+    terms = tmp_path / 'terms'
+    for name in ('fall', 'spring', 'summer'):
+        (terms / name).mkdir(parents=True)
+        shutil.copy('course_sessions.csv', terms / name / 'course_sessions.csv')
+    with open('courses_info.csv') as f:
+        lines = f.readlines()
+    (terms / 'fall' / 'courses_info.csv').write_text(''.join(lines[:11]))
+    shutil.copy('courses_info.csv', terms / 'spring' / 'courses_info.csv')
+    shutil.copy('courses_info.csv', terms / 'summer' / 'courses_info.csv')
+    datasets = CourseDatasets(scheduler, terms_dir=str(terms), max_resident=3, snapshot_dir=str(tmp_path))
+    monkeypatch.setattr(app_module, 'datasets', datasets)
+    client = app.test_client()
+
+    assert client.get('/api/terms').get_json()['terms'] == ['current', 'fall', 'spring', 'summer']
+    assert datasets.resident == {}
+    fall = client.get('/api/courses?program=All&term=fall')
+    assert len(fall.get_json()) == 10 < len(client.get('/api/courses?program=All').get_json())
+    assert len(client.get('/api/courses?program=All&term=current').get_json()) == len(scheduler.get_all_courses())
+    assert client.get('/api/courses?term=winter').status_code == 404
+    assert client.get('/api/courses?term=../terms/fall').status_code == 404
+    # Selection analytics only cover the default term
+    from app import log_writer, CourseSelection
+    assert log_writer.flush()
+    with app.app_context():
+        selections = CourseSelection.query.count()
+    fall_ids = [course['course_id'] for course in fall.get_json()[:2]]
+    assert client.get('/api/calendar', query_string={'courses': fall_ids, 'term': 'fall'}).status_code == 200
+    assert log_writer.flush()
+    with app.app_context():
+        assert CourseSelection.query.count() == selections
+    # Only course data views take a term
+    assert client.get('/stats/cache?term=winter').status_code == 200
+    assert client.get('/metrics?term=winter').status_code == 200
+
+    # Default plus two terms fit; a third evicts the least recently used one
+    client.get('/api/programs?term=spring')
+    client.get('/api/programs?term=fall')
+    client.get('/api/programs?term=summer')
+    assert list(datasets.resident) == ['fall', 'summer']
+    status = {term['term']: term for term in client.get('/admin/datasets').get_json()['terms']}
+    assert status['spring']['resident'] is False and status['spring']['evictions'] == 1
+    assert status['fall']['loads'] == 1 and status['fall']['courses'] == 10
+    assert status['summer']['load_seconds'] > 0 and status['summer']['memory']['heap_bytes'] > 0
+    assert status['current']['resident'] and status['current']['default']
+
+    # Resident terms are checked for changes by the watcher thread, never on the request path
+    checks = []
+    monkeypatch.setattr(app_module.CourseScheduler, 'check_for_changes', lambda self: checks.append(self))
+    assert client.get('/api/programs?term=fall').status_code == 200
+    assert checks == []
+
+    # Over the memory budget only the term just loaded stays
+    datasets.memory_budget = 1
+    client.get('/api/programs?term=spring')
+    assert list(datasets.resident) == ['spring']
+    assert datasets.status()['terms'][datasets.names().index('spring')]['loads'] == 2
+
 if __name__ == "__main__":
     test_calendar_events()
@@ -0,0 +1,436 @@
+"""
+Tests for request and activity logging
+"""
+
+import csv
+import gzip
+import io
+import json
+import time
+from datetime import datetime, timedelta
+import queue
+import sys
+from sqlalchemy import func
+import os
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+
+from app import (app, db, scheduler, log_writer, latency_metrics, live_stats, request_profiler, ingest_policy,
+                 read_archive, IngestPolicy, LatencyHistogram, LatencyMetrics, LogRetention, LogWriter, NULL_SPAN,
+                 RequestCount, RequestLog, RequestProfiler, RequestRollup, TrafficCounter, UserActivity, UserAgent)
+
+def test_requests_logged_in_background():
+    client = app.test_client()
+    assert log_writer.flush()
+    with app.app_context():
+        requests_before = RequestLog.query.count()
+        activities_before = UserActivity.query.count()
+
+    client.get('/api/programs')
+    client.get('/api/courses?program=All')
+    assert log_writer.flush()
+
+    with app.app_context():
+        assert RequestLog.query.count() == requests_before + 2
+        assert UserActivity.query.count() == activities_before + 1
+        latest = UserActivity.query.order_by(UserActivity.id.desc()).first()
+        assert latest.activity_type == 'course_browsing'
+        assert latest.timestamp is not None
+
+def test_full_queue_drops_rows():
+    writer = LogWriter(app, max_queue=1, policy='drop')
+    writer._ensure_started = lambda: None  # no writer thread draining the queue
+    writer._queue = queue.Queue(maxsize=1)
+    for _ in range(3):
+        writer.submit(RequestLog, {'path': '/'})
+    assert writer.stats()['dropped'] == 2
+
+def test_commit_hooks_skip_rolled_back_batches():
+    writer = LogWriter(app)
+    committed = []
+    writer.add_commit_hook(lambda rows_by_model: committed.append(rows_by_model[RequestCount]))
+    writer.add_batch_hook(lambda rows_by_model: 1 / (len(rows_by_model[RequestCount]) - 1))
+    writer._write([(RequestCount, {'path': '/a'})])  # the batch hook fails, so the batch is rolled back
+    writer._write([(RequestCount, {'path': '/a'}), (RequestCount, {'path': '/b'})])
+    assert committed == [[{'path': '/a'}, {'path': '/b'}]]
+    assert (writer.failed, writer.written) == (1, 2)
+
+def test_summary_served_from_rollups():
+    client = app.test_client()
+    client.get('/api/programs')
+    client.get('/api/calendar?courses=PMBA6003&courses=PMBA2963')
+    assert log_writer.flush()
+
+    summary = client.get('/stats/summary').get_json()
+    with app.app_context():
+        assert summary['total_requests'] == RequestLog.query.count()
+        assert summary['user_activities']['total_activities'] == UserActivity.query.count()
+        selections = UserActivity.query.filter_by(activity_type='course_selection').count()
+    assert summary['user_activities']['course_selections'] == selections
+    assert sum(summary['methods'].values()) == summary['total_requests']
+
+def test_latency_histogram_percentiles():
+    histogram = LatencyHistogram()
+    for ms in range(1, 1001):
+        histogram.record(float(ms))
+    assert histogram.count == 1000
+    assert histogram.max == 1000.0
+    for q in (0.5, 0.9, 0.99):
+        assert abs(histogram.percentile(q) - q * 1000) <= q * 1000 * 0.125
+
+    other = LatencyHistogram()
+    other.record(5000.0)
+    histogram.merge(LatencyHistogram.from_dict(json.loads(json.dumps(other.to_dict()))))
+    assert histogram.count == 1001
+    assert histogram.percentile(1.0) == 5000.0
+
+def test_spool_files_of_exited_workers_are_folded(tmp_path):
+    import subprocess
+    exited = subprocess.Popen([sys.executable, '-c', 'pass'])
+    exited.wait()
+    metrics = LatencyMetrics(str(tmp_path))
+    metrics.record('/api/programs', 200, 10.0)
+    histogram = LatencyHistogram()
+    for ms in (20.0, 30.0):
+        histogram.record(ms)
+    for i in range(3):
+        snapshot = [{'route': '/api/programs', 'status': '2xx', 'histogram': histogram.to_dict()}]
+        (tmp_path / f"{exited.pid}-{i}.json").write_text(json.dumps(snapshot))
+
+    assert metrics.merged()[('/api/programs', '2xx')].count == 7
+    assert sorted(os.listdir(tmp_path)) == sorted(['compact.lock', 'retired.json', metrics._spool_name])
+    assert metrics.merged()[('/api/programs', '2xx')].count == 7
+
+    # A compaction that stopped before removing the files it absorbed is not counted twice
+    (tmp_path / f"{exited.pid}-0.json").write_text(json.dumps(snapshot))
+    retired = json.loads((tmp_path / 'retired.json').read_text())
+    (tmp_path / 'retired.json').write_text(json.dumps(dict(retired, absorbed=[f"{exited.pid}-0.json"])))
+    assert metrics.merged()[('/api/programs', '2xx')].count == 7
+    assert not (tmp_path / f"{exited.pid}-0.json").exists()
+
+def test_metrics_endpoint_reports_routes(tmp_path):
+    latency_metrics.spool_dir = str(tmp_path)
+    client = app.test_client()
+    client.get('/api/programs')
+    client.get('/no/such/page')
+
+    body = client.get('/metrics').get_data(as_text=True)
+    assert 'http_request_duration_ms_count{route="/api/programs",status="2xx"}' in body
+    assert 'route="unmatched",status="4xx",quantile="0.99"' in body
+    assert os.listdir(tmp_path)
+
+def test_profiling_captures_spans_and_stacks(tmp_path, monkeypatch):
+    monkeypatch.setattr(request_profiler, 'directory', str(tmp_path))
+    monkeypatch.setattr(request_profiler, 'keep', 3)
+    client = app.test_client()
+    local = {'REMOTE_ADDR': '127.0.0.1'}
+    query = {'courses': ['PMBA6013', 'PMBA6127'], 'start': '2025-01-01'}
+
+    # Off by default: nothing is watched or written
+    assert 'X-Profile-Id' not in client.get('/api/courses', query_string={'program': 'Core Courses'}).headers
+    assert request_profiler.list() == []
+
+    response = client.get('/api/calendar', query_string=query, headers={'X-Profile': '1'}, environ_base=local)
+    response.close()  # captures are written once the response is closed
+    name = response.headers['X-Profile-Id']
+    meta = client.get(f'/admin/profiles/{name}', query_string={'format': 'json'}, environ_base=local).get_json()
+    assert meta['trigger'] == 'admin' and meta['route'] == '/api/calendar'
+    assert {'build', 'overlap_detection', 'serialization', 'logging'} <= {span['name'] for span in meta['spans']}
+    folded = client.get(f'/admin/profiles/{name}', environ_base=local).get_data(as_text=True)
+    for line in folded.splitlines():
+        stack, count = line.rsplit(' ', 1)
+        assert stack and int(count) > 0
+
+    # Only admins can ask for a profile
+    monkeypatch.setitem(app.config, 'ADMIN_TOKEN', 'secret')
+    assert 'X-Profile-Id' not in client.get('/api/programs', headers={'X-Profile': '1'}).headers
+    monkeypatch.setitem(app.config, 'ADMIN_TOKEN', None)
+
+    # Slow capture keeps only requests over the threshold, and the ring stays bounded
+    monkeypatch.setattr(request_profiler, 'slow_ms', 60000)
+    assert 'X-Profile-Id' not in client.get('/api/programs').headers
+    monkeypatch.setattr(request_profiler, 'slow_ms', 0.001)
+    for _ in range(4):
+        response = client.get('/api/programs')
+        response.close()
+        assert response.headers['X-Profile-Id']
+    monkeypatch.setattr(request_profiler, 'slow_ms', 0)
+    profiles = client.get('/admin/profiles', environ_base=local).get_json()['profiles']
+    assert len(profiles) == 3 and all(p['trigger'] == 'slow' for p in profiles)
+    assert client.get('/admin/profiles/nope', environ_base=local).status_code == 404
+
+def test_slow_trigger_samples_only_requests_past_part_of_the_threshold(tmp_path):
+    profiler = RequestProfiler(str(tmp_path), slow_ms=100, interval_ms=1)
+    fast = profiler.begin('slow')
+    assert profiler.end() is fast and not fast.samples
+
+    slow = profiler.begin('slow')
+    with profiler.span('build'):
+        assert slow.thread_id not in profiler._watched
+        time.sleep(0.15)
+        assert profiler._watched[slow.thread_id] is slow
+    assert profiler.end() is slow
+    assert slow.samples and [span['name'] for span in slow.spans] == ['build']
+    assert profiler._watched == {} and profiler.span('idle') is NULL_SPAN
+
+def test_course_selection_analytics():
+    client = app.test_client()
+    matrix = scheduler.get_conflict_matrix()
+    course1 = next(c for c in matrix.course_ids if matrix.conflicts_of(c))
+    course2 = matrix.conflicts_of(course1)[0]
+    course3 = next(c for c in matrix.course_ids if c not in (course1, course2)
+                   and not matrix.conflicts(c, course1) and not matrix.conflicts(c, course2))
+
+    def stats(course_id, activity_type='course_selection'):
+        assert log_writer.flush()
+        data = client.get(f'/stats/courses/{course_id}?type={activity_type}&k=100').get_json()
+        return data, {row['course_id']: row['count'] for row in data['co_selected']}
+
+    before1, co_before1 = stats(course1)
+    before3, co_before3 = stats(course3)
+    export_before, _ = stats(course3, 'calendar_export')
+
+    client.get(f'/api/calendar?courses={course1}&courses={course2}&courses={course3}')
+    client.get(f'/api/export.ics?courses={course3}')
+
+    after1, co_after1 = stats(course1)
+    after3, co_after3 = stats(course3)
+    export_after, _ = stats(course3, 'calendar_export')
+    assert after1['count'] == before1['count'] + 1
+    assert after1['conflict_count'] == before1['conflict_count'] + 1
+    assert after3['count'] == before3['count'] + 1
+    assert after3['conflict_count'] == before3['conflict_count']
+    assert co_after1[course2] == co_before1.get(course2, 0) + 1
+    assert co_after3[course1] == co_before3.get(course1, 0) + 1
+    assert export_after['count'] == export_before['count'] + 1
+
+    top = client.get('/stats/courses?limit=500').get_json()['courses']
+    assert [row['count'] for row in top] == sorted((row['count'] for row in top), reverse=True)
+    assert course1 in {row['course_id'] for row in top}
+    assert client.get('/stats/courses?type=site_visit').status_code == 400
+
+def test_retention_archives_and_deletes_old_rows(tmp_path):
+    archive_dir = str(tmp_path / 'archive')
+    retention = LogRetention(app, archive_dir, raw_days=30, minute_rollup_days=7, chunk_rows=3,
+                             batch_size=2, pause=0, lock_path=str(tmp_path / 'retention.lock'))
+    old = datetime.utcnow() - timedelta(days=40)
+    assert log_writer.flush()
+    with app.app_context():
+        for i in range(7):
+            db.session.add(RequestLog(timestamp=old + timedelta(minutes=i), path=f'/old/{i}', method='GET'))
+        db.session.add(UserActivity(timestamp=old, activity_type='site_visit'))
+        for granularity in ('minute', 'hour'):
+            db.session.add(RequestRollup(granularity=granularity, bucket=old.replace(second=0, microsecond=0),
+                                         path='/old', method='GET', status_code=200, count=7))
+        recent = RequestLog(timestamp=datetime.utcnow(), path='/recent', method='GET')
+        db.session.add(recent)
+        db.session.commit()
+        old_ids = [row.id for row in RequestLog.query.filter(RequestLog.timestamp < old + timedelta(days=1))]
+        recent_id = recent.id
+
+    result = retention.run()
+    assert result['archived']['request_log'] == 7
+    assert result['archived']['user_activity'] == 1
+    assert result['deleted']['request_rollup'] == 1
+    assert len([name for name in result['files'] if name.startswith('request_log.')]) == 3
+
+    archived = list(read_archive(archive_dir, 'request_log'))
+    assert [row['id'] for row in archived] == old_ids
+    assert archived[0]['path'] == '/old/0'
+    assert [row['path'] for row in read_archive(archive_dir, 'request_log', since=old + timedelta(minutes=5))] == \
+        ['/old/5', '/old/6']
+    with app.app_context():
+        assert RequestLog.query.filter(RequestLog.id.in_(old_ids)).count() == 0
+        assert db.session.get(RequestLog, recent_id) is not None
+        assert RequestRollup.query.filter_by(path='/old').one().granularity == 'hour'
+
+    # A chunk written by an interrupted run is only deleted, not archived again
+    with app.app_context():
+        db.session.add(RequestLog(timestamp=old, path='/old/late', method='GET'))
+        db.session.commit()
+        late = RequestLog.query.filter_by(path='/old/late').one()
+        retention.write_chunk('request_log', [{'id': late.id, 'timestamp': late.timestamp, 'path': late.path}])
+    result = retention.run()
+    assert result['archived']['request_log'] == 0
+    assert result['deleted']['request_log'] == 1
+    assert [row['path'] for row in read_archive(archive_dir, 'request_log')].count('/old/late') == 1
+
+def test_retention_keeps_new_rows_reusing_archived_ids(tmp_path):
+    # Once a table is fully expired SQLite hands out the archived ids again
+    archive_dir = str(tmp_path / 'archive')
+    retention = LogRetention(app, archive_dir, raw_days=30, pause=0, lock_path=str(tmp_path / 'retention.lock'))
+    assert log_writer.flush()
+    with app.app_context():
+        old = UserActivity(timestamp=datetime.utcnow() - timedelta(days=40), activity_type='site_visit')
+        db.session.add(old)
+        db.session.commit()
+        old_id = old.id
+    assert retention.run()['archived']['user_activity'] >= 1
+
+    with app.app_context():
+        db.session.add(UserActivity(id=old_id, timestamp=datetime.utcnow(), activity_type='site_visit'))
+        db.session.commit()
+    result = retention.run()
+    assert result['archived']['user_activity'] == 0
+    assert result['deleted']['user_activity'] == 0
+    with app.app_context():
+        assert db.session.get(UserActivity, old_id) is not None
+        db.session.delete(db.session.get(UserActivity, old_id))
+        db.session.commit()
+
+def test_export_streams_time_range(monkeypatch):
+    monkeypatch.setitem(app.config, 'EXPORT_CHUNK_ROWS', 2)
+    client = app.test_client()
+    base = datetime(2001, 2, 3, 4, 5, 6)
+    with app.app_context():
+        for i in range(5):
+            db.session.add(RequestLog(timestamp=base + timedelta(hours=i), path=f'/export/{i}', method='GET',
+                                      status_code=200))
+        db.session.commit()
+
+    query = 'start=2001-02-03T05:00:00&end=2001-02-03T08:00:00'
+    response = client.get(f'/stats/export/request_log?{query}')
+    assert response.status_code == 200
+    rows = [json.loads(line) for line in response.data.decode().splitlines()]
+    assert [row['path'] for row in rows] == ['/export/1', '/export/2', '/export/3']
+    assert rows[0]['timestamp'] == '2001-02-03T05:05:06'
+
+    response = client.get(f'/stats/export/request_log?{query}&format=csv&gzip=1')
+    assert response.headers['Content-Disposition'] == 'attachment; filename="request_log.csv.gz"'
+    table = list(csv.DictReader(io.StringIO(gzip.decompress(response.data).decode())))
+    assert [row['path'] for row in table] == ['/export/1', '/export/2', '/export/3']
+    assert table[0]['status_code'] == '200'
+
+    # Times with an offset are converted to UTC, the timezone of the stored timestamps
+    zoned = client.get('/stats/export/request_log', query_string={
+        'start': '2001-02-03T07:00:00+02:00', 'end': '2001-02-03T08:00:00Z'})
+    assert [json.loads(line)['path'] for line in zoned.data.decode().splitlines()] == ['/export/1', '/export/2', '/export/3']
+
+    assert client.get('/stats/export/request_log?start=2001-02-03&end=2001-02-03').data == b''
+    assert client.get('/stats/export/request_log?start=yesterday').status_code == 400
+    assert client.get('/stats/export/schema_migration').status_code == 404
+
+def run_concurrently(work, threads=8):
+    import threading
+    workers = [threading.Thread(target=work) for _ in range(threads)]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+
+def test_writer_counters_exact_under_concurrent_submits():
+    writer = LogWriter(app, max_queue=1, policy='drop')
+    writer._ensure_started = lambda: None
+    writer._queue = queue.Queue(maxsize=1)
+    run_concurrently(lambda: [writer.submit(RequestLog, {'path': '/'}) for _ in range(2000)])
+    assert (writer.submitted, writer.dropped) == (16000, 15999)
+
+def test_ingest_counters_exact_under_concurrent_requests():
+    policy = IngestPolicy(bot_agents=r'bot')
+    run_concurrently(lambda: [(policy.classify('/', 'somebot'), policy.sample('/')) for _ in range(2000)])
+    assert (policy.counts['bot'], policy.counts['detailed']) == (16000, 16000)
+
+def test_ingest_policy_sampling_weights():
+    policy = IngestPolicy({'/static/<path:filename>': 0.0, '/half': 0.5}, budget=100,
+                          health_paths=['/healthz'], health_agents='AlwaysOn', bot_agents=r'[\w.-]*bot[\w.-]*')
+    assert policy.classify('/', 'Mozilla/5.0 (compatible; Googlebot/2.1)') == ('bot', 'Googlebot')
+    assert policy.classify('/', 'AlwaysOn') == ('health', '/')
+    assert policy.classify('/healthz', 'curl/8.0') == ('health', '/healthz')
+    assert policy.classify('/', 'Mozilla/5.0 (X11; Linux x86_64)') == (None, None)
+
+    assert policy.sample('/static/<path:filename>') is None
+    assert {policy.sample('/half') for _ in range(200)} == {None, 2.0}
+
+    # 400 rows offered in the last second against a budget of 100: keep a quarter, each weighing 4
+    policy._second, policy._seen = int(time.monotonic()) - 1, 400
+    assert policy.keep_probability() == 0.25
+    assert {policy.sample('/') for _ in range(200)} <= {None, 4.0}
+
+def test_default_bot_pattern_matches_crawler_tokens_only():
+    policy = IngestPolicy(bot_agents=app.config['LOG_BOT_AGENTS'])
+    crawlers = {
+        'Mozilla/5.0 (compatible; Googlebot/2.1; +http://www.google.com/bot.html)': 'Googlebot',
+        'Mozilla/5.0 (compatible; bingbot/2.0; +http://www.bing.com/bingbot.htm)': 'bingbot',
+        'Mozilla/5.0 (compatible; Yahoo! Slurp; http://help.yahoo.com/help/us/ysearch/slurp)': 'Slurp',
+        'DuckDuckBot-Https/1.1; (+https://duckduckgo.com/duckduckbot)': 'DuckDuckBot',
+        'Mozilla/5.0 (compatible;PetalBot;+https://webmaster.petalsearch.com/site/petalbot)': 'PetalBot',
+        'facebookexternalhit/1.1 (+http://www.facebook.com/externalhit_uatext.php)': 'facebookexternalhit',
+    }
+    for agent, name in crawlers.items():
+        assert policy.classify('/', agent) == ('bot', name)
+    for agent in ('Mozilla/5.0 (Linux; Android 10; Cubot X19) AppleWebKit/537.36 Chrome/96.0 Mobile Safari/537.36',
+                  'Mozilla/5.0 (Linux; Android 9; CUBOT_P30) AppleWebKit/537.36 Chrome/90.0 Mobile Safari/537.36',
+                  'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 Chrome/120.0 Safari/537.36'):
+        assert policy.classify('/', agent) == (None, None)
+
+def test_bots_and_sampled_routes_only_counted(monkeypatch):
+    client = app.test_client()
+    assert log_writer.flush()
+    with app.app_context():
+        rows_before = RequestLog.query.count()
+        activities_before = UserActivity.query.count()
+        bots_before = db.session.query(func.sum(TrafficCounter.count)).filter_by(
+            category='bot', label='ExampleBot').scalar() or 0
+
+    client.get('/api/programs', headers={'User-Agent': 'Mozilla/5.0 (compatible; ExampleBot/1.0)'})
+    client.get('/', headers={'User-Agent': 'ExampleBot/1.0'})
+    monkeypatch.setitem(ingest_policy.sample_rates, '/api/programs', 0.0)
+    client.get('/api/programs')
+    monkeypatch.delitem(ingest_policy.sample_rates, '/api/programs')
+    client.get('/api/programs', headers={'User-Agent': 'Interned-Agent/1.0'})
+    client.get('/api/programs', headers={'User-Agent': 'Interned-Agent/1.0'})
+    assert log_writer.flush()
+
+    summary = client.get('/stats/summary').get_json()
+    with app.app_context():
+        assert RequestLog.query.count() == rows_before + 2
+        assert UserActivity.query.count() == activities_before
+        bots = db.session.query(func.sum(TrafficCounter.count)).filter_by(
+            category='bot', label='ExampleBot').scalar()
+        assert bots == bots_before + 2
+        latest = RequestLog.query.order_by(RequestLog.id.desc()).limit(2).all()
+        agent = db.session.get(UserAgent, latest[0].user_agent_id)
+        assert agent.user_agent == 'Interned-Agent/1.0'
+        assert latest[1].user_agent_id == agent.id
+        assert latest[0].user_agent is None and latest[0].weight == 1.0
+        # Rollups still count every request
+        assert summary['total_requests'] >= RequestLog.query.count() + 3
+
+def read_event(stream):
+    chunk = next(stream).decode('utf-8')
+    name = next(line[7:] for line in chunk.splitlines() if line.startswith('event: '))
+    data = next(line[6:] for line in chunk.splitlines() if line.startswith('data: '))
+    return name, json.loads(data)
+
+def test_stats_stream_pushes_deltas(monkeypatch):
+    client = app.test_client()
+    monkeypatch.setattr(live_stats, 'interval', 0.05)
+    assert log_writer.flush()
+    summary = client.get('/stats/summary').get_json()
+
+    response = client.get('/stats/stream', buffered=False)
+    assert response.mimetype == 'text/event-stream'
+    stream = iter(response.response)
+    name, snapshot = read_event(stream)
+    assert name == 'snapshot'
+    # Only the summary and stream requests themselves may have been logged since
+    assert summary['total_requests'] <= snapshot['total_requests'] <= summary['total_requests'] + 2
+    assert snapshot['user_activities']['site_visits'] == summary['user_activities']['site_visits']
+    assert snapshot['user_activities']['recent_activities'] == summary['user_activities']['recent_activities']
+
+    for _ in range(3):
+        client.get('/')
+    assert log_writer.flush()
+    name, update = read_event(stream)
+    assert name == 'update'
+    assert update['total_requests'] == summary['total_requests'] + 5
+    assert update['user_activities']['site_visits'] == summary['user_activities']['site_visits'] + 3
+    assert [activity['type'] for activity in update['new_activities']] == ['site_visit'] * 3
+    assert update['latency']['count'] >= 3 and update['latency']['p99'] >= update['latency']['p50'] > 0
+    assert 'methods' in update and 'filtered_traffic' not in update
+
+    monkeypatch.setitem(app.config, 'LIVE_STATS_MAX_STREAMS', live_stats.streams)
+    assert client.get('/stats/stream').status_code == 503
+    response.close()
+    assert live_stats.streams == 0
+    assert log_writer.flush()
+    assert client.get('/stats/summary').get_json()['total_requests'] == update['total_requests'] + 1